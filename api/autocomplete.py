@@ -0,0 +1,160 @@
+"""Autocomplete.py: In-memory prefix index of compound names, so names can be
+completed at keystroke latency.
+
+Names are those get_extra_info shows for reference compounds, taken from the
+xref_ids map (see ``python -m api.build xref-ids``). Each MINE gets its own
+index with only the names of its compounds, kept as sorted arrays that are
+searched by bisection. Indexes are rebuilt when their MINE or the xref_ids
+map changes."""
+import threading
+import time
+from bisect import bisect_left
+from typing import List, Optional, Tuple
+
+import pymongo
+
+from api.engine import batches
+from api.operators import mine_version
+from api.queries import INCHIKEY_BLOCK1, XREF_ID_COLLECTION
+
+# Number of InChIKey first blocks looked up in xref_ids per query
+_BLOCK_CHUNK_SIZE = 10000
+
+# Indexes of the MINEs served by this process, keyed by database name
+_name_indexes = {}
+
+# Lock of each MINE's index, so building one doesn't hold up the others
+_name_index_locks = {}
+_name_index_locks_lock = threading.Lock()
+
+
+class NameIndex(object):
+    """Compound names sorted by their lower case form.
+
+    Parameters
+    ----------
+    names : List[str]
+        Compound names, in any order. Duplicates are dropped.
+    version : Tuple
+        Version marker of the data the names were taken from (see
+        name_index_version).
+    """
+
+    def __init__(self, names: List[str], version: Tuple = None):
+        entries = sorted({(name.lower(), name) for name in names})
+        self.keys = [key for key, _ in entries]
+        self.names = [name for _, name in entries]
+        self.version = version
+        self.checked_at = time.monotonic()
+
+    @classmethod
+    def from_mongo(cls, core_db: pymongo.database, ref_db: pymongo.database,
+                   mine_db: pymongo.database) -> "NameIndex":
+        """Build the index of the names of a MINE's compounds.
+
+        Parameters
+        ----------
+        core_db : pymongo.database
+            Core database with compound MINE membership.
+        ref_db : pymongo.database
+            Compound references database with the xref_ids map.
+        mine_db : pymongo.database
+            MINE database.
+
+        Returns
+        -------
+        NameIndex
+            The index.
+        """
+        version = name_index_version(ref_db, mine_db)
+        blocks = set()
+        for x in core_db.compounds.find({"MINES": mine_db.name},
+                                        {INCHIKEY_BLOCK1: 1, "Inchikey": 1}):
+            if x.get(INCHIKEY_BLOCK1):
+                blocks.add(x[INCHIKEY_BLOCK1])
+            elif x.get("Inchikey"):
+                blocks.add(x["Inchikey"].split("-")[0])
+        names = []
+        for chunk in batches(sorted(blocks), _BLOCK_CHUNK_SIZE):
+            names.extend(x["name"] for x in ref_db[XREF_ID_COLLECTION].find(
+                {"source": "name", INCHIKEY_BLOCK1: {"$in": chunk}}, {"name": 1, "_id": 0}
+            ))
+        return cls(names, version)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix: str, limit: int = 10) -> List[str]:
+        """Get names starting with prefix (ignoring case), in alphabetical
+        order.
+
+        Parameters
+        ----------
+        prefix : str
+            Start of the name.
+        limit : int
+            Maximum number of names to return.
+
+        Returns
+        -------
+        List[str]
+            Matching names.
+        """
+        prefix = prefix.lower()
+        completions = []
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(completions) < limit:
+            if not self.keys[i].startswith(prefix):
+                break
+            completions.append(self.names[i])
+            i += 1
+        return completions
+
+
+def name_index_version(ref_db: pymongo.database, mine_db: pymongo.database) -> Tuple:
+    """Get the version marker of the names of a MINE: its own version marker
+    (see api.operators.mine_version) and the size of the xref_ids map."""
+    return mine_version(mine_db), ref_db[XREF_ID_COLLECTION].estimated_document_count()
+
+
+def get_name_index(core_db: pymongo.database, ref_db: pymongo.database,
+                   mine_db: pymongo.database, check_interval: float) -> Optional[NameIndex]:
+    """Get the name index of a MINE, building it on first use and rebuilding
+    it if the MINE or the xref_ids map changed.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with compound MINE membership.
+    ref_db : pymongo.database
+        Compound references database with the xref_ids map.
+    mine_db : pymongo.database
+        MINE database.
+    check_interval : float
+        Minimum time in seconds between checks of the version marker.
+
+    Returns
+    -------
+    NameIndex
+        Index of the names of the MINE's compounds, None if there is no
+        such MINE.
+    """
+    mine_name = mine_db.name
+    name_index = _name_indexes.get(mine_name)
+    if name_index is not None and time.monotonic() - name_index.checked_at < check_interval:
+        return name_index
+    if name_index is None and "compounds" not in mine_db.list_collection_names():
+        return None
+
+    with _name_index_locks_lock:
+        lock = _name_index_locks.setdefault(mine_name, threading.Lock())
+    with lock:
+        name_index = _name_indexes.get(mine_name)
+        if name_index is not None and time.monotonic() - name_index.checked_at < check_interval:
+            return name_index
+        if name_index is not None and name_index_version(ref_db, mine_db) == name_index.version:
+            name_index.checked_at = time.monotonic()
+        else:
+            name_index = NameIndex.from_mongo(core_db, ref_db, mine_db)
+            _name_indexes[mine_name] = name_index
+    return name_index
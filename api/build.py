@@ -0,0 +1,346 @@
+"""Offline builders for data precomputed from the MINE databases. Run from
+the MINE-Server directory, e.g.:
+
+    python -m api.build fp-store /data/mine/fingerprints.store
+
+Each command is a subcommand of this module. Run with --help for a list."""
+
+import argparse
+import datetime
+import logging
+
+import pymongo
+from bson.binary import Binary
+from rdkit.Chem import AllChem
+
+from api.config import Config
+from api.fingerprints import PATTERN_FP_SIZE, write_fp_store
+from api.molecules import MOL_COLLECTION
+from api.operators import OP_RXN_CHUNK_SIZE, OP_RXN_COLLECTION, OperatorCatalog
+from api.queries import INCHIKEY_BLOCK1, RXN_SMILES_FIELDS, XREF_ID_COLLECTION
+from api.utils import get_xrefs
+
+logger = logging.getLogger(__name__)
+
+
+def build_fp_store(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Export core compound fingerprints to a memory-mappable store."""
+    core_db = client[args.core_db]
+    n_compounds = write_fp_store(core_db, args.path, fp_type=args.fp_type)
+    logger.info(f"Wrote {n_compounds} fingerprints to {args.path}")
+
+
+def build_pattern_fp(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Store substructure screening fingerprints (Pattern_fp) on core
+    compounds."""
+    core_db = client[args.core_db]
+    query = {} if args.force else {"Pattern_fp": {"$exists": False}}
+    n_updated = 0
+    requests = []
+    for cpd in core_db.compounds.find(query, {"SMILES": 1}, batch_size=args.batch_size):
+        mol = AllChem.MolFromSmiles(cpd["SMILES"]) if cpd.get("SMILES") else None
+        if not mol:
+            logger.warning(f"Unable to parse SMILES of {cpd['_id']}, skipping")
+            continue
+        on_bits = list(AllChem.PatternFingerprint(mol, fpSize=PATTERN_FP_SIZE).GetOnBits())
+        requests.append(pymongo.UpdateOne(
+            {"_id": cpd["_id"]}, {"$set": {"Pattern_fp": on_bits, "len_Pattern_fp": len(on_bits)}}
+        ))
+        if len(requests) >= args.batch_size:
+            n_updated += core_db.compounds.bulk_write(requests, ordered=False).modified_count
+            requests = []
+            logger.info(f"Stored {n_updated} pattern fingerprints")
+    if requests:
+        n_updated += core_db.compounds.bulk_write(requests, ordered=False).modified_count
+    logger.info(f"Stored {n_updated} pattern fingerprints")
+
+
+def build_mol_cache(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Store serialized RDKit molecules of core compounds for MolCache."""
+    core_db = client[args.core_db]
+    mol_collection = core_db[MOL_COLLECTION]
+    n_stored = 0
+    batch = []
+
+    def store_batch():
+        """Serialize and store molecules of the compounds in batch."""
+        ids = [cpd["_id"] for cpd in batch]
+        if args.force:
+            done = set()
+        else:
+            done = {x["_id"] for x in mol_collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+        requests = []
+        for cpd in batch:
+            if cpd["_id"] in done:
+                continue
+            mol = AllChem.MolFromSmiles(cpd["SMILES"]) if cpd.get("SMILES") else None
+            if not mol:
+                logger.warning(f"Unable to parse SMILES of {cpd['_id']}, skipping")
+                continue
+            requests.append(pymongo.ReplaceOne(
+                {"_id": cpd["_id"]}, {"_id": cpd["_id"], "Mol": Binary(mol.ToBinary())},
+                upsert=True,
+            ))
+        if requests:
+            mol_collection.bulk_write(requests, ordered=False)
+        return len(requests)
+
+    for cpd in core_db.compounds.find({}, {"SMILES": 1}, batch_size=args.batch_size):
+        batch.append(cpd)
+        if len(batch) >= args.batch_size:
+            n_stored += store_batch()
+            batch = []
+            logger.info(f"Stored {n_stored} molecules")
+    if batch:
+        n_stored += store_batch()
+    logger.info(f"Stored {n_stored} molecules")
+
+
+def build_inchikey_block1(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Store the first block of InChIKeys as inchikey_block1 on core, MINE
+    and reference compounds and index it for exact structure lookups."""
+    # (collection, field with full InChIKeys)
+    targets = [(client[args.core_db].compounds, "Inchikey"),
+               (client[args.ref_db].data, "Inchikey")]
+    targets += [(client[name].compounds, "InChI_key")
+                for name in _mine_names(client, args, "compounds", skip={args.ref_db})]
+
+    for collection, key_field in targets:
+        query = {key_field: {"$type": "string"}}
+        if not args.force:
+            query[INCHIKEY_BLOCK1] = {"$exists": False}
+        # Computed server side by an update pipeline (MongoDB 4.2+)
+        result = collection.update_many(
+            query, [{"$set": {INCHIKEY_BLOCK1: {"$substrCP": ["$" + key_field, 0, 14]}}}]
+        )
+        collection.create_index(INCHIKEY_BLOCK1)
+        logger.info(f"Stored {INCHIKEY_BLOCK1} on {result.modified_count} documents of "
+                    f"{collection.full_name} and indexed it")
+    logger.info("Restart the server to switch structure lookups to the new indexes")
+
+
+def build_rxn_smiles(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Store the SMILES of each reaction participant (Reactant_SMILES and
+    Product_SMILES) on MINE reactions, parsed from SMILES_rxn."""
+    for name in _mine_names(client, args, "reactions"):
+        query = {"SMILES_rxn": {"$type": "string"}}
+        if not args.force:
+            query["Reactant_SMILES"] = {"$exists": False}
+        # Computed server side by an update pipeline (MongoDB 4.2+)
+        result = client[name].reactions.update_many(query, [{"$set": RXN_SMILES_FIELDS}])
+        logger.info(f"Stored participant SMILES on {result.modified_count} reactions of {name}")
+
+
+def build_op_rxns(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Materialize each operator's reaction _ids (in chunks) and count of
+    reactions for MINEs."""
+    for name in _mine_names(client, args, "operators"):
+        db = client[name]
+        catalog = OperatorCatalog.from_mongo(db)
+        # Built aside and swapped in, so servers keep reading the old index
+        side = db[OP_RXN_COLLECTION + "_build"]
+        side.drop()
+        side.create_index([("operator", pymongo.ASCENDING), ("chunk", pymongo.ASCENDING)],
+                          unique=True)
+
+        # Reaction _ids not yet written and number written of each operator
+        # (by operator _id)
+        buffers = {}
+        counts = {}
+        chunks = []
+
+        def flush(op_id):
+            """Queue the buffered reaction _ids of an operator as a chunk."""
+            rxn_ids = buffers.pop(op_id)
+            count = counts.get(op_id, 0)
+            chunks.append({"operator": op_id, "chunk": count // OP_RXN_CHUNK_SIZE,
+                           "Reaction_ids": rxn_ids})
+            counts[op_id] = count + len(rxn_ids)
+            if len(chunks) >= 100:
+                side.insert_many(chunks, ordered=False)
+                chunks.clear()
+
+        for rxn in db.reactions.find({}, {"Operators": 1}, batch_size=args.batch_size):
+            # Reactions list operators by _id or Name, dedupe per reaction
+            op_ids = {}
+            for op_key in rxn.get("Operators", []):
+                operator = catalog.get(op_key)
+                op_ids[operator["_id"] if operator else op_key] = None
+            for op_id in op_ids:
+                buffers.setdefault(op_id, []).append(rxn["_id"])
+                if len(buffers[op_id]) >= OP_RXN_CHUNK_SIZE:
+                    flush(op_id)
+        for op_id in list(buffers):
+            flush(op_id)
+        if chunks:
+            side.insert_many(chunks, ordered=False)
+        side.rename(OP_RXN_COLLECTION, dropTarget=True)
+
+        # Counts are overwritten in place, never reset first, so readers
+        # don't see zero counts while (or if) this runs
+        requests = [pymongo.UpdateOne({"_id": op_id}, {"$set": {"Reaction_count": count}})
+                    for op_id, count in counts.items() if op_id in catalog.by_id]
+        if requests:
+            db.operators.bulk_write(requests, ordered=False)
+        db.operators.update_many({"_id": {"$nin": list(counts)}},
+                                 {"$set": {"Reaction_count": 0}})
+        n_unknown = sum(op_id not in catalog.by_id for op_id in counts)
+        if n_unknown:
+            logger.warning(f"{n_unknown} operators of {name} reactions aren't in its "
+                           f"operators collection")
+        # New version marker, so servers reload their operator catalogs
+        db.meta_data.insert_one({"Timestamp": datetime.datetime.now(),
+                                 "Action": "Operator reaction index built"})
+        logger.info(f"Indexed reactions of {len(counts)} operators of {name}")
+
+
+def build_xref_ids(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Map the cross-reference ids and lower case names of reference
+    compounds (as shown by get_extra_info) to InChIKey first blocks, for
+    quick search and name autocompletion."""
+    ref_db = client[args.ref_db]
+    building = ref_db[XREF_ID_COLLECTION + "_build"]
+    building.drop()
+    n_entries = 0
+    entries = []
+    for ref_cpd in ref_db.data.find({"Inchikey": {"$type": "string"}},
+                                    {"Inchikey": 1, "cross_references": 1, "pubchem_id": 1},
+                                    batch_size=args.batch_size):
+        xrefs, names = get_xrefs(ref_cpd)
+        block1 = ref_cpd["Inchikey"].split("-")[0]
+        sources = {str(source_id): {"source": source} for source, source_id in xrefs.items()}
+        # Names also keep their spelling for autocompletion
+        for name in names:
+            sources.setdefault(name.lower(), {"source": "name", "name": name})
+        entries.extend(dict(entry, source_id=source_id, **{INCHIKEY_BLOCK1: block1})
+                       for source_id, entry in sources.items())
+        if len(entries) >= args.batch_size:
+            building.insert_many(entries, ordered=False)
+            n_entries += len(entries)
+            entries = []
+    if entries:
+        building.insert_many(entries, ordered=False)
+        n_entries += len(entries)
+    if not n_entries:
+        logger.warning(f"No cross-references found in {ref_db.name}.data")
+        return
+
+    # Covers quick search lookups, which only read inchikey_block1
+    building.create_index([("source_id", pymongo.ASCENDING), (INCHIKEY_BLOCK1, pymongo.ASCENDING)])
+    # Serves autocompletion, which reads the names of a MINE's blocks
+    building.create_index([(INCHIKEY_BLOCK1, pymongo.ASCENDING), ("source", pymongo.ASCENDING)])
+    building.rename(XREF_ID_COLLECTION, dropTarget=True)
+    logger.info(f"Mapped {n_entries} cross-reference ids and names to InChIKey blocks")
+
+
+def build_search_indexes(client: pymongo.MongoClient, args: argparse.Namespace) -> None:
+    """Create compound indexes for quick search on core compounds, so
+    identifier lookups filter by MINE within the index."""
+    core_db = client[args.core_db]
+    for field in ["KEGG_id", "MINE_id", "Inchikey", INCHIKEY_BLOCK1]:
+        name = core_db.compounds.create_index([(field, pymongo.ASCENDING),
+                                               ("MINES", pymongo.ASCENDING)])
+        logger.info(f"Created index {name} on {core_db.name}.compounds")
+
+
+def _mine_names(client: pymongo.MongoClient, args: argparse.Namespace, collection: str,
+                skip: set = frozenset()) -> list:
+    """Get the MINE databases given with --mine, or every database with
+    collection besides the core, KEGG and system databases (and skip)."""
+    if args.mine:
+        return args.mine
+    skip = set(skip) | {args.core_db, Config.KEGG_DB_NAME, "admin", "config", "local"}
+    return [name for name in client.list_database_names()
+            if name not in skip and collection in client[name].list_collection_names()]
+
+
+def main(argv=None):
+    """Parse command line arguments and run the selected builder."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--mongo-uri", default=Config.MONGO_URI,
+                        help="URI of the MINE MongoDB (default: Config.MONGO_URI)")
+    parser.add_argument("--core-db", default=Config.CORE_DB_NAME,
+                        help="Name of the core compound database")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    fp_store_parser = subparsers.add_parser(
+        "fp-store", help="Export fingerprints and MINE membership to a fingerprint store"
+    )
+    fp_store_parser.add_argument("path", help="Path of the store file to write")
+    fp_store_parser.add_argument("--fp-type", default="RDKit_fp",
+                                 help="Fingerprint field to export")
+    fp_store_parser.set_defaults(func=build_fp_store)
+
+    pattern_fp_parser = subparsers.add_parser(
+        "pattern-fp", help="Compute substructure screening fingerprints of core compounds"
+    )
+    pattern_fp_parser.add_argument("--force", action="store_true",
+                                   help="Recompute fingerprints compounds already have")
+    pattern_fp_parser.add_argument("--batch-size", type=int, default=1000,
+                                   help="Number of compounds updated per bulk write")
+    pattern_fp_parser.set_defaults(func=build_pattern_fp)
+
+    mol_cache_parser = subparsers.add_parser(
+        "mol-cache", help="Store serialized RDKit molecules of core compounds"
+    )
+    mol_cache_parser.add_argument("--force", action="store_true",
+                                  help="Replace molecules that are already stored")
+    mol_cache_parser.add_argument("--batch-size", type=int, default=1000,
+                                  help="Number of compounds written per bulk write")
+    mol_cache_parser.set_defaults(func=build_mol_cache)
+
+    block1_parser = subparsers.add_parser(
+        "inchikey-block1", help="Store and index InChIKey first blocks for exact structure lookups"
+    )
+    block1_parser.add_argument("--mine", action="append",
+                               help="Name of a MINE database to update (repeatable, default: "
+                                    "every database with a compounds collection)")
+    block1_parser.add_argument("--ref-db", default=Config.REF_DB_NAME,
+                               help="Name of the compound references database")
+    block1_parser.add_argument("--force", action="store_true",
+                               help="Recompute the field on documents that already have it")
+    block1_parser.set_defaults(func=build_inchikey_block1)
+
+    rxn_smiles_parser = subparsers.add_parser(
+        "rxn-smiles", help="Store SMILES of reaction participants on MINE reactions"
+    )
+    rxn_smiles_parser.add_argument("--mine", action="append",
+                                   help="Name of a MINE database to update (repeatable, "
+                                        "default: every database with a reactions collection)")
+    rxn_smiles_parser.add_argument("--force", action="store_true",
+                                   help="Recompute SMILES of reactions that already have them")
+    rxn_smiles_parser.set_defaults(func=build_rxn_smiles)
+
+    op_rxns_parser = subparsers.add_parser(
+        "op-rxns", help="Materialize reaction _ids and counts of each operator"
+    )
+    op_rxns_parser.add_argument("--mine", action="append",
+                                help="Name of a MINE database to index (repeatable, "
+                                     "default: every database with an operators collection)")
+    op_rxns_parser.add_argument("--batch-size", type=int, default=10000,
+                                help="Number of reactions read per batch")
+    op_rxns_parser.set_defaults(func=build_op_rxns)
+
+    xref_ids_parser = subparsers.add_parser(
+        "xref-ids", help="Map cross-reference ids and names to InChIKey blocks for quick search"
+    )
+    xref_ids_parser.add_argument("--ref-db", default=Config.REF_DB_NAME,
+                                 help="Name of the compound references database")
+    xref_ids_parser.add_argument("--batch-size", type=int, default=10000,
+                                 help="Number of map entries written per insert")
+    xref_ids_parser.set_defaults(func=build_xref_ids)
+
+    search_indexes_parser = subparsers.add_parser(
+        "search-indexes", help="Create quick search indexes on core compounds"
+    )
+    search_indexes_parser.set_defaults(func=build_search_indexes)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    client = pymongo.MongoClient(args.mongo_uri)
+    args.func(client, args)
+
+
+if __name__ == "__main__":
+    main()
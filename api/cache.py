@@ -0,0 +1,210 @@
+"""Cache.py: Caches shared by the requests a server worker handles. LRU and
+TTL caches live in the worker's memory, SQLiteCache persists entries in a
+file shared by all workers and kept across restarts."""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with a bounded number of entries.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of entries. The least recently used entry is evicted
+        when a new one would exceed it.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups that found their key.
+    misses : int
+        Number of lookups that didn't find their key.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value for key (marking it as recently used) or default."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Set the value for key, evicting the least recently used entries if
+        the cache is full."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries and reset the hit and miss counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Get the size, maximum size, hits and misses of the cache."""
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TTLCache(LRUCache):
+    """LRU cache whose entries also expire a fixed time after being put.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of entries.
+    ttl : float
+        Time to live of entries in seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        LRUCache.__init__(self, max_size)
+        self.ttl = ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value for key if it hasn't expired (marking it as recently
+        used), otherwise default."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Set the value for key, expiring ttl seconds from now."""
+        LRUCache.put(self, key, (time.monotonic() + self.ttl, value))
+
+
+class SQLiteCache(object):
+    """Cache of JSON-serializable values in a SQLite file, shared by the
+    server's worker processes and kept across restarts. Entries expire a
+    fixed time after being put.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file (created if needed).
+    ttl : float
+        Time to live of entries in seconds.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                               "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self._conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value for key if it hasn't expired, otherwise default."""
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?",
+                                     (key,)).fetchone()
+            if row is None or row[1] <= time.time():
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """Set the value for key, expiring ttl seconds from now."""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                               (key, json.dumps(value), time.time() + self.ttl))
+
+    def clear(self) -> None:
+        """Remove all entries and reset the hit and miss counters."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Get the size, hits and misses of the cache."""
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class TieredCache(object):
+    """In-memory cache in front of a persistent one. Entries found only in
+    the persistent cache are copied to memory.
+
+    Parameters
+    ----------
+    memory : LRUCache
+        Fast in-process cache, checked first.
+    disk : SQLiteCache
+        Persistent cache.
+    """
+
+    def __init__(self, memory: LRUCache, disk: SQLiteCache):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value for key from memory or disk, otherwise default."""
+        value = self.memory.get(key)
+        if value is None:
+            value = self.disk.get(key)
+            if value is None:
+                return default
+            self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Set the value for key in both tiers."""
+        self.memory.put(key, value)
+        self.disk.put(key, value)
+
+    def clear(self) -> None:
+        """Remove all entries from both tiers."""
+        self.memory.clear()
+        self.disk.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Get statistics of both tiers."""
+        return {"memory": self.memory.stats(), "disk": self.disk.stats()}
@@ -0,0 +1,281 @@
+"""Compression.py: Compresses responses with the encoding clients prefer.
+
+init_compression registers an after_request hook that compresses JSON,
+MessagePack, Arrow and text responses with zstd, brotli or gzip (whichever
+the Accept-Encoding header prefers among those installed). Buffered
+responses are only compressed above a minimum size. Streamed responses are
+compressed chunk by chunk, flushing after each so clients still receive
+data as it is produced.
+
+Static files (operator images, adduct lists) are compressed once at the
+highest levels by send_precompressed and served from copies kept in a cache
+directory."""
+import gzip
+import mimetypes
+import os
+import tempfile
+import zlib
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from flask import current_app, request, send_file
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#: Content encodings this server can produce, in order of preference when a
+#: client accepts several equally
+ENCODINGS = [encoding for encoding, module in [("zstd", zstandard), ("br", brotli),
+                                               ("gzip", zlib)] if module is not None]
+
+#: File extensions of precompressed copies by encoding
+ENCODING_EXTENSIONS = {"zstd": ".zst", "br": ".br", "gzip": ".gz"}
+
+#: Mimetypes (besides text/*) of responses worth compressing
+COMPRESSIBLE_MIMETYPES = frozenset([
+    "application/json",
+    "application/x-ndjson",
+    "application/msgpack",
+    "application/vnd.apache.arrow.stream",
+    "application/javascript",
+    "image/svg+xml",
+])
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compress data.
+
+    Parameters
+    ----------
+    data : bytes
+        Data to compress.
+    encoding : str
+        Content encoding, one of ENCODINGS.
+    level : int
+        Compression level (gzip 1-9, br 0-11, zstd 1-22).
+
+    Returns
+    -------
+    bytes
+        Compressed data.
+    """
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+def compress_stream(chunks: Iterable[bytes], encoding: str, level: int) -> Iterator[bytes]:
+    """Compress a stream of chunks, flushing after each chunk so the
+    compressed stream can be decoded as far as it has been received.
+
+    Parameters
+    ----------
+    chunks : Iterable[bytes]
+        Data to compress (str chunks are UTF-8 encoded).
+    encoding : str
+        Content encoding, one of ENCODINGS.
+    level : int
+        Compression level.
+
+    Yields
+    ------
+    bytes
+        Compressed data.
+    """
+    if encoding == "gzip":
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+        def process(chunk):
+            return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+
+        def process(chunk):
+            return compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+        def process(chunk):
+            return compressor.compress(chunk) + compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        finish = compressor.flush
+    else:
+        raise ValueError(f"Unknown content encoding: {encoding}")
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield process(chunk)
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def negotiate_encoding() -> Optional[str]:
+    """Get the content encoding the client of the current request prefers,
+    None if it accepts none of ENCODINGS or compression is off."""
+    if not current_app.config["COMPRESSION_ON"]:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def compress_response(response):
+    """Compress a response with the encoding the client prefers, if it is
+    of a compressible type (after_request hook, see init_compression)."""
+    if (response.direct_passthrough or "Content-Encoding" in response.headers
+            or not 200 <= response.status_code < 300 or response.status_code == 204
+            or not _is_compressible(response.mimetype)):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    level = current_app.config["COMPRESSION_LEVELS"][encoding]
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESSION_MIN_SIZE"]:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app) -> None:
+    """Compress responses of app (see compress_response).
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The app.
+    """
+    app.after_request(compress_response)
+
+
+def send_precompressed(path: str, cache_dir: str, mimetype: str = None):
+    """Send a file compressed with the encoding the client prefers, from a
+    copy compressed once and kept in cache_dir (rebuilt when the file
+    changes). The file itself is sent if the client accepts no encoding or
+    compression doesn't make it smaller (e.g. JPEG images).
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    cache_dir : str
+        Directory with compressed copies (created if needed).
+    mimetype : str
+        Mimetype of the file, guessed from its name if not given.
+
+    Returns
+    -------
+    flask.Response
+        The file.
+    """
+    if not os.path.isfile(path):
+        raise NotFound()
+    path = os.path.abspath(path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    encoding = negotiate_encoding()
+    cached = _precompressed_copy(path, cache_dir, encoding) if encoding else None
+    if cached is not None and os.path.getsize(cached) < os.path.getsize(path):
+        response = send_file(cached, mimetype=mimetype, conditional=True)
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def write_cache_file(path: str, build: Callable[[], bytes], sources: List[str]) -> Optional[str]:
+    """Write the data made by build to path, unless path is already newer
+    than all sources.
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache file.
+    build : Callable[[], bytes]
+        Makes the data.
+    sources : List[str]
+        Paths to the files the data is made from.
+
+    Returns
+    -------
+    Optional[str]
+        path, or None if it couldn't be written.
+    """
+    if _is_fresh(path, sources):
+        return path
+    try:
+        _write_atomic(path, build())
+    except OSError as err:
+        current_app.logger.warning(f"Unable to write cache file {path}: {err}")
+        return None
+    return path
+
+
+def _precompressed_copy(path: str, cache_dir: str, encoding: str) -> Optional[str]:
+    """Get the path to the copy of a file compressed with encoding, making
+    it if needed. None if it couldn't be written."""
+    cached = os.path.join(cache_dir, os.path.basename(path) + ENCODING_EXTENSIONS[encoding])
+    if _is_fresh(cached, [path]):
+        return cached
+    try:
+        with open(path, "rb") as infile:
+            data = compress(infile.read(), encoding,
+                            current_app.config["PRECOMPRESSION_LEVELS"][encoding])
+        _write_atomic(cached, data)
+    except OSError as err:
+        current_app.logger.warning(f"Unable to write compressed copy {cached}: {err}")
+        return None
+    return cached
+
+
+def _is_fresh(path: str, sources: List[str]) -> bool:
+    """Whether path exists and is at least as new as all sources."""
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Write a file through a temporary one, so other workers never read it
+    half written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _is_compressible(mimetype: str) -> bool:
+    """Whether responses of a mimetype are worth compressing."""
+    return bool(mimetype) and (mimetype.startswith("text/")
+                               or mimetype in COMPRESSIBLE_MIMETYPES)
@@ -21,6 +21,132 @@ class Config(object):
     #: Whether to use thermo database - useful to switch off for development
     THERMO_ON = True
 
+    #: Whether to keep packed fingerprints of each MINE in memory to speed up
+    #: similarity searches (built on first search against each MINE)
+    FP_INDEX_ON = True
+
+    #: Whether to keep an inverted index from fingerprint bits to compounds of
+    #: each MINE in memory to screen substructure searches
+    FP_POSTINGS_ON = True
+
+    #: Whether to compress responses for clients that accept it (gzip, and
+    #: brotli or zstd if their packages are installed)
+    COMPRESSION_ON = True
+
+    #: Whether to sort the keys of JSON responses. Off, since sorting slows
+    #: down serialization and documents keep their field order without it.
+    JSON_SORT_KEYS = False
+
+    #: Whether to refuse database queries that no index can serve (checked
+    #: with explain before they run). Queries are bounded by
+    #: MAX_DATABASE_QUERY_PAGE_SIZE and DATABASE_QUERY_TIME_MS either way.
+    REJECT_COLLSCAN_QUERIES = False
+
+    # ------------------------------- Limits -------------------------------- #
+
+    #: Maximum number of query structures in one batch similarity search
+    MAX_BATCH_QUERIES = 1000
+
+    # Time budgets (in ms) of expensive searches. When one runs out, the
+    # results found so far are returned with an "X-Truncated: true" header
+    # (streamed results end with a {"truncated": true, "next_token": ...}
+    # line instead). Clients can lower (not raise) them with a "time_ms"
+    # argument.
+
+    #: Time budget of similarity searches (None for no limit)
+    SIMILARITY_SEARCH_TIME_MS = 10000
+
+    #: Time budget of substructure searches (None for no limit)
+    SUBSTRUCTURE_SEARCH_TIME_MS = 10000
+
+    #: Time budget of database queries (None for no limit)
+    DATABASE_QUERY_TIME_MS = 10000
+
+    #: Time budget of streamed reactions producing or consuming a compound
+    #: (None for no limit)
+    RXN_STREAM_TIME_MS = 30000
+
+    #: Default number of compounds per page of database query results
+    DATABASE_QUERY_PAGE_SIZE = 100
+
+    #: Maximum number of compounds per page of database query results a
+    #: client can ask for
+    MAX_DATABASE_QUERY_PAGE_SIZE = 1000
+
+    #: Number of documents read from Mongo and written out at a time by
+    #: streamed (NDJSON) responses
+    STREAM_BATCH_SIZE = 1000
+
+    #: Default number of reactions per page of reactions producing or
+    #: consuming a compound
+    RXN_PAGE_SIZE = 100
+
+    #: Maximum number of reactions per page a client can ask for
+    MAX_RXN_PAGE_SIZE = 5000
+
+    #: Default number of names returned by name autocompletion
+    AUTOCOMPLETE_LIMIT = 10
+
+    #: Maximum number of names returned by name autocompletion a client can
+    #: ask for
+    MAX_AUTOCOMPLETE_LIMIT = 100
+
+    # ------------------------------- Search -------------------------------- #
+
+    #: Fingerprint field used to screen substructure search candidates.
+    #: "Pattern_fp" needs "python -m api.build pattern-fp" to be run against
+    #: the core database first (searches fall back to "RDKit_fp", with a
+    #: logged warning, until it is), "RDKit_fp" works without it but screens
+    #: out fewer compounds.
+    SUBSTRUCTURE_SCREEN_FP = 'Pattern_fp'
+
+    #: Number of worker processes (per server worker) that similarity and
+    #: substructure searches are sharded across. Less than 2 runs searches
+    #: in the request worker. Similarity searches are only sharded when
+    #: FP_STORE_PATH is set.
+    SEARCH_PROCESSES = 0
+
+    #: Number of shards each similarity search is split into
+    SEARCH_SHARDS = 16
+
+    # ------------------------------- Caches -------------------------------- #
+
+    #: Maximum number of parsed candidate molecules kept in memory for
+    #: substructure matching (0 parses SMILES every time). Stored molecules
+    #: are written by "python -m api.build mol-cache".
+    MOL_CACHE_SIZE = 20000
+
+    #: Maximum number of parsed query structures kept in memory, so the same
+    #: structure sent to several search routes is only parsed once
+    STRUCTURE_CACHE_SIZE = 1000
+
+    #: Maximum number of compounds' resolved cross-references and names kept
+    #: in memory (keyed by InChIKey first block)
+    XREF_CACHE_SIZE = 50000
+
+    #: Time (in s) cached cross-references and names are used for
+    XREF_CACHE_TTL = 24 * 60 * 60
+
+    #: Minimum time (in s) between checks whether a MINE changed, which
+    #: reloads its in-memory operator catalog
+    OP_CATALOG_CHECK_INTERVAL = 60
+
+    #: Minimum time (in s) between checks whether a MINE or the xref_ids map
+    #: changed, which rebuilds the MINE's in-memory autocomplete name index
+    NAME_INDEX_CHECK_INTERVAL = 60
+
+    # ----------------------------- Compression ----------------------------- #
+
+    #: Compression level of responses by content encoding
+    COMPRESSION_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+
+    #: Compression level of static files, which are compressed only once
+    PRECOMPRESSION_LEVELS = {'gzip': 9, 'br': 11, 'zstd': 19}
+
+    #: Minimum size (in bytes) of responses to compress. Streamed responses
+    #: are always compressed.
+    COMPRESSION_MIN_SIZE = 1024
+
     # ------------------------------ Filepaths ------------------------------ #
     # Local filepaths are defined here
 
@@ -38,6 +164,24 @@ class Config(object):
     #: Path to operator images
     OP_IMG_DIR = os.path.join(APP_DIR, '../static/operator_images')
 
+    #: Path to directory with compressed copies of operator images and
+    #: adduct lists (created on first use)
+    COMPRESSION_CACHE_DIR = os.path.join(APP_DIR, '../cache/compressed')
+
+    #: Path to fingerprint store written by "python -m api.build fp-store".
+    #: If None, or the store is stale (the core database has another number
+    #: of compounds than it was built from), fingerprint indexes are built
+    #: from the core database instead.
+    FP_STORE_PATH = None
+
+    #: Whether to check the fingerprint store checksum on startup
+    FP_STORE_VERIFY = True
+
+    #: Path to SQLite file caching cross-references and names across
+    #: restarts (shared by all workers). If None, they are only cached in
+    #: memory.
+    XREF_CACHE_PATH = None
+
     #: Path to SSL certificate (for development)
     SSL_CERT_PATH = os.path.join(APP_DIR, '../certs/minedatabase_ci_northwestern_edu.cer')
 
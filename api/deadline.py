@@ -0,0 +1,61 @@
+"""Deadline.py: Time budgets for expensive searches, so a pathological query
+returns partial results instead of holding a server worker for minutes.
+
+Searches take a Deadline, pass its remaining time to Mongo cursors as
+maxTimeMS and check it inside their Python match loops. When it runs out they
+stop, keep the results found so far and set Deadline.truncated."""
+import time
+from typing import Optional
+
+
+class Deadline(object):
+    """Time budget of one request, started on creation.
+
+    Parameters
+    ----------
+    budget_ms : float
+        Budget in milliseconds. None for no limit.
+
+    Attributes
+    ----------
+    truncated : bool
+        Whether a search stopped early because the budget ran out.
+    """
+
+    def __init__(self, budget_ms: Optional[float]):
+        self.budget_ms = budget_ms
+        self.truncated = False
+        self._start = time.monotonic()
+
+    def elapsed_ms(self) -> float:
+        """Get the time since the deadline was started in milliseconds."""
+        return (time.monotonic() - self._start) * 1000
+
+    def remaining_ms(self) -> Optional[float]:
+        """Get the time left in milliseconds (None if there is no limit)."""
+        if self.budget_ms is None:
+            return None
+        return max(0.0, self.budget_ms - self.elapsed_ms())
+
+    def expired(self) -> bool:
+        """Check whether the budget is used up, marking results as truncated
+        if so."""
+        if self.budget_ms is not None and self.elapsed_ms() >= self.budget_ms:
+            self.truncated = True
+        return self.truncated
+
+    def max_time_ms(self) -> Optional[int]:
+        """Get the time left as a Mongo maxTimeMS value (None if there is no
+        limit). At least 1, since 0 means no limit to Mongo."""
+        remaining = self.remaining_ms()
+        if remaining is None:
+            return None
+        return max(1, int(remaining))
+
+    def timeout(self) -> Optional[float]:
+        """Get the time left in seconds to wait for a future (None if there
+        is no limit)."""
+        remaining = self.remaining_ms()
+        if remaining is None:
+            return None
+        return remaining / 1000
@@ -0,0 +1,334 @@
+"""Engine.py: Runs similarity and substructure searches across a persistent
+pool of worker processes, so that one heavy query uses every core instead of
+pinning the request worker's core.
+
+The candidate space of a query is split into shards: contiguous ranges of a
+fingerprint index's popcount window for similarity searches, and consecutive
+chunks of screened candidates for substructure searches. Each shard returns
+at most limit hits, and shards are merged in order so results are the same
+as those of a sequential search. Shards that haven't started yet are
+cancelled as soon as the global limit is met.
+
+Worker processes read fingerprints from the fingerprint store (see
+api.fingerprints) through their own memory map, so similarity searches are
+only sharded for indexes taken from a store.
+
+If the pool can't be started or a worker dies, searches run in the request
+process instead."""
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import Generator, Iterable, List, Tuple
+
+import numpy as np
+from rdkit.Chem import AllChem
+
+from api.deadline import Deadline
+from api.fingerprints import FingerprintIndex, FingerprintStore
+from api.molecules import MolCache
+
+logger = logging.getLogger(__name__)
+
+# Number of screened candidates per substructure shard
+_SUBSTRUCTURE_CHUNK_SIZE = 2000
+
+# Engine shared by all requests of this process, see get_search_engine
+_engine = None
+_engine_lock = threading.Lock()
+
+# State of worker processes: open stores, MINE indexes and parsed queries
+_worker_stores = {}
+_worker_indexes = {}
+_worker_mols = {}
+
+
+class SearchEngine(object):
+    """Pool of worker processes that run sharded searches.
+
+    Parameters
+    ----------
+    processes : int
+        Number of worker processes.
+    shards : int
+        Number of shards each similarity search is split into. Using more
+        shards than processes lets searches stop earlier once the limit is
+        met.
+
+    Attributes
+    ----------
+    broken : bool
+        Whether the pool failed (workers couldn't start or died). Searches
+        of a broken engine run in the calling process.
+    """
+
+    def __init__(self, processes: int, shards: int):
+        self.processes = processes
+        self.shards = max(1, shards)
+        self.broken = False
+        # Spawn workers, forking a process with open Mongo connections and
+        # their monitor threads is unsafe
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def shutdown(self):
+        """Stop all worker processes."""
+        self._executor.shutdown(wait=False)
+
+    def _mark_broken(self, err: Exception) -> None:
+        """Stop using the pool after it failed."""
+        if not self.broken:
+            logger.warning(f"Search worker pool failed ({err!r}), searching in the "
+                           f"request process instead")
+            self.broken = True
+            self.shutdown()
+
+    def similarity(self, fp_index: FingerprintIndex, mine_name: str, query_bits: Iterable[int],
+                   min_tc: float, limit: int, ranked: bool = False,
+                   deadline: Deadline = None) -> List[Tuple[str, float]]:
+        """Run FingerprintIndex.search (or top_k if ranked) across the pool.
+
+        Parameters
+        ----------
+        fp_index : FingerprintIndex
+            Index of the MINE to search. Searched in this process if it wasn't
+            taken from a fingerprint store.
+        mine_name : str
+            Name of the MINE (workers get their index from the store by name).
+        query_bits : Iterable[int]
+            On-bits of the query fingerprint.
+        min_tc : float
+            Minimum Tanimoto score.
+        limit : int
+            The maximum number of hits to return.
+        ranked : bool
+            Whether to return the limit best hits sorted by decreasing score.
+        deadline : Deadline
+            Time budget of the search. If it runs out, hits of the shards
+            finished so far are returned and deadline.truncated is set.
+
+        Returns
+        -------
+        hits : List[Tuple[str, float]]
+            (_id, Tanimoto score) of hits, as fp_index would return them.
+        """
+        deadline = deadline or Deadline(None)
+        query_bits = sorted(query_bits)
+        if fp_index.store_path is None or self.broken:
+            return _search_index(fp_index, query_bits, min_tc, limit, ranked, deadline)
+
+        start, stop = fp_index.window(len(query_bits), min_tc)
+        bounds = np.linspace(start, stop, self.shards + 1).astype(int)
+        hits = []
+        try:
+            futures = [
+                self._executor.submit(_similarity_shard, fp_index.store_path, mine_name,
+                                      query_bits, min_tc, limit, int(shard_start),
+                                      int(shard_stop), ranked, deadline.remaining_ms())
+                for shard_start, shard_stop in zip(bounds[:-1], bounds[1:])
+                if shard_stop > shard_start
+            ]
+            for i, future in enumerate(futures):
+                try:
+                    shard_hits, shard_truncated = future.result(timeout=deadline.timeout())
+                    hits.extend(shard_hits)
+                    if shard_truncated:
+                        deadline.truncated = True
+                except FutureTimeoutError:
+                    deadline.truncated = True
+                if deadline.truncated or (not ranked and len(hits) >= limit):
+                    for pending in futures[i + 1:]:
+                        pending.cancel()
+                    break
+        except BrokenProcessPool as err:
+            self._mark_broken(err)
+            return _search_index(fp_index, query_bits, min_tc, limit, ranked, deadline)
+        if ranked:
+            # Shards are in index order and each is sorted by decreasing
+            # score, so a stable sort breaks ties by index position
+            hits.sort(key=lambda hit: -hit[1])
+        return hits[:limit]
+
+    def substructure(self, candidates: Iterable[dict], sub_structure: str, limit: int,
+                     mol_cache: MolCache = None, deadline: Deadline = None) -> List[dict]:
+        """Check screened candidates for a substructure across the pool.
+
+        Parameters
+        ----------
+        candidates : Iterable[dict]
+            Compound documents with a SMILES field (e.g. a Mongo cursor).
+            Consumed lazily and only as far as needed to reach limit.
+        sub_structure : str
+            The substructure in molfile or SMILES format.
+        limit : int
+            The maximum number of compounds to return.
+        mol_cache : MolCache
+            Cache to get candidate molecules from. Molecules are sent to
+            workers in binary form instead of as SMILES to parse.
+        deadline : Deadline
+            Time budget of the search. If it runs out, matches of the shards
+            finished so far are returned and deadline.truncated is set.
+
+        Returns
+        -------
+        matches : List[dict]
+            The first limit candidates (in candidates order) that contain the
+            substructure.
+        """
+        deadline = deadline or Deadline(None)
+        matches = []
+        # (chunk, its molecules or SMILES, future) of each shard, with no
+        # future for shards to check in this process
+        in_flight = deque()
+
+        def collect():
+            """Add matches of the oldest shard, True once limit is met or
+            time is up."""
+            chunk, comps, future = in_flight.popleft()
+            try:
+                if future is None:
+                    positions = _substructure_shard(sub_structure, comps, limit)
+                else:
+                    positions = future.result(timeout=deadline.timeout())
+            except FutureTimeoutError:
+                deadline.truncated = True
+                positions = []
+            except BrokenProcessPool as err:
+                self._mark_broken(err)
+                positions = _substructure_shard(sub_structure, comps, limit)
+            matches.extend(chunk[i] for i in positions)
+            if len(matches) >= limit or deadline.expired():
+                for _, _, pending in in_flight:
+                    if pending is not None:
+                        pending.cancel()
+                return True
+            return False
+
+        def submit(chunk):
+            """Send a chunk of candidates to the pool (or queue it to check in
+            this process if the pool is broken)."""
+            if mol_cache is not None:
+                comps = mol_cache.get_mols(chunk)
+            else:
+                comps = [x["SMILES"] for x in chunk]
+            future = None
+            if not self.broken:
+                try:
+                    future = self._executor.submit(_substructure_shard, sub_structure, comps,
+                                                   limit)
+                except BrokenProcessPool as err:
+                    self._mark_broken(err)
+            in_flight.append((chunk, comps, future))
+
+        for chunk in batches(candidates, _SUBSTRUCTURE_CHUNK_SIZE):
+            if deadline.expired():
+                break
+            submit(chunk)
+            # Bound memory by keeping a few shards per process in flight
+            while in_flight and (len(in_flight) > 2 * self.processes or in_flight[0][2] is None
+                                 or in_flight[0][2].done()):
+                if collect():
+                    return matches[:limit]
+        while in_flight:
+            if collect():
+                break
+        return matches[:limit]
+
+
+def get_search_engine(processes: int, shards: int) -> SearchEngine:
+    """Get the search engine of this process, starting it on first use.
+
+    Parameters
+    ----------
+    processes : int
+        Number of worker processes. If less than 2, no engine is used.
+    shards : int
+        Number of shards each similarity search is split into.
+
+    Returns
+    -------
+    SearchEngine
+        The shared engine, or None if processes is less than 2 or the engine
+        couldn't be started or has failed (searches then run in the request
+        process).
+    """
+    global _engine  # pylint: disable=global-statement
+    if processes < 2:
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                try:
+                    _engine = SearchEngine(processes, shards)
+                except (OSError, NotImplementedError) as err:
+                    logger.warning(f"Unable to start search worker pool ({err!r}), "
+                                   f"searching in the request process instead")
+                    _engine = False
+    if not _engine or _engine.broken:
+        return None
+    return _engine
+
+
+def _search_index(fp_index, query_bits, min_tc, limit, ranked, deadline):
+    """Search a whole index in this process."""
+    if ranked:
+        return fp_index.top_k(query_bits, min_tc, limit, deadline=deadline)
+    return fp_index.search(query_bits, min_tc, limit, deadline=deadline)
+
+
+def _similarity_shard(store_path, mine_name, query_bits, min_tc, limit, start, stop, ranked,
+                      budget_ms):
+    """Search positions start:stop of a MINE's index (in a worker) within
+    budget_ms (the time left of the request's deadline). Returns the hits and
+    whether the budget ran out."""
+    if store_path not in _worker_stores:
+        # The request process already verified the checksum
+        _worker_stores[store_path] = FingerprintStore(store_path, verify=False)
+    key = (store_path, mine_name)
+    if key not in _worker_indexes:
+        _worker_indexes[key] = _worker_stores[store_path].index_for(mine_name)
+    shard = _worker_indexes[key].subset(start, stop)
+    deadline = Deadline(budget_ms)
+    if ranked:
+        hits = shard.top_k(query_bits, min_tc, limit, deadline=deadline)
+    else:
+        hits = shard.search(query_bits, min_tc, limit, deadline=deadline)
+    return hits, deadline.truncated
+
+
+def batches(iterable: Iterable, batch_size: int) -> Generator[List, None, None]:
+    """Yield lists of up to batch_size consecutive items of iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _substructure_shard(sub_structure, comps, limit):
+    """Get positions of the compounds (molecules or SMILES) that contain
+    sub_structure (in a worker)."""
+    if sub_structure not in _worker_mols:
+        if len(_worker_mols) > 100:
+            _worker_mols.clear()
+        if "\n" in sub_structure:
+            _worker_mols[sub_structure] = AllChem.MolFromMolBlock(sub_structure)
+        else:
+            _worker_mols[sub_structure] = AllChem.MolFromSmiles(sub_structure)
+    mol = _worker_mols[sub_structure]
+
+    positions = []
+    for i, comp in enumerate(comps):
+        if isinstance(comp, str):
+            comp = AllChem.MolFromSmiles(comp)
+        if comp and comp.HasSubstructMatch(mol):
+            positions.append(i)
+            if len(positions) >= limit:
+                break
+    return positions
@@ -27,3 +27,21 @@ class InvalidUsage(Exception):
         rv = dict(self.payload or ())
         rv['message'] = self.message
         return rv
+
+
+class StaleStoreError(Exception):
+    """Raised when a precomputed on-disk store can't be used because it was
+    written in an older format or its contents don't match its checksum.
+
+    Attributes
+    ----------
+    path : str
+        Path to the store file.
+    message : str
+        Human readable string describing why the store is stale.
+    """
+
+    def __init__(self, path, message):
+        Exception.__init__(self, f"{path}: {message}")
+        self.path = path
+        self.message = message
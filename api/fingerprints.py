@@ -0,0 +1,807 @@
+"""Fingerprints.py: Packed-bit fingerprint indexes used to speed up
+similarity searches. Fingerprints are held as rows of 64 bit words so that
+Tanimoto scores for a whole popcount window can be computed with a handful of
+vectorized numpy operations instead of one Python set per compound.
+
+Indexes are either built from the core database on first use, or taken from
+a fingerprint store: a read-only file written offline by
+``python -m api.build fp-store`` which every worker maps into memory, so all
+workers share a single copy through the OS page cache."""
+import datetime
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+import pymongo
+
+from api.deadline import Deadline
+from api.exceptions import StaleStoreError
+
+#: Number of bits in the RDKit fingerprints stored in the core database
+FP_SIZE = 512
+
+#: Number of 64 bit words in one packed fingerprint
+FP_WORDS = FP_SIZE // 64
+
+#: Number of bits in the RDKit pattern fingerprints used to screen
+#: substructure searches (written by "python -m api.build pattern-fp")
+PATTERN_FP_SIZE = 2048
+
+#: Length in bits of each fingerprint field of core compounds
+FP_SIZES = {"RDKit_fp": FP_SIZE, "Pattern_fp": PATTERN_FP_SIZE}
+
+#: Version of the fingerprint store file format, bumped on layout changes
+STORE_VERSION = 1
+
+# First bytes of every fingerprint store file
+_STORE_MAGIC = b"MINEFPS\x00"
+
+# Magic, format version and header length
+_STORE_PREAMBLE = struct.Struct("<8sII")
+
+# Alignment of the store header and sections in bytes
+_STORE_ALIGN = 64
+
+# Number of on-bits for every possible byte value (used for popcounts)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Number of candidate rows scored at once, bounds temporary memory use
+_CHUNK_SIZE = 65536
+
+# Number of (query, candidate) pairs scored at once in batch searches
+_MATRIX_CHUNK_SIZE = 1 << 18
+
+# Per-MINE indexes, keyed by (core db name, MINE name, fingerprint field)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+# Per-MINE bit postings, keyed like _indexes
+_postings = {}
+
+# Fingerprint store opened with open_fp_store, shared by all indexes
+_store = None
+
+
+def pack_fps(fp_lists: Iterable[List[int]], fp_size: int = FP_SIZE) -> np.ndarray:
+    """Pack lists of fingerprint on-bits into a matrix of 64 bit words.
+
+    Parameters
+    ----------
+    fp_lists : Iterable[List[int]]
+        On-bit indices for each fingerprint (e.g. the RDKit_fp field).
+    fp_size : int
+        Length of the fingerprints in bits.
+
+    Returns
+    -------
+    packed : np.ndarray
+        uint64 array of shape (n_fingerprints, fp_size // 64). Bit i of a
+        fingerprint is bit i % 64 of word i // 64.
+    """
+    fp_lists = list(fp_lists)
+    bits = np.zeros((len(fp_lists), fp_size), dtype=bool)
+    for row, on_bits in enumerate(fp_lists):
+        bits[row, on_bits] = True
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8").astype(np.uint64, copy=False)
+
+
+def pack_fp(on_bits: Iterable[int], fp_size: int = FP_SIZE) -> np.ndarray:
+    """Pack a single list of on-bits into a vector of 64 bit words."""
+    return pack_fps([list(on_bits)], fp_size)[0]
+
+
+def popcount(packed: np.ndarray) -> np.ndarray:
+    """Count on-bits of packed fingerprints along the last axis."""
+    as_bytes = np.ascontiguousarray(packed).view(np.uint8)
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int32)
+
+
+def tanimoto_bound(n_bits_a: int, n_bits_b: int) -> float:
+    """Upper bound on the Tanimoto coefficient of two fingerprints with
+    n_bits_a and n_bits_b on-bits (the same length ratio that defines the
+    popcount window of a search)."""
+    return min(n_bits_a, n_bits_b) / max(n_bits_a, n_bits_b, 1)
+
+
+def bucket_order(counts: Iterable[int], n_bits: int) -> List[int]:
+    """Sort popcount buckets by decreasing Tanimoto upper bound against a
+    query with n_bits on-bits."""
+    return sorted((int(count) for count in counts),
+                  key=lambda count: (-tanimoto_bound(count, n_bits), count))
+
+
+class FingerprintIndex(object):
+    """Packed fingerprints of the compounds in one MINE, sorted by their
+    number of on-bits so a popcount window is a contiguous slice.
+
+    Parameters
+    ----------
+    ids : np.ndarray
+        Mongo _id of each compound (str, or bytes when read from a store).
+    fps : np.ndarray
+        uint64 matrix of packed fingerprints, one row per compound.
+    counts : np.ndarray
+        Number of on-bits of each fingerprint.
+    rows : np.ndarray, optional
+        Rows of ids, fps and counts that belong to this index. Used to share
+        the arrays of a fingerprint store between MINEs. Defaults to all rows.
+    store_path : str, optional
+        Path of the fingerprint store the arrays were read from, if any.
+
+    Notes
+    -----
+    ids, fps and counts (restricted to rows) must be sorted by counts. Use
+    FingerprintIndex.from_unsorted for arbitrary order.
+    """
+
+    def __init__(self, ids: np.ndarray, fps: np.ndarray, counts: np.ndarray,
+                 rows: np.ndarray = None, store_path: str = None):
+        self.store_path = store_path
+        self._ids = ids
+        self._fps = fps
+        self._counts = counts
+        self.rows = rows
+        if rows is None:
+            self.counts = np.asarray(counts, dtype=np.int32)
+        else:
+            self.counts = np.asarray(counts[rows], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def fp_size(self) -> int:
+        """Length of the indexed fingerprints in bits."""
+        return self._fps.shape[1] * 64
+
+    @classmethod
+    def from_unsorted(cls, ids, fps: np.ndarray) -> "FingerprintIndex":
+        """Build an index from compound ids and packed fingerprints in any
+        order."""
+        counts = popcount(fps)
+        order = np.argsort(counts, kind="stable")
+        return cls(np.asarray(ids, dtype=object)[order], fps[order], counts[order])
+
+    @classmethod
+    def from_mongo(cls, core_db: pymongo.database, mine_name: str,
+                   fp_type: str = "RDKit_fp") -> "FingerprintIndex":
+        """Build an index from the fingerprints of all core compounds in a
+        MINE.
+
+        Parameters
+        ----------
+        core_db : pymongo.database
+            Core database with compound fingerprints.
+        mine_name : str
+            Name of the MINE whose compounds are indexed.
+        fp_type : str
+            Name of the fingerprint field to index.
+
+        Returns
+        -------
+        FingerprintIndex
+            Index over every compound in the MINE with a fingerprint.
+        """
+        fp_size = FP_SIZES[fp_type]
+        ids = []
+        chunks = []
+        fp_lists = []
+        cursor = core_db.compounds.find(
+            {"MINES": mine_name, fp_type: {"$exists": True}}, {fp_type: 1}, batch_size=10000
+        )
+        for doc in cursor:
+            ids.append(doc["_id"])
+            fp_lists.append(doc[fp_type])
+            if len(fp_lists) >= _CHUNK_SIZE:
+                chunks.append(pack_fps(fp_lists, fp_size))
+                fp_lists = []
+        chunks.append(pack_fps(fp_lists, fp_size))
+        return cls.from_unsorted(ids, np.concatenate(chunks))
+
+    def subset(self, start: int, stop: int) -> "FingerprintIndex":
+        """Get an index over positions start:stop of this one, sharing its
+        arrays."""
+        if self.rows is None:
+            return FingerprintIndex(self._ids[start:stop], self._fps[start:stop],
+                                    self.counts[start:stop])
+        return FingerprintIndex(self._ids, self._fps, self._counts, rows=self.rows[start:stop],
+                                store_path=self.store_path)
+
+    def fps(self, start: int, stop: int) -> np.ndarray:
+        """Packed fingerprints of positions start:stop of the index."""
+        if self.rows is None:
+            return self._fps[start:stop]
+        return self._fps[self.rows[start:stop]]
+
+    def cpd_id(self, position: int) -> str:
+        """Mongo _id of the compound at a position of the index."""
+        if self.rows is not None:
+            position = self.rows[position]
+        cpd_id = self._ids[position]
+        if isinstance(cpd_id, bytes):
+            cpd_id = cpd_id.decode()
+        return cpd_id
+
+    def window(self, n_bits: int, min_tc: float) -> Tuple[int, int]:
+        """Get the slice of positions whose on-bit counts could reach min_tc
+        against a query with n_bits on-bits."""
+        lower = np.searchsorted(self.counts, min_tc * n_bits, side="left")
+        if min_tc > 0:
+            upper = np.searchsorted(self.counts, n_bits / min_tc, side="right")
+        else:
+            upper = len(self.counts)
+        return int(lower), int(upper)
+
+    def tanimoto(self, query_fp: np.ndarray, start: int, stop: int) -> np.ndarray:
+        """Tanimoto coefficients of a packed query against positions
+        start:stop."""
+        n_common = popcount(self.fps(start, stop) & query_fp)
+        n_union = self.counts[start:stop] + popcount(query_fp) - n_common
+        return n_common / np.maximum(n_union, 1)
+
+    def search(self, query_bits: Iterable[int], min_tc: float, limit: int,
+               deadline: Deadline = None) -> List[Tuple[str, float]]:
+        """Find compounds with a Tanimoto coefficient of at least min_tc.
+
+        Parameters
+        ----------
+        query_bits : Iterable[int]
+            On-bits of the query fingerprint.
+        min_tc : float
+            Minimum Tanimoto score.
+        limit : int
+            The maximum number of hits to return.
+        deadline : Deadline
+            Time budget, checked before each chunk of candidates. If it runs
+            out, the hits found so far are returned and deadline.truncated is
+            set.
+
+        Returns
+        -------
+        hits : List[Tuple[str, float]]
+            (_id, Tanimoto score) of the first limit hits in index order.
+        """
+        deadline = deadline or Deadline(None)
+        query_fp = pack_fp(query_bits, self.fp_size)
+        start, stop = self.window(int(popcount(query_fp)), min_tc)
+        hits = []
+        for chunk_start in range(start, stop, _CHUNK_SIZE):
+            if deadline.expired():
+                break
+            chunk_stop = min(chunk_start + _CHUNK_SIZE, stop)
+            scores = self.tanimoto(query_fp, chunk_start, chunk_stop)
+            for position in np.flatnonzero(scores >= min_tc):
+                hits.append((self.cpd_id(chunk_start + position), float(scores[position])))
+                if len(hits) >= limit:
+                    return hits
+        return hits
+
+    def top_k(self, query_bits: Iterable[int], min_tc: float, k: int,
+              deadline: Deadline = None) -> List[Tuple[str, float]]:
+        """Find the k compounds most similar to the query.
+
+        Popcount buckets are scored in order of decreasing Tanimoto upper
+        bound (see tanimoto_bound), keeping the best hits in a bounded heap.
+        Scanning stops as soon as no remaining bucket can beat the k-th best
+        score found so far.
+
+        Parameters
+        ----------
+        query_bits : Iterable[int]
+            On-bits of the query fingerprint.
+        min_tc : float
+            Minimum Tanimoto score.
+        k : int
+            The maximum number of hits to return.
+        deadline : Deadline
+            Time budget, checked before each bucket. If it runs out, the best
+            hits of the buckets scored so far are returned and
+            deadline.truncated is set.
+
+        Returns
+        -------
+        hits : List[Tuple[str, float]]
+            (_id, Tanimoto score) of the best hits, sorted by decreasing score.
+        """
+        if k <= 0:
+            return []
+        deadline = deadline or Deadline(None)
+        query_fp = pack_fp(query_bits, self.fp_size)
+        n_bits = int(popcount(query_fp))
+        start, stop = self.window(n_bits, min_tc)
+        # Min-heap of (score, -position) so ties keep the earliest positions
+        heap = []
+        for count in bucket_order(np.unique(self.counts[start:stop]), n_bits):
+            if len(heap) >= k and tanimoto_bound(count, n_bits) <= heap[0][0]:
+                break
+            if deadline.expired():
+                break
+            bucket_start = int(np.searchsorted(self.counts, count, side="left"))
+            bucket_stop = int(np.searchsorted(self.counts, count, side="right"))
+            for chunk_start in range(bucket_start, bucket_stop, _CHUNK_SIZE):
+                chunk_stop = min(chunk_start + _CHUNK_SIZE, bucket_stop)
+                scores = self.tanimoto(query_fp, chunk_start, chunk_stop)
+                threshold = heap[0][0] if len(heap) >= k else min_tc
+                for position in np.flatnonzero(scores >= threshold):
+                    item = (float(scores[position]), -(chunk_start + int(position)))
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+        return [(self.cpd_id(-neg_position), score)
+                for score, neg_position in sorted(heap, reverse=True)]
+
+    def search_many(self, queries: List[Iterable[int]], min_tc: float, limit: int,
+                    deadline: Deadline = None) -> List[List[Tuple[str, float]]]:
+        """Run search for many queries in a single pass over the index.
+
+        Candidates in the union of the query popcount windows are scored
+        against all queries at once as a (query x candidate) matrix, one chunk
+        of candidates at a time. Queries drop out once they have limit hits.
+
+        Parameters
+        ----------
+        queries : List[Iterable[int]]
+            On-bits of each query fingerprint.
+        min_tc : float
+            Minimum Tanimoto score.
+        limit : int
+            The maximum number of hits to return per query.
+        deadline : Deadline
+            Time budget, checked before each chunk of candidates. If it runs
+            out, the hits found so far are returned and deadline.truncated is
+            set.
+
+        Returns
+        -------
+        hits : List[List[Tuple[str, float]]]
+            For each query, (_id, Tanimoto score) of its first limit hits in
+            index order (the same hits search would return).
+        """
+        hits = [[] for _ in queries]
+        if not queries or limit <= 0:
+            return hits
+        deadline = deadline or Deadline(None)
+        query_fps = pack_fps([list(query) for query in queries], self.fp_size)
+        n_bits = popcount(query_fps)
+        windows = np.array([self.window(int(n), min_tc) for n in n_bits])
+        active = np.ones(len(queries), dtype=bool)
+
+        chunk_start = 0
+        stop = int(windows[:, 1].max())
+        while True:
+            pending = active & (windows[:, 1] > chunk_start)
+            if not pending.any() or deadline.expired():
+                break
+            chunk_start = max(chunk_start, int(windows[pending, 0].min()))
+            chunk_stop = min(stop, chunk_start + max(1, _MATRIX_CHUNK_SIZE // int(pending.sum())))
+            in_chunk = np.flatnonzero(pending & (windows[:, 0] < chunk_stop))
+            n_common = popcount(query_fps[in_chunk, None, :] & self.fps(chunk_start, chunk_stop))
+            n_union = n_bits[in_chunk, None] + self.counts[None, chunk_start:chunk_stop] - n_common
+            scores = n_common / np.maximum(n_union, 1)
+            positions = np.arange(chunk_start, chunk_stop)
+            is_hit = ((scores >= min_tc)
+                      & (positions >= windows[in_chunk, 0, None])
+                      & (positions < windows[in_chunk, 1, None]))
+            for row, query in enumerate(in_chunk):
+                for column in np.flatnonzero(is_hit[row]):
+                    hits[query].append((self.cpd_id(chunk_start + column),
+                                        float(scores[row, column])))
+                    if len(hits[query]) >= limit:
+                        active[query] = False
+                        break
+            chunk_start = chunk_stop
+        return hits
+
+
+class BitPostings(object):
+    """Inverted index from each fingerprint bit to the positions (in a
+    FingerprintIndex) of the compounds that have that bit on.
+
+    Like a roaring bitmap, each posting list is stored in whichever form is
+    smaller: a packed bitmap over all positions for common bits, or a sorted
+    array of positions for rare ones. Screening a query intersects the lists
+    of its on-bits, rarest first.
+
+    Parameters
+    ----------
+    fp_index : FingerprintIndex
+        Index whose fingerprints are inverted.
+    """
+
+    def __init__(self, fp_index: FingerprintIndex):
+        self.fp_index = fp_index
+        n_positions = len(fp_index)
+        n_bytes = -(-n_positions // 8)
+        fp_size = fp_index.fp_size
+
+        # Transpose fingerprints into one bitmap per bit, a chunk at a time
+        bitmaps = np.zeros((fp_size, n_bytes), dtype=np.uint8)
+        for start in range(0, n_positions, _CHUNK_SIZE):
+            stop = min(start + _CHUNK_SIZE, n_positions)
+            bits = np.unpackbits(
+                np.ascontiguousarray(fp_index.fps(start, stop)).view(np.uint8),
+                axis=1, bitorder="little",
+            )
+            bitmaps[:, start // 8:-(-stop // 8)] = np.packbits(bits.T, axis=1, bitorder="little")
+
+        self.cardinalities = popcount(bitmaps)
+        # Arrays of uint32 positions are smaller below 1 in 32 compounds
+        self.postings = []
+        for bit in range(fp_size):
+            if self.cardinalities[bit] * 32 < n_positions:
+                positions = np.flatnonzero(np.unpackbits(bitmaps[bit], bitorder="little"))
+                self.postings.append(positions.astype(np.uint32))
+            else:
+                self.postings.append(bitmaps[bit].copy())
+
+    def __len__(self):
+        return len(self.fp_index)
+
+    def screen(self, query_bits: Iterable[int]) -> np.ndarray:
+        """Get positions of the compounds that have every query bit on.
+
+        Parameters
+        ----------
+        query_bits : Iterable[int]
+            On-bits of the query fingerprint.
+
+        Returns
+        -------
+        positions : np.ndarray
+            Sorted positions in fp_index of compounds passing the screen.
+        """
+        query_bits = sorted(set(query_bits), key=lambda bit: self.cardinalities[bit])
+        if not query_bits:
+            return np.arange(len(self))
+
+        rarest = self.postings[query_bits[0]]
+        if rarest.dtype == np.uint32:
+            positions = rarest
+        else:
+            # Every posting list is a bitmap, AND them all together
+            bitmap = rarest.copy()
+            for bit in query_bits[1:]:
+                bitmap &= self.postings[bit]
+            return np.flatnonzero(np.unpackbits(bitmap, bitorder="little")[:len(self)])
+
+        for bit in query_bits[1:]:
+            if not len(positions):
+                break
+            posting = self.postings[bit]
+            if posting.dtype == np.uint32:
+                positions = np.intersect1d(positions, posting, assume_unique=True)
+            else:
+                positions = positions[(posting[positions >> 3] >> (positions & 7).astype(np.uint8))
+                                      & np.uint8(1) > 0]
+        return positions.astype(np.int64)
+
+    def screen_ids(self, query_bits: Iterable[int]) -> Iterator[str]:
+        """Iterate over _ids of the compounds that have every query bit on,
+        in index order."""
+        for position in self.screen(query_bits):
+            yield self.fp_index.cpd_id(position)
+
+
+class FingerprintStore(object):
+    """Read-only, memory-mapped fingerprint store written by write_fp_store.
+
+    Parameters
+    ----------
+    path : str
+        Path to the store file.
+    verify : bool
+        Whether to check the checksum of the store contents on opening.
+
+    Raises
+    ------
+    StaleStoreError
+        If the file isn't a store, was written in another format version or
+        doesn't match its checksum.
+    """
+
+    def __init__(self, path: str, verify: bool = True):
+        self.path = path
+        with open(path, "rb") as infile:
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _STORE_PREAMBLE.size:
+            raise StaleStoreError(path, "file is too short to be a fingerprint store")
+        magic, version, header_len = _STORE_PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != _STORE_MAGIC:
+            raise StaleStoreError(path, "file is not a fingerprint store")
+        if version != STORE_VERSION:
+            raise StaleStoreError(
+                path, f"store format version is {version}, expected {STORE_VERSION}"
+            )
+        header_start = _STORE_PREAMBLE.size
+        self.header = json.loads(bytes(self._mmap[header_start:header_start + header_len]))
+        body_start = self.header["body_offset"]
+        if verify and _sha256(self._mmap, body_start) != self.header["sha256"]:
+            raise StaleStoreError(path, "checksum mismatch, store is corrupt or incomplete")
+
+        self.mines = self.header["mines"]
+        self.fp_type = self.header["fp_type"]
+        arrays = {}
+        for name, (offset, dtype, shape) in self.header["sections"].items():
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(
+                self._mmap, dtype=dtype, count=count, offset=body_start + offset
+            ).reshape(shape)
+        self.counts = arrays["counts"]
+        self.fps = arrays["fps"]
+        self.ids = arrays["ids"]
+        self.membership = arrays["mines"]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def index_for(self, mine_name: str) -> FingerprintIndex:
+        """Get an index over the compounds of one MINE in the store.
+
+        Parameters
+        ----------
+        mine_name : str
+            Name of the MINE.
+
+        Returns
+        -------
+        FingerprintIndex
+            Index sharing the memory-mapped arrays of the store, or None if
+            the store doesn't have this MINE.
+        """
+        if mine_name not in self.mines:
+            return None
+        bit = self.mines.index(mine_name)
+        in_mine = self.membership[:, bit // 8] & np.uint8(1 << (bit % 8))
+        return FingerprintIndex(self.ids, self.fps, self.counts, rows=np.flatnonzero(in_mine),
+                                store_path=self.path)
+
+
+def _align(offset: int) -> int:
+    """Round offset up to the store alignment."""
+    return -(-offset // _STORE_ALIGN) * _STORE_ALIGN
+
+
+def _sha256(buffer, start: int) -> str:
+    """Hex SHA-256 digest of buffer[start:], read in chunks."""
+    digest = hashlib.sha256()
+    view = memoryview(buffer)
+    for chunk_start in range(start, len(buffer), 1 << 24):
+        digest.update(view[chunk_start:chunk_start + (1 << 24)])
+    view.release()
+    return digest.hexdigest()
+
+
+def write_fp_store(core_db: pymongo.database, path: str, fp_type: str = "RDKit_fp") -> int:
+    """Export fingerprints and MINE membership of all core compounds to a
+    fingerprint store file.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with compound fingerprints. Compounds are read sorted
+        by the "len_" + fp_type field, which must be indexed.
+    path : str
+        Path of the store file to write. The file is written next to it and
+        moved into place when complete, so running servers never see a
+        partial store.
+    fp_type : str
+        Name of the fingerprint field to export.
+
+    Returns
+    -------
+    n_compounds : int
+        Number of compounds written to the store.
+    """
+    query = {fp_type: {"$exists": True}}
+    mines = sorted(core_db.compounds.distinct("MINES"))
+    mine_bits = {mine_name: i for i, mine_name in enumerate(mines)}
+    n_compounds = core_db.compounds.count_documents(query)
+    id_width = max(
+        [x["width"] for x in core_db.compounds.aggregate([
+            {"$match": query},
+            {"$group": {"_id": None, "width": {"$max": {"$strLenBytes": "$_id"}}}},
+        ])] + [1]
+    )
+
+    sections = {}
+    body_len = 0
+    for name, dtype, shape in [
+        ("counts", "<i4", [n_compounds]),
+        ("fps", "<u8", [n_compounds, FP_SIZES[fp_type] // 64]),
+        ("ids", f"S{id_width}", [n_compounds]),
+        ("mines", "u1", [n_compounds, max(1, -(-len(mines) // 8))]),
+    ]:
+        sections[name] = [body_len, dtype, shape]
+        body_len = _align(body_len + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+    header = {
+        "fp_type": fp_type,
+        "fp_size": FP_SIZES[fp_type],
+        "n_compounds": n_compounds,
+        "n_source_compounds": core_db.compounds.estimated_document_count(),
+        "source": core_db.name,
+        "built_at": datetime.datetime.utcnow().isoformat(),
+        "mines": mines,
+        "sections": sections,
+        "body_offset": 0,
+        "sha256": "0" * 64,
+    }
+    # Body offset and checksum don't change the header length (fixed width)
+    header["body_offset"] = _align(_STORE_PREAMBLE.size + len(json.dumps(header)) + 16)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.truncate(header["body_offset"] + body_len)
+        with open(tmp_path, "r+b") as outfile:
+            buffer = mmap.mmap(outfile.fileno(), 0)
+            arrays = {}
+            for name, (offset, dtype, shape) in sections.items():
+                arrays[name] = np.frombuffer(
+                    buffer, dtype=dtype, count=int(np.prod(shape)),
+                    offset=header["body_offset"] + offset,
+                ).reshape(shape)
+
+            cursor = core_db.compounds.find(query, {fp_type: 1, "MINES": 1}, batch_size=10000)
+            cursor = cursor.sort("len_" + fp_type, pymongo.ASCENDING)
+            row = 0
+            docs = []
+            for doc in cursor:
+                docs.append(doc)
+                if len(docs) >= _CHUNK_SIZE:
+                    row = _write_store_rows(arrays, row, docs, fp_type, mine_bits)
+                    docs = []
+            row = _write_store_rows(arrays, row, docs, fp_type, mine_bits)
+            if row != n_compounds:
+                raise ValueError(f"Expected {n_compounds} compounds but read {row}, "
+                                 "core database changed while writing the store")
+            if np.any(np.diff(arrays["counts"]) < 0):
+                raise ValueError(f"len_{fp_type} doesn't match {fp_type} for some compounds")
+
+            del arrays
+            header["sha256"] = _sha256(buffer, header["body_offset"])
+            header_bytes = json.dumps(header).encode()
+            buffer[:_STORE_PREAMBLE.size] = _STORE_PREAMBLE.pack(
+                _STORE_MAGIC, STORE_VERSION, len(header_bytes)
+            )
+            buffer[_STORE_PREAMBLE.size:_STORE_PREAMBLE.size + len(header_bytes)] = header_bytes
+            buffer.flush()
+            buffer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Left behind if still mapped (Windows), rather than hide the error
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return n_compounds
+
+
+def _write_store_rows(arrays, row, docs, fp_type, mine_bits):
+    """Write a chunk of compound documents to the store arrays, starting at
+    row. Returns the row after the chunk."""
+    stop = row + len(docs)
+    fps = pack_fps([doc[fp_type] for doc in docs], FP_SIZES[fp_type])
+    arrays["fps"][row:stop] = fps
+    arrays["counts"][row:stop] = popcount(fps)
+    arrays["ids"][row:stop] = [doc["_id"].encode() for doc in docs]
+    for i, doc in enumerate(docs):
+        for mine_name in doc.get("MINES", []):
+            bit = mine_bits.get(mine_name)
+            if bit is None:
+                raise ValueError(f"Compound {doc['_id']} is in MINE {mine_name}, which wasn't in "
+                                 "the core database when the store was started. The core "
+                                 "database changed while writing the store, re-run the build")
+            arrays["mines"][row + i, bit // 8] |= np.uint8(1 << (bit % 8))
+    return stop
+
+
+def open_fp_store(path: str, verify: bool = True,
+                  core_db: pymongo.database = None) -> FingerprintStore:
+    """Open a fingerprint store and use it for all fingerprint indexes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the store file.
+    verify : bool
+        Whether to check the checksum of the store contents.
+    core_db : pymongo.database
+        Core database the store was built from. If given, the store is
+        refused if the number of compounds changed since it was built.
+
+    Returns
+    -------
+    FingerprintStore
+        The opened store.
+
+    Raises
+    ------
+    StaleStoreError
+        If the store can't be used (see FingerprintStore) or is out of date
+        with core_db. Indexes are then built from Mongo as without a store.
+    """
+    global _store  # pylint: disable=global-statement
+    store = FingerprintStore(path, verify=verify)
+    if (core_db is not None and store.header["n_source_compounds"]
+            != core_db.compounds.estimated_document_count()):
+        raise StaleStoreError(path, f"built {store.header['built_at']} from a core database "
+                                    f"with another number of compounds, rebuild it with "
+                                    f"'python -m api.build fp-store'")
+    with _indexes_lock:
+        _store = store
+        _indexes.clear()
+        _postings.clear()
+    return store
+
+
+def get_fp_index(core_db: pymongo.database, mine_name: str,
+                 fp_type: str = "RDKit_fp") -> FingerprintIndex:
+    """Get the fingerprint index for a MINE, taking it from the fingerprint
+    store if one is open, otherwise building it from core_db on first use.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with compound fingerprints.
+    mine_name : str
+        Name of the MINE to get the index for.
+    fp_type : str
+        Name of the fingerprint field to index.
+
+    Returns
+    -------
+    FingerprintIndex
+        Cached index for this MINE.
+    """
+    key = (core_db.name, mine_name, fp_type)
+    if key not in _indexes:
+        with _indexes_lock:
+            if key not in _indexes:
+                index = None
+                if _store is not None and _store.fp_type == fp_type:
+                    index = _store.index_for(mine_name)
+                if index is None:
+                    index = FingerprintIndex.from_mongo(core_db, mine_name, fp_type)
+                _indexes[key] = index
+    return _indexes[key]
+
+
+def get_bit_postings(core_db: pymongo.database, mine_name: str,
+                     fp_type: str = "RDKit_fp") -> BitPostings:
+    """Get the bit postings for a MINE, building them (and the fingerprint
+    index they invert) on first use.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with compound fingerprints.
+    mine_name : str
+        Name of the MINE to get the postings for.
+    fp_type : str
+        Name of the fingerprint field to invert.
+
+    Returns
+    -------
+    BitPostings
+        Cached postings for this MINE.
+    """
+    key = (core_db.name, mine_name, fp_type)
+    if key not in _postings:
+        fp_index = get_fp_index(core_db, mine_name, fp_type)
+        with _indexes_lock:
+            if key not in _postings:
+                _postings[key] = BitPostings(fp_index)
+    return _postings[key]
@@ -0,0 +1,228 @@
+"""Molecules.py: Caches of parsed RDKit molecules, so hot loops like
+substructure matching and back-to-back searches for the same query don't
+parse and sanitize structures again on every request.
+
+Candidate molecules: serialized molecules (Mol.ToBinary()) are stored in the
+"mol_binaries" collection of the core database, keyed by compound _id, and
+written by ``python -m api.build mol-cache``. Deserialized molecules are kept
+in an in-process LRU cache.
+
+Query structures: parse_structure keeps parsed query molecules and the
+values searches derive from them (canonical SMILES, fingerprints, InChIKey)
+in an in-process LRU cache keyed by a hash of the normalized input."""
+import hashlib
+import threading
+from typing import Dict, List
+
+import pymongo
+from rdkit.Chem import AllChem
+
+from api.cache import LRUCache
+from api.fingerprints import PATTERN_FP_SIZE
+
+#: Name of the core database collection with serialized molecules
+MOL_COLLECTION = "mol_binaries"
+
+#: Default maximum number of parsed query structures kept in memory
+STRUCTURE_CACHE_SIZE = 1000
+
+# Cache shared by all requests of this process, see get_mol_cache
+_mol_cache = None
+_mol_cache_lock = threading.Lock()
+
+# Parsed query structures, see parse_structure
+_structure_cache = LRUCache(STRUCTURE_CACHE_SIZE)
+
+
+class MolCache(object):
+    """LRU cache of RDKit molecules backed by stored binary molecules, with a
+    fallback to parsing SMILES for compounds that have none.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with the mol_binaries collection.
+    max_size : int
+        Maximum number of molecules kept in memory.
+    """
+
+    def __init__(self, core_db: pymongo.database, max_size: int):
+        self.collection = core_db[MOL_COLLECTION]
+        self.lru = LRUCache(max_size)
+        self.smiles_fallbacks = 0
+
+    def get_mols(self, compounds: List[Dict]) -> List[AllChem.Mol]:
+        """Get molecules for a batch of compounds.
+
+        Parameters
+        ----------
+        compounds : List[Dict]
+            Compound documents with _id and SMILES fields.
+
+        Returns
+        -------
+        mols : List[AllChem.Mol]
+            Molecule of each compound, in the same order. None for compounds
+            whose SMILES can't be parsed.
+        """
+        mols = [self.lru.get(cpd["_id"]) for cpd in compounds]
+        missing = [cpd["_id"] for cpd, mol in zip(compounds, mols) if mol is None]
+        if not missing:
+            return mols
+
+        stored = {}
+        for x in self.collection.find({"_id": {"$in": missing}}):
+            stored[x["_id"]] = AllChem.Mol(bytes(x["Mol"]))
+        for i, cpd in enumerate(compounds):
+            if mols[i] is not None:
+                continue
+            mol = stored.get(cpd["_id"])
+            if mol is None and cpd.get("SMILES"):
+                self.smiles_fallbacks += 1
+                mol = AllChem.MolFromSmiles(cpd["SMILES"])
+            if mol is not None:
+                self.lru.put(cpd["_id"], mol)
+            mols[i] = mol
+        return mols
+
+    def stats(self) -> Dict[str, int]:
+        """Get LRU statistics and the number of SMILES fallbacks."""
+        return dict(self.lru.stats(), smiles_fallbacks=self.smiles_fallbacks)
+
+
+def get_mol_cache(core_db: pymongo.database, max_size: int) -> MolCache:
+    """Get the molecule cache of this process, creating it on first use.
+
+    Parameters
+    ----------
+    core_db : pymongo.database
+        Core database with the mol_binaries collection.
+    max_size : int
+        Maximum number of molecules kept in memory.
+
+    Returns
+    -------
+    MolCache
+        The shared cache.
+    """
+    global _mol_cache  # pylint: disable=global-statement
+    if _mol_cache is None:
+        with _mol_cache_lock:
+            if _mol_cache is None:
+                _mol_cache = MolCache(core_db, max_size)
+    return _mol_cache
+
+
+class ParsedStructure(object):
+    """A parsed query structure. Values derived from the molecule are
+    computed on first use and kept, so they are shared by every search for
+    the same structure.
+
+    Parameters
+    ----------
+    mol : AllChem.Mol
+        Query molecule. Must not be modified.
+    """
+
+    def __init__(self, mol: AllChem.Mol):
+        self.mol = mol
+        self._smiles = None
+        self._inchi_key = None
+        self._fp_bits = {}
+
+    @property
+    def smiles(self) -> str:
+        """Canonical SMILES of the molecule."""
+        if self._smiles is None:
+            self._smiles = AllChem.MolToSmiles(self.mol)
+        return self._smiles
+
+    @property
+    def inchi_key(self) -> str:
+        """InChIKey of the molecule."""
+        if self._inchi_key is None:
+            self._inchi_key = AllChem.InchiToInchiKey(AllChem.MolToInchi(self.mol))
+        return self._inchi_key
+
+    def fp_bits(self, fp_type: str = "RDKit_fp") -> List[int]:
+        """Get the on-bits of a fingerprint of the molecule (see
+        screen_fp_bits). The list is shared and must not be modified."""
+        if fp_type not in self._fp_bits:
+            self._fp_bits[fp_type] = screen_fp_bits(self.mol, fp_type)
+        return self._fp_bits[fp_type]
+
+
+def parse_structure(comp_structure: str) -> ParsedStructure:
+    """Parse a query structure, reusing the result of an earlier parse of the
+    same structure if it is still cached.
+
+    Molfiles are normalized before lookup by dropping their header block
+    (name, program/timestamp and comment lines, which differ between exports
+    of the same drawing) and trailing whitespace.
+
+    Parameters
+    ----------
+    comp_structure : str
+        A molecule in molfile or SMILES format.
+
+    Returns
+    -------
+    ParsedStructure
+        The parsed structure.
+    """
+    comp_structure = str(comp_structure)
+    if "\n" in comp_structure:
+        lines = comp_structure.replace("\r\n", "\n").split("\n")
+        normalized = "\n".join(line.rstrip() for line in lines[3:]).rstrip()
+    else:
+        normalized = comp_structure
+    key = hashlib.sha1(normalized.encode()).hexdigest()
+
+    parsed = _structure_cache.get(key)
+    if parsed is None:
+        # Create Mol object from Molfile (has newlines)
+        if "\n" in comp_structure:
+            mol = AllChem.MolFromMolBlock(comp_structure)
+        # Create Mol object from SMILES string (does not have newlines)
+        else:
+            mol = AllChem.MolFromSmiles(comp_structure)
+        if not mol:
+            raise ValueError("Unable to parse comp_structure")
+        parsed = ParsedStructure(mol)
+        _structure_cache.put(key, parsed)
+    return parsed
+
+
+def set_structure_cache_size(max_size: int) -> None:
+    """Replace the query structure cache with an empty one of max_size (0
+    disables it)."""
+    global _structure_cache  # pylint: disable=global-statement
+    _structure_cache = LRUCache(max_size)
+
+
+def structure_cache_stats() -> Dict[str, int]:
+    """Get LRU statistics of the query structure cache."""
+    return _structure_cache.stats()
+
+
+def screen_fp_bits(mol: AllChem.Mol, fp_type: str = "Pattern_fp") -> List[int]:
+    """Get the on-bits of a molecule's substructure screening fingerprint.
+
+    Parameters
+    ----------
+    mol : AllChem.Mol
+        Query molecule.
+    fp_type : str
+        Fingerprint field compounds are screened on, "Pattern_fp" or
+        "RDKit_fp".
+
+    Returns
+    -------
+    List[int]
+        Indices of on-bits, comparable to the fp_type field of compounds.
+    """
+    if fp_type == "Pattern_fp":
+        return list(AllChem.PatternFingerprint(mol, fpSize=PATTERN_FP_SIZE).GetOnBits())
+    elif fp_type == "RDKit_fp":
+        return list(AllChem.RDKFingerprint(mol, fpSize=512).GetOnBits())
+    raise ValueError(f"Unknown screening fingerprint: {fp_type}")
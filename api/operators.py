@@ -0,0 +1,131 @@
+"""Operators.py: In-memory catalog of each MINE's reaction operators, so
+operator endpoints are served without querying Mongo.
+
+Operator sets are small and don't change once a MINE is built. A catalog is
+loaded on first use and reloaded when the MINE's version marker (its latest
+meta_data entry and number of operators) changes, which is checked at most
+once per check interval."""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import pymongo
+
+#: Name of the MINE collection with chunks of each operator's reaction
+#: _ids, written by "python -m api.build op-rxns"
+OP_RXN_COLLECTION = "operator_reactions"
+
+#: Number of reaction _ids per chunk document
+OP_RXN_CHUNK_SIZE = 1000
+
+# Catalogs of the MINEs served by this process, keyed by database name
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def mine_version(db: pymongo.database) -> Tuple:
+    """Get the version marker of a MINE: the _id of its latest meta_data
+    entry and its number of operators."""
+    latest = db.meta_data.find_one({}, {"_id": 1}, sort=[("_id", pymongo.DESCENDING)])
+    return (latest["_id"] if latest else None, db.operators.estimated_document_count())
+
+
+class OperatorCatalog(object):
+    """Operators of a MINE indexed by _id and Name.
+
+    Parameters
+    ----------
+    operators : List[Dict]
+        Operator documents, in collection order.
+    version : Tuple
+        Version marker of the MINE the operators were loaded from.
+    """
+
+    def __init__(self, operators: List[Dict], version: Tuple):
+        self.operators = operators
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.by_id = {op["_id"]: op for op in operators}
+        self.by_name = {}
+        for op in operators:
+            if "Name" in op:
+                self.by_name.setdefault(op["Name"], op)
+
+    @classmethod
+    def from_mongo(cls, db: pymongo.database) -> "OperatorCatalog":
+        """Load all operators of a MINE."""
+        version = mine_version(db)
+        return cls(list(db.operators.find()), version)
+
+    def __len__(self):
+        return len(self.operators)
+
+    def get(self, op_id: str) -> Optional[Dict]:
+        """Get an operator by _id or Name (e.g. "rule0001"), None if there
+        is none. The document is shared and must not be modified."""
+        op = self.by_id.get(op_id)
+        if op is None:
+            op = self.by_name.get(op_id)
+        return op
+
+
+def get_op_catalog(db: pymongo.database, check_interval: float) -> OperatorCatalog:
+    """Get the operator catalog of a MINE, loading it on first use and
+    reloading it if the MINE's version marker changed.
+
+    Parameters
+    ----------
+    db : pymongo.database
+        MINE database.
+    check_interval : float
+        Minimum time in seconds between checks of the version marker.
+
+    Returns
+    -------
+    OperatorCatalog
+        Catalog of the MINE's operators.
+    """
+    catalog = _catalogs.get(db.name)
+    if catalog is not None and time.monotonic() - catalog.checked_at < check_interval:
+        return catalog
+    with _catalogs_lock:
+        catalog = _catalogs.get(db.name)
+        if catalog is not None and time.monotonic() - catalog.checked_at < check_interval:
+            return catalog
+        if catalog is not None and mine_version(db) == catalog.version:
+            catalog.checked_at = time.monotonic()
+        else:
+            catalog = OperatorCatalog.from_mongo(db)
+            _catalogs[db.name] = catalog
+    return catalog
+
+
+def get_op_rxn_ids(db: pymongo.database, operator_id: str, offset: int,
+                   n_ids: int) -> List[str]:
+    """Get reaction _ids of an operator from the materialized index.
+
+    Parameters
+    ----------
+    db : pymongo.database
+        MINE database with the operator_reactions collection.
+    operator_id : str
+        Mongo _id of the operator.
+    offset : int
+        Position of the first reaction _id to get.
+    n_ids : int
+        Maximum number of reaction _ids to get.
+
+    Returns
+    -------
+    List[str]
+        Reaction _ids, in reaction collection order.
+    """
+    first_chunk = offset // OP_RXN_CHUNK_SIZE
+    last_chunk = (offset + n_ids - 1) // OP_RXN_CHUNK_SIZE
+    rxn_ids = []
+    for chunk in db[OP_RXN_COLLECTION].find(
+        {"operator": operator_id, "chunk": {"$gte": first_chunk, "$lte": last_chunk}}
+    ).sort("chunk", pymongo.ASCENDING):
+        rxn_ids.extend(chunk["Reaction_ids"])
+    start = offset - first_chunk * OP_RXN_CHUNK_SIZE
+    return rxn_ids[start:start + n_ids]
@@ -1,14 +1,70 @@
 """Queries.py: Contains functions which power the API queries"""
+import base64
+import heapq
+import itertools
+import json
 import re
+import time
 from ast import literal_eval
-from typing import Dict, List
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
 
 import pymongo
+from pymongo.errors import ExecutionTimeout
 from rdkit.Chem import AllChem
 
 from minedatabase.databases import MINE
 from minedatabase.metabolomics import score_compounds
 
+from api.deadline import Deadline
+from api.engine import SearchEngine, batches
+from api.molecules import MolCache, parse_structure
+from api.operators import OperatorCatalog, get_op_rxn_ids
+from api.query_compiler import QueryError, compile_query, plan_summary
+from api.fingerprints import BitPostings, FingerprintIndex, bucket_order, tanimoto_bound
+
+#: Field with the first block (connectivity hash) of a document's InChIKey,
+#: written by "python -m api.build inchikey-block1"
+INCHIKEY_BLOCK1 = "inchikey_block1"
+
+#: Name of the compound references collection mapping cross-reference ids
+#: and lower case names to InChIKey first blocks, written by
+#: "python -m api.build xref-ids"
+XREF_ID_COLLECTION = "xref_ids"
+
+#: Maximum number of compounds advanced_search returns
+ADVANCED_SEARCH_LIMIT = 1000
+
+#: Time (in s) after which whether a collection has an INCHIKEY_BLOCK1 index
+#: is checked again, so indexes built (or dropped) while the server runs are
+#: noticed
+BLOCK1_INDEX_CHECK_INTERVAL = 300
+
+# (Whether it has an index on INCHIKEY_BLOCK1, time checked) of each
+# (database, collection)
+_block1_indexed = {}
+
+
+def _side_smiles_expr(side: int) -> Dict:
+    """Get a Mongo expression for the SMILES of the participants on one side
+    (0 for reactants, 1 for products) of a reaction's SMILES_rxn, which looks
+    like "(1) CCO + (1) O=O => (1) CC=O + (2) O"."""
+    half = {"$arrayElemAt": [{"$split": ["$SMILES_rxn", "=>"]}, side]}
+    return {"$map": {
+        # Participants are separated by spaced pluses (charges aren't)
+        "input": {"$split": [half, " + "]},
+        # Drop the stoichiometry in front of each SMILES
+        "in": {"$arrayElemAt": [{"$split": [{"$trim": {"input": "$$this"}}, " "]}, -1]},
+    }}
+
+
+#: Reaction fields with the SMILES of each participant (in Reactants and
+#: Products order) and expressions computing them from SMILES_rxn. Stored by
+#: "python -m api.build rxn-smiles", computed on the fly for older MINEs.
+RXN_SMILES_FIELDS = {
+    "Reactant_SMILES": _side_smiles_expr(0),
+    "Product_SMILES": _side_smiles_expr(1),
+}
+
 DEFAULT_PROJECTION = {
     "SMILES": 1,
     "InChI_key": 1,
@@ -25,7 +81,11 @@ DEFAULT_PROJECTION = {
 
 
 def quick_search(
-    db: MINE, core_db: MINE, query: str, search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy()
+    db: MINE,
+    core_db: MINE,
+    query: str,
+    search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    ref_db: pymongo.database = None,
 ) -> List:
     """This function takes user provided compound identifiers and attempts to
      find a related database ID.
@@ -37,38 +97,54 @@ def quick_search(
     core_db : MINE
         Core Database.
     query : str
-        A MINE id, KEGG code, ModelSEED id, Inchikey or Name.
+        A MINE id, KEGG code, ModelSEED id, PubChem id, Inchikey or Name.
     search_projection : Dict[str, int]
         The fields which should be returned in the results.
+    ref_db : pymongo.database
+        Compound references database. If given, queries that aren't MINE
+        _ids, KEGG codes or InChIKeys are also looked up as cross-reference
+        ids and names (see api.build xref-ids).
 
     Returns
     -------
     results : List
         List of query results (documents in MINE database).
     """
-
+    query = query.strip()
     # Determine what kind of query was input (e.g. KEGG code, MINE id, etc.)
-    # If it can't be determined to be an id or a key, assume it is the name
-    # of a compound.
+    # If it can't be determined to be an id or a key, it can still be a
+    # cross-reference id (e.g. ModelSEED or PubChem) or a compound name.
+    conditions = []
+    xref_lookup = True
     if re.match(r"C\w{40}", query):
-        query_field = "_id"
+        conditions.append({"_id": query})
+        xref_lookup = False
     elif re.match(r"C\d{5}", query):
-        query_field = "KEGG_id"
+        conditions.append({"KEGG_id": query})
+        xref_lookup = False
     elif re.search(r"[A-Z]{14}-[A-Z]{10}-[A-Z]", query):
-        query_field = "Inchikey"
-        query = query.split("=", 1)[-1]
+        conditions.append({"Inchikey": query.split("=", 1)[-1]})
+        xref_lookup = False
     elif query.isdigit():
-        query_field = "MINE_id"
-        query = int(query)
-    else:
-        query_field = None
-
-    if query_field:
+        conditions.append({"MINE_id": int(query)})
+
+    if xref_lookup and ref_db is not None and query:
+        # The references database is separate from the core database and
+        # $lookup can't join across databases, so this is its own round trip.
+        # Covered by the (source_id, inchikey_block1) index
+        blocks = {x[INCHIKEY_BLOCK1] for x in ref_db[XREF_ID_COLLECTION].find(
+            {"source_id": {"$in": list({query, query.lower()})}},
+            {INCHIKEY_BLOCK1: 1, "_id": 0},
+        ).limit(500)}
+        if blocks:
+            conditions.append(inchikey_block1_in_filter(core_db.compounds, blocks, "Inchikey"))
+
+    if conditions:
         results = [
             x
-            for x in core_db.compounds.find({"$and": [{query_field: query}, {"MINES": db.name}]}, search_projection).limit(
-                500
-            )
+            for x in core_db.compounds.find(
+                {"$and": [{"$or": conditions}, {"MINES": db.name}]}, search_projection
+            ).limit(500)
             if x["_id"][0] == "C"
         ]
     else:
@@ -81,6 +157,7 @@ def advanced_search(
     db: MINE,
     mongo_query: str,
     search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    deadline: Deadline = None,
 ) -> List:
     """Returns compounds in the indicated database which match the provided
     mongo query
@@ -90,21 +167,212 @@ def advanced_search(
     db : MINE
         Database to search.
     mongo_query : str
-        A query string with Mongo syntax.
+        A query string with Mongo syntax, using the fields and operators
+        whitelisted in api.query_compiler.
     search_projection : Dict[str, int]
         The fields which should be returned in the results.
+    deadline : Deadline
+        Time budget of the query. If it runs out, the compounds found so far
+        are returned and deadline.truncated is set.
 
     Returns
     -------
     List
-        List of query results (documents in MINE database).
+        List of query results (documents in MINE database), at most
+        ADVANCED_SEARCH_LIMIT.
+    """
+    return advanced_search_page(db, mongo_query, ADVANCED_SEARCH_LIMIT,
+                                search_projection=search_projection, deadline=deadline)[0]
+
+
+def advanced_search_page(
+    db: MINE,
+    mongo_query: str,
+    page_size: int,
+    token: str = None,
+    search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    deadline: Deadline = None,
+    reject_collscan: bool = False,
+) -> Tuple[List, Optional[str]]:
+    """Get a page of the compounds matching a Mongo query, in _id order
+    (tokens resume after the last _id, so pages don't repeat or skip
+    compounds and deep pages cost no more than the first).
+
+    Parameters
+    ----------
+    db : MINE
+        Database to search.
+    mongo_query : str
+        A query string with Mongo syntax, using the fields and operators
+        whitelisted in api.query_compiler.
+    page_size : int
+        Maximum number of compounds to return.
+    token : str
+        Continuation token of the page, from the previous page. None for the
+        first page.
+    search_projection : Dict[str, int]
+        The fields which should be returned in the results.
+    deadline : Deadline
+        Time budget of the query. If it runs out, the compounds found so far
+        are returned and deadline.truncated is set.
+    reject_collscan : bool
+        Whether to refuse queries that no index can serve, before they run.
+
+    Returns
+    -------
+    compounds : List
+        The page of compounds.
+    next_token : Optional[str]
+        Token of the next page, None if this was the last one. Pages cut
+        short by the deadline continue after their last compound.
+
+    Raises
+    ------
+    ValueError
+        If the query or token is invalid, or the query would scan the whole
+        collection and reject_collscan is set.
+    """
+    deadline = deadline or Deadline(None)
+    cursor, hide_id = _advanced_search_cursor(db, mongo_query, token, search_projection,
+                                              deadline, reject_collscan)
+    compounds = list(_until(cursor.limit(page_size + 1), deadline))
+    next_token = None
+    if len(compounds) > page_size or (deadline.truncated and compounds):
+        compounds = compounds[:page_size]
+        next_token = _encode_id_token(compounds[-1]["_id"])
+    if hide_id:
+        for x in compounds:
+            del x["_id"]
+    return compounds, next_token
+
+
+class ResultStream(object):
+    """Iterator over streamed results that remembers where it stopped.
+
+    Parameters
+    ----------
+    results : Iterable[Dict]
+        Results to stream.
+    deadline : Deadline
+        Time budget of the stream.
+
+    Attributes
+    ----------
+    next_token : str
+        If the stream stopped early because deadline ran out, the
+        continuation token of the first result it didn't give, to resume
+        from. None otherwise.
+    """
+
+    def __init__(self, results: Iterable[Dict], deadline: Deadline):
+        self.deadline = deadline
+        self.next_token = None
+        self._results = iter(results)
+
+    def __iter__(self) -> "ResultStream":
+        return self
+
+    def __next__(self) -> Dict:
+        return next(self._results)
+
+    @property
+    def truncated(self) -> bool:
+        """Whether the stream stopped early because its deadline ran out."""
+        return self.deadline.truncated
+
+
+def advanced_search_stream(
+    db: MINE,
+    mongo_query: str,
+    token: str = None,
+    search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    deadline: Deadline = None,
+    reject_collscan: bool = False,
+    batch_size: int = 1000,
+) -> ResultStream:
+    """Get all compounds matching a Mongo query (after the token's _id), in
+    _id order, as an iterator that reads them from Mongo batch_size at a time, so they
+    can be written out as they arrive. The query and token are checked
+    before this returns, see advanced_search_page for parameters.
+
+    Returns
+    -------
+    ResultStream
+        Compounds matching the query. Stops early (setting
+        deadline.truncated and next_token) if deadline runs out.
     """
+    deadline = deadline or Deadline(None)
+    cursor, hide_id = _advanced_search_cursor(db, mongo_query, token, search_projection,
+                                              deadline, reject_collscan)
+
+    def results():
+        last_id = None
+        for x in _until(cursor.batch_size(batch_size), deadline):
+            last_id = x.pop("_id") if hide_id else x["_id"]
+            yield x
+        if deadline.truncated:
+            stream.next_token = _encode_id_token(last_id) if last_id is not None else token
+
+    stream = ResultStream(results(), deadline)
+    return stream
+
+
+def _advanced_search_cursor(
+    db: MINE,
+    mongo_query: str,
+    token: Optional[str],
+    search_projection: Dict[str, int],
+    deadline: Deadline,
+    reject_collscan: bool,
+) -> Tuple[pymongo.cursor.Cursor, bool]:
+    """Check a query for advanced search and get a cursor over its compounds
+    in _id order, after the _id of the token. Compounds always have their
+    _id, which tokens are made from, so the bool tells whether the caller
+    must remove it because search_projection leaves it out."""
     # We don't want users poking around here
     if db.name == "admin" or not mongo_query:
         raise ValueError("Illegal query")
-    # This transforms the string into a dictionary
-    query_dict = literal_eval(mongo_query)
-    return [x for x in db.compounds.find(query_dict, search_projection)]
+    query_dict = compile_query(mongo_query)
+    last_id = _decode_id_token(token) if token else None
+    if reject_collscan and explain_advanced_search(db, query_dict)["collscan"]:
+        raise QueryError("Query can't use an index, filter on an indexed field "
+                         "(use explain to check)")
+    if last_id is not None:
+        query_dict = {"$and": [query_dict, {"_id": {"$gt": last_id}}]}
+    hide_id = not search_projection.get("_id", 1)
+    if hide_id:
+        search_projection = dict(search_projection, _id=1)
+
+    cursor = db.compounds.find(query_dict, search_projection).sort("_id", pymongo.ASCENDING)
+    return cursor.max_time_ms(deadline.max_time_ms()), hide_id
+
+
+def explain_advanced_search(db: MINE, mongo_query: Union[str, Dict]) -> Dict:
+    """Get the plan Mongo would run a query for advanced_search with,
+    without running it.
+
+    Parameters
+    ----------
+    db : MINE
+        Database to search.
+    mongo_query : Union[str, Dict]
+        A query string with Mongo syntax, or a query from compile_query.
+
+    Returns
+    -------
+    Dict
+        "plan": the winning plan, "stages": its stages, "indexes": names of
+        the indexes it uses and "collscan": whether it scans the whole
+        compounds collection.
+    """
+    if db.name == "admin" or not mongo_query:
+        raise ValueError("Illegal query")
+    if isinstance(mongo_query, str):
+        mongo_query = compile_query(mongo_query)
+    explain = db.compounds.database.command(
+        "explain", {"find": db.compounds.name, "filter": mongo_query}, verbosity="queryPlanner"
+    )
+    return plan_summary(explain)
 
 
 def similarity_search(
@@ -116,6 +384,10 @@ def similarity_search(
     parent_filter: str = None,
     model_db: pymongo.database = None,
     search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    fp_index: FingerprintIndex = None,
+    ranked: bool = False,
+    engine: SearchEngine = None,
+    deadline: Deadline = None,
 ) -> List:
     """Returns compounds in the indicated database which have structural
      similarity to the provided compound.
@@ -136,6 +408,18 @@ def similarity_search(
         MongoDB with KEGG organism codes and associated compounds.
     search_projection : Dict[str, int]
         The fields which should be returned in the results.
+    fp_index : FingerprintIndex
+        Packed fingerprints of the compounds in db. If given, Tanimoto scores
+        are computed in memory and only the hits are fetched from core_db.
+    ranked : bool
+        If True, return the limit most similar compounds sorted by decreasing
+        Tanimoto score (given in the "Tanimoto" field of each result).
+        Otherwise return the first limit compounds found above min_tc.
+    engine : SearchEngine
+        Process pool to shard the search of fp_index across.
+    deadline : Deadline
+        Time budget of the search. If it runs out, the compounds found so far
+        are returned and deadline.truncated is set.
 
     Returns
     -------
@@ -144,58 +428,232 @@ def similarity_search(
     """
     similarity_search_results = []
     fp_type = "RDKit_fp"
-    # Create Mol object from Molfile (has newlines)
-    if "\n" in comp_structure:
-        mol = AllChem.MolFromMolBlock(str(comp_structure))
-    # Create Mol object from SMILES string (does not have newlines)
-    else:
-        mol = AllChem.MolFromSmiles(str(comp_structure))
-    if not mol:
-        raise ValueError("Unable to parse comp_structure")
+    deadline = deadline or Deadline(None)
+    # Parse the structure (or reuse an earlier parse of it)
+    parsed = parse_structure(comp_structure)
 
     # Based on fingerprint type specified by user, get the finger print as an
     # explicit bit vector (series of 1s and 0s). Then, return a set of all
     # indices where a bit is 1 in the bit vector.
-    query_fp = set(AllChem.RDKFingerprint(mol, fpSize=512).GetOnBits())
+    query_fp = set(parsed.fp_bits(fp_type))
+
+    len_fp = len(query_fp)
+    search_projection = dict(search_projection, **{fp_type: 1})
+
+    if fp_index is not None:
+        if engine is not None:
+            hits = engine.similarity(fp_index, db.name, query_fp, min_tc, limit, ranked=ranked,
+                                     deadline=deadline)
+        elif ranked:
+            hits = fp_index.top_k(query_fp, min_tc, limit, deadline=deadline)
+        else:
+            hits = fp_index.search(query_fp, min_tc, limit, deadline=deadline)
+        hit_docs = {x["_id"]: x for x in _until(core_db.compounds.find(
+            {"_id": {"$in": [cpd_id for cpd_id, _ in hits]}}, search_projection
+        ).max_time_ms(deadline.max_time_ms()), deadline)}
+        for cpd_id, tmc in hits:
+            if cpd_id in hit_docs:
+                if ranked:
+                    hit_docs[cpd_id]["Tanimoto"] = tmc
+                similarity_search_results.append(hit_docs[cpd_id])
+    elif ranked:
+        similarity_search_results = _ranked_similarity_scan(
+            db, core_db, query_fp, min_tc, limit, fp_type, search_projection, deadline
+        )
+    else:
+        # Filter compounds that meet tanimoto coefficient size requirements
+        cursor = core_db.compounds.find(
+            {
+                "$and": [
+                    {"len_" + fp_type: {"$gte": min_tc * len_fp}},
+                    {"len_" + fp_type: {"$lte": len_fp / min_tc}},
+                    {"MINES": db.name}
+                ]
+            },
+            search_projection,
+        ).max_time_ms(deadline.max_time_ms())
+        for x in _until(cursor, deadline):
+            # Put fingerprint in set for fast union (&) and intersection (|)
+            # calculations
+            test_fp = set(x[fp_type])
+            # Calculate tanimoto coefficient
+            tmc = len(query_fp & test_fp) / float(len(query_fp | test_fp))
+            # If a sufficient tanimoto coefficient is calculated, append the
+            # compound to the search results (until the limit is reached)
+            if tmc >= min_tc:
+                similarity_search_results.append(x)
+                if len(similarity_search_results) >= limit:
+                    break
+
+    if parent_filter and model_db:
+        similarity_search_results = score_compounds(
+            similarity_search_results, parent_filter, core_db=core_db, mine_db=db,
+            kegg_db=model_db, get_native=True
+        )
+
+    return similarity_search_results
+
 
+def _ranked_similarity_scan(
+    db: MINE,
+    core_db: MINE,
+    query_fp: set,
+    min_tc: float,
+    limit: int,
+    fp_type: str,
+    search_projection: Dict[str, int],
+    deadline: Deadline,
+) -> List:
+    """Find the limit compounds most similar to query_fp by scanning core_db
+    one popcount bucket at a time, in order of decreasing Tanimoto upper bound,
+    until no remaining bucket can beat the limit-th best score (or deadline
+    expires, leaving the best compounds of the buckets scanned so far)."""
+    if limit <= 0:
+        return []
     len_fp = len(query_fp)
-    # Return only id and fingerprint vector
-    # search_projection[fp_type] = 1
+    try:
+        counts = core_db.compounds.find(
+            {
+                "$and": [
+                    {"len_" + fp_type: {"$gte": min_tc * len_fp}},
+                    {"len_" + fp_type: {"$lte": len_fp / min_tc}},
+                    {"MINES": db.name}
+                ]
+            },
+        ).max_time_ms(deadline.max_time_ms()).distinct("len_" + fp_type)
+    except ExecutionTimeout:
+        deadline.truncated = True
+        return []
+    # Min-heap of (score, -n, compound) so ties keep the compounds found first
+    heap = []
+    n_scored = 0
+    for count in bucket_order(counts, len_fp):
+        if len(heap) >= limit and tanimoto_bound(count, len_fp) <= heap[0][0]:
+            break
+        if deadline.expired():
+            break
+        cursor = core_db.compounds.find({"len_" + fp_type: count, "MINES": db.name},
+                                        search_projection)
+        for x in _until(cursor.max_time_ms(deadline.max_time_ms()), deadline):
+            test_fp = set(x[fp_type])
+            tmc = len(query_fp & test_fp) / float(len(query_fp | test_fp))
+            n_scored += 1
+            if tmc >= min_tc:
+                item = (tmc, -n_scored, x)
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+
+    results = []
+    for tmc, _, x in sorted(heap, key=lambda item: item[:2], reverse=True):
+        x["Tanimoto"] = tmc
+        results.append(x)
+    return results
+
+
+def similarity_search_batch(
+    db: MINE,
+    core_db: MINE,
+    comp_structures: List[str],
+    min_tc: float,
+    limit: int,
+    search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    fp_index: FingerprintIndex = None,
+    deadline: Deadline = None,
+) -> Dict[str, List]:
+    """Runs a similarity search for many query structures with a single scan
+    of the candidate fingerprints.
+
+    Parameters
+    ----------
+    db : MINE
+        Database to search.
+    core_db : MINE
+        Core database with compound fingerprints.
+    comp_structures : List[str]
+        Molecules in molfile or SMILES format.
+    min_tc : float
+        Minimum Tanimoto score.
+    limit : int
+        The maximum number of compounds to return per query.
+    search_projection : Dict[str, int]
+        The fields which should be returned in the results.
+    fp_index : FingerprintIndex
+        Packed fingerprints of the compounds in db. If given, all queries are
+        scored against the candidates as one matrix computation in memory.
+    deadline : Deadline
+        Time budget of the search. If it runs out, the compounds found so far
+        are returned and deadline.truncated is set.
 
-    # Filter compounds that meet tanimoto coefficient size requirements
-    search_projection['RDKit_fp'] = 1
-    for x in core_db.compounds.find(
+    Returns
+    -------
+    results : Dict[str, List]
+        Search results (documents in MINE database) keyed by query structure,
+        as similarity_search would return them for each query.
+
+    Raises
+    ------
+    ValueError
+        If min_tc isn't in (0, 1] or a structure can't be parsed.
+    """
+    if not 0 < min_tc <= 1:
+        raise ValueError("min_tc must be greater than 0 and at most 1")
+    fp_type = "RDKit_fp"
+    comp_structures = list(dict.fromkeys(comp_structures))
+    query_fps = []
+    for comp_structure in comp_structures:
+        try:
+            parsed = parse_structure(comp_structure)
+        except ValueError:
+            raise ValueError(f"Unable to parse comp_structure: {comp_structure}")
+        query_fps.append(set(parsed.fp_bits(fp_type)))
+
+    search_projection = dict(search_projection, **{fp_type: 1})
+    deadline = deadline or Deadline(None)
+
+    if fp_index is not None:
+        all_hits = fp_index.search_many(query_fps, min_tc, limit, deadline=deadline)
+        hit_ids = {cpd_id for hits in all_hits for cpd_id, _ in hits}
+        hit_docs = {x["_id"]: x for x in _until(core_db.compounds.find(
+            {"_id": {"$in": list(hit_ids)}}, search_projection
+        ).max_time_ms(deadline.max_time_ms()), deadline)}
+        return {
+            comp_structure: [hit_docs[cpd_id] for cpd_id, _ in hits if cpd_id in hit_docs]
+            for comp_structure, hits in zip(comp_structures, all_hits)
+        }
+
+    results = {comp_structure: [] for comp_structure in comp_structures}
+    if not comp_structures:
+        return results
+    lengths = [len(query_fp) for query_fp in query_fps]
+    # Scan the union of all popcount windows once, scoring every candidate
+    # against each query whose window it falls into
+    cursor = core_db.compounds.find(
         {
             "$and": [
-                {"len_" + fp_type: {"$gte": min_tc * len_fp}},
-                {"len_" + fp_type: {"$lte": len_fp / min_tc}},
+                {"len_" + fp_type: {"$gte": min_tc * min(lengths)}},
+                {"len_" + fp_type: {"$lte": max(lengths) / min_tc}},
                 {"MINES": db.name}
             ]
         },
         search_projection,
-    ):
-        # Put fingerprint in set for fast union (&) and intersection (|)
-        # calculations
+    ).max_time_ms(deadline.max_time_ms())
+    for x in _until(cursor, deadline):
         test_fp = set(x[fp_type])
-        # Calculate tanimoto coefficient
-        tmc = len(query_fp & test_fp) / float(len(query_fp | test_fp))
-        # If a sufficient tanimoto coefficient is calculated, append the
-        # compound to the search results (until the limit is reached)
-        #print(tmc)
-        if tmc >= min_tc:
-            similarity_search_results.append(x)
-            if len(similarity_search_results) >= limit:
-                break
-
-    del search_projection['RDKit_fp']
-
-    if parent_filter and model_db:
-        similarity_search_results = score_compounds(
-            similarity_search_results, parent_filter, core_db=core_db, mine_db=db,
-            kegg_db=model_db, get_native=True
-        )
+        len_test_fp = len(test_fp)
+        for comp_structure, query_fp, len_fp in zip(comp_structures, query_fps, lengths):
+            if len(results[comp_structure]) >= limit:
+                continue
+            if not min_tc * len_fp <= len_test_fp <= len_fp / min_tc:
+                continue
+            tmc = len(query_fp & test_fp) / float(len(query_fp | test_fp))
+            if tmc >= min_tc:
+                results[comp_structure].append(x)
+        if all(len(hits) >= limit for hits in results.values()):
+            break
 
-    return similarity_search_results
+    return results
 
 
 def structure_search(
@@ -227,21 +685,10 @@ def structure_search(
     results : List
         List of search results (documents in MINE database).
     """
-    # Create Mol object from Molfile (has newlines)
-    if "\n" in comp_structure:
-        mol = AllChem.MolFromMolBlock(str(comp_structure))
-    # Create Mol object from SMILES string (does not have newlines)
-    else:
-        mol = AllChem.MolFromSmiles(str(comp_structure))
-    if not mol:
-        raise ValueError("Unable to parse comp_structure")
-
-    # Get InChI string from mol file (rdkit)
-    inchi = AllChem.MolToInchi(mol)
-    # Get InChI key from InChI string (rdkit)
-    inchi_key = AllChem.InchiToInchiKey(inchi)
+    # Get InChI key of the structure (computed once per cached structure)
+    inchi_key = parse_structure(comp_structure).inchi_key
     results = [x for x in db.compounds.find(
-               {"InChI_key": {"$regex": "^" + inchi_key.split("-")[0]}},
+               inchikey_block1_filter(db.compounds, inchi_key, "InChI_key"),
                search_projection)]
 
     if parent_filter and model_db:
@@ -261,6 +708,11 @@ def substructure_search(
     parent_filter: str = None,
     model_db: pymongo.database = None,
     search_projection: Dict[str, int] = DEFAULT_PROJECTION.copy(),
+    engine: SearchEngine = None,
+    postings: BitPostings = None,
+    screen_fp_type: str = "RDKit_fp",
+    mol_cache: MolCache = None,
+    deadline: Deadline = None,
 ) -> List:
     """Returns compounds in the indicated database which contain the provided
     structure
@@ -279,6 +731,21 @@ def substructure_search(
         MongoDB with KEGG organism codes and associated compounds.
     search_projection : Dict[str, int]
         The fields which should be returned in the results.
+    engine : SearchEngine
+        Process pool to check screened candidates for the substructure in.
+    postings : BitPostings
+        Fingerprint bit postings of the compounds in db. If given, candidates
+        are screened in memory and only the survivors are fetched from core_db.
+        Must invert the screen_fp_type fingerprints.
+    screen_fp_type : str
+        Fingerprint field used to screen candidates before substructure
+        matching. "Pattern_fp" (substructure-safe, see api.build pattern-fp)
+        or "RDKit_fp".
+    mol_cache : MolCache
+        Cache of candidate molecules, used instead of parsing their SMILES.
+    deadline : Deadline
+        Time budget of the search. If it runs out, the compounds found so far
+        are returned and deadline.truncated is set.
 
     Returns
     -------
@@ -286,37 +753,55 @@ def substructure_search(
         List of search results (documents in MINE database).
     """
     substructure_search_results = []
-    # Create Mol object from Molfile (has newlines)
-    if "\n" in sub_structure:
-        mol = AllChem.MolFromMolBlock(str(sub_structure))
-    # Create Mol object from SMILES string (does not have newlines)
+    deadline = deadline or Deadline(None)
+    # Parse the structure (or reuse an earlier parse of it)
+    parsed = parse_structure(sub_structure)
+    mol = parsed.mol
+
+    # Every bit of a compound's screening fingerprint must be on in the
+    # fingerprint of any compound containing it
+    query_fp = parsed.fp_bits(screen_fp_type)
+    if postings is not None:
+        candidates = _find_in_order(core_db.compounds, postings.screen_ids(query_fp),
+                                    search_projection, deadline=deadline)
     else:
-        mol = AllChem.MolFromSmiles(str(sub_structure))
-    if not mol:
-        raise ValueError("Unable to parse comp_structure")
-
-    # Based on fingerprint type specified by user, get the finger print as an
-    # explicit bit vector (series of 1s and 0s). Then, return a set of all
-    # indices where a bit is 1 in the bit vector.
-    query_fp = list(AllChem.RDKFingerprint(mol, fpSize=512).GetOnBits())
-    for x in core_db.compounds.find(
-        {
-            "$and": [
-                {"RDKit_fp": {"$all": query_fp}},
-                {"MINES": db.name}
-            ]
-        },
-        search_projection):
-
-        # Get Mol object from SMILES string (rdkit)
-        comp = AllChem.MolFromSmiles(x["SMILES"])
-        # Use HasSubstructMatch (rdkit) to determine if compound has a
-        # specified substructure. If so, append it to the results (until
-        # limit).
-        if comp and comp.HasSubstructMatch(mol):
-            substructure_search_results.append(x)
-            if len(substructure_search_results) >= limit:
+        candidates = core_db.compounds.find(
+            {
+                "$and": [
+                    {screen_fp_type: {"$all": query_fp}},
+                    {"MINES": db.name}
+                ]
+            },
+            search_projection).max_time_ms(deadline.max_time_ms())
+    candidates = _until(candidates, deadline)
+
+    if engine is not None:
+        substructure_search_results = engine.substructure(candidates, str(sub_structure), limit,
+                                                          mol_cache=mol_cache, deadline=deadline)
+        candidates.close()
+    elif mol_cache is not None:
+        for batch in batches(candidates, 500):
+            # Get Mol objects from the cache (or stored binaries) in bulk
+            for x, comp in zip(batch, mol_cache.get_mols(batch)):
+                if comp and comp.HasSubstructMatch(mol):
+                    substructure_search_results.append(x)
+                    if len(substructure_search_results) >= limit:
+                        break
+                if deadline.expired():
+                    break
+            if len(substructure_search_results) >= limit or deadline.truncated:
                 break
+    else:
+        for x in candidates:
+            # Get Mol object from SMILES string (rdkit)
+            comp = AllChem.MolFromSmiles(x["SMILES"])
+            # Use HasSubstructMatch (rdkit) to determine if compound has a
+            # specified substructure. If so, append it to the results (until
+            # limit).
+            if comp and comp.HasSubstructMatch(mol):
+                substructure_search_results.append(x)
+                if len(substructure_search_results) >= limit:
+                    break
 
     if parent_filter and model_db:
         substructure_search_results = score_compounds(
@@ -327,6 +812,108 @@ def substructure_search(
     return substructure_search_results
 
 
+def inchikey_block1_filter(
+    collection: pymongo.collection.Collection, inchi_key: str, key_field: str
+) -> Dict:
+    """Get a filter for the documents of collection with the same InChIKey
+    first block (i.e. the same connectivity) as inchi_key.
+
+    Uses an equality lookup on the precomputed inchikey_block1 field if
+    collection has an index on it, otherwise an anchored regex on key_field.
+    Whether a collection is indexed is checked once per process.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to be queried.
+    inchi_key : str
+        Full InChIKey (or just its first block).
+    key_field : str
+        Field of collection with full InChIKeys (e.g. "InChI_key").
+
+    Returns
+    -------
+    Dict
+        Mongo filter.
+    """
+    block1 = inchi_key.split("-")[0]
+    if _has_block1_index(collection):
+        return {INCHIKEY_BLOCK1: block1}
+    return {key_field: {"$regex": "^" + re.escape(block1)}}
+
+
+def inchikey_block1_in_filter(
+    collection: pymongo.collection.Collection, inchi_keys: Iterable[str], key_field: str
+) -> Dict:
+    """Get a filter for the documents of collection with the same InChIKey
+    first block as any of inchi_keys, as one query (see
+    inchikey_block1_filter).
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to be queried.
+    inchi_keys : Iterable[str]
+        Full InChIKeys (or just their first blocks).
+    key_field : str
+        Field of collection with full InChIKeys (e.g. "Inchikey").
+
+    Returns
+    -------
+    Dict
+        Mongo filter.
+    """
+    blocks = sorted({inchi_key.split("-")[0] for inchi_key in inchi_keys})
+    if _has_block1_index(collection):
+        return {INCHIKEY_BLOCK1: {"$in": blocks}}
+    return {key_field: {"$in": [re.compile("^" + re.escape(block1)) for block1 in blocks]}}
+
+
+def _has_block1_index(collection: pymongo.collection.Collection) -> bool:
+    """Check whether collection has an index on inchikey_block1 (at most
+    once per BLOCK1_INDEX_CHECK_INTERVAL)."""
+    indexed_key = (collection.database.name, collection.name)
+    indexed, checked_at = _block1_indexed.get(indexed_key, (None, None))
+    if checked_at is None or time.monotonic() - checked_at >= BLOCK1_INDEX_CHECK_INTERVAL:
+        indexed = any(
+            index["key"][0][0] == INCHIKEY_BLOCK1
+            for index in collection.index_information().values()
+        )
+        _block1_indexed[indexed_key] = (indexed, time.monotonic())
+    return indexed
+
+
+def _until(cursor: Iterable[Dict], deadline: Deadline) -> Generator[Dict, None, None]:
+    """Yield documents of cursor until deadline expires or Mongo stops the
+    cursor for exceeding its maxTimeMS, marking results as truncated in both
+    cases."""
+    try:
+        for x in cursor:
+            if deadline.expired():
+                return
+            yield x
+    except ExecutionTimeout:
+        deadline.truncated = True
+
+
+def _find_in_order(
+    collection: pymongo.collection.Collection,
+    ids: Iterable[str],
+    search_projection: Dict[str, int],
+    batch_size: int = 1000,
+    deadline: Deadline = None,
+) -> Generator[Dict, None, None]:
+    """Yield documents with the given _ids in the order of ids, fetching them
+    lazily in batches. Missing documents are skipped."""
+    deadline = deadline or Deadline(None)
+    for batch in batches(ids, batch_size):
+        cursor = collection.find({"_id": {"$in": batch}}, search_projection)
+        docs = {x["_id"]: x for x in cursor.max_time_ms(deadline.max_time_ms())}
+        for doc_id in batch:
+            if doc_id in docs:
+                yield docs[doc_id]
+
+
 def model_search(db: pymongo.database, query: str) -> List[str]:
     """Returns models that match a given KEGG Org Code query (e.g. 'hsa').
 
@@ -371,44 +958,92 @@ def get_ids(db: pymongo.database, collection: str, query: str) -> List[str]:
     ids : List[str]
         List of KEGG Org codes (_id) found in the DB matching search query.
     """
+    ids = list(iter_ids(db, collection, query))
+
+    return ids
+
+
+def iter_ids(db: pymongo.database, collection: str, query: str,
+             batch_size: int = 1000) -> Iterator[str]:
+    """Get ids for documents in database collection matching query (see
+    get_ids) as an iterator that reads them from Mongo batch_size at a time.
+    The query is parsed before this returns."""
     if query:
         query = literal_eval(query)
     else:
         query = {}
-    ids = [x["_id"] for x in db[collection].find(query)]
-
-    return ids
+    cursor = db[collection].find(query, {"_id": 1}).batch_size(batch_size)
+    return (x["_id"] for x in cursor)
 
 
 def get_comps(db: MINE, id_list: List[str], core_db: MINE) -> List:
     """Returns compounds with associated IDs from a Mongo database.
 
+    Compounds are fetched with one query (plus one to resolve MINE ids), and
+    reaction links missing from compounds are filled in with one
+    aggregation.
+
     Parameters
     ----------
     db : MINE
         DB to search.
     id_list : List[str]
-        IDs to get compound documents for.
+        IDs to get compound documents for. Integers are MINE ids.
+    core_db : MINE
+        Core database, used to resolve MINE ids.
 
     Returns
     -------
     compounds : List
-        List of compound documents with specified IDs.
+        List of compound documents with specified IDs, in the order of
+        id_list. None for IDs without a compound.
     """
-    compounds = []
-    for cpd_id in id_list:
-        if isinstance(cpd_id, int):
-            cpd = core_db.compounds.find_one({"MINE_id": cpd_id})
-            cpd_id = cpd['_id']
-        cpd = db.compounds.find_one({"_id": cpd_id})
-        # New MINEs won't have this precomputed
-        if cpd and "Reactant_in" not in cpd and "Product_of" not in cpd:
-            rxns_as_sub = db.reactions.find({"Reactants.c_id": cpd["_id"]})
-            cpd["Reactant_in"] = [x["_id"] for x in rxns_as_sub]
-            rxns_as_prod = db.reactions.find({"Products.c_id": cpd["_id"]})
-            cpd["Product_of"] = [x["_id"] for x in rxns_as_prod]
-        compounds.append(cpd)
-    return compounds
+    mine_ids = [cpd_id for cpd_id in id_list if isinstance(cpd_id, int)]
+    if mine_ids:
+        mine_id_map = {x["MINE_id"]: x["_id"] for x in core_db.compounds.find(
+            {"MINE_id": {"$in": mine_ids}}, {"MINE_id": 1}
+        )}
+        id_list = [mine_id_map.get(cpd_id) if isinstance(cpd_id, int) else cpd_id
+                   for cpd_id in id_list]
+
+    cpd_ids = list({cpd_id for cpd_id in id_list if cpd_id is not None})
+    cpds = {x["_id"]: x for x in db.compounds.find({"_id": {"$in": cpd_ids}})}
+
+    # New MINEs won't have this precomputed
+    unlinked = [cpd_id for cpd_id, cpd in cpds.items()
+                if "Reactant_in" not in cpd and "Product_of" not in cpd]
+    if unlinked:
+        _add_reaction_links(db, [cpds[cpd_id] for cpd_id in unlinked])
+
+    return [cpds.get(cpd_id) for cpd_id in id_list]
+
+
+def _add_reaction_links(db: MINE, compounds: List[Dict]) -> None:
+    """Set the Reactant_in and Product_of reaction _ids of compounds (in
+    natural reaction order) with one aggregation over db.reactions."""
+    cpds = {cpd["_id"]: cpd for cpd in compounds}
+    for cpd in compounds:
+        cpd["Reactant_in"] = []
+        cpd["Product_of"] = []
+    cpd_ids = list(cpds)
+    pipeline = [
+        {"$match": {"$or": [{"Reactants.c_id": {"$in": cpd_ids}},
+                            {"Products.c_id": {"$in": cpd_ids}}]}},
+        # One document per (reaction, participant), reactants first
+        {"$project": {"link": {"$concatArrays": [
+            {"$map": {"input": "$Reactants",
+                      "in": {"c_id": "$$this.c_id", "field": "Reactant_in"}}},
+            {"$map": {"input": "$Products",
+                      "in": {"c_id": "$$this.c_id", "field": "Product_of"}}},
+        ]}}},
+        {"$unwind": "$link"},
+        {"$match": {"link.c_id": {"$in": cpd_ids}}},
+    ]
+    for x in db.reactions.aggregate(pipeline):
+        rxn_ids = cpds[x["link"]["c_id"]][x["link"]["field"]]
+        # A compound can take part in a reaction more than once
+        if not rxn_ids or rxn_ids[-1] != x["_id"]:
+            rxn_ids.append(x["_id"])
 
 
 def get_rxns(db: MINE, id_list: List[str]) -> List:
@@ -426,28 +1061,24 @@ def get_rxns(db: MINE, id_list: List[str]) -> List:
     reactions : List
         List of reaction documents with specified IDs.
     """
-    reactions = []
-    all_reactions = db.reactions.find({"_id": {"$in": id_list}})
-
-    for rxn in all_reactions:
-        for i, cpds in enumerate(rxn['SMILES_rxn'].split('=>')):
-            if i == 0:  # reactants
-                for reactant, reactant_array in zip(cpds.split('+'), rxn['Reactants']):
-                    reactant = reactant.strip()
-                    reactant_smiles = reactant.split(' ')[-1]  # removes stoich from beginning
-                    reactant_array.append(reactant_smiles)
-            elif i == 1:
-                for product, product_array in zip(cpds.split('+'), rxn['Products']):
-                    product = product.strip()
-                    product_smiles = product.split(' ')[-1]  # removes stoich from beginning
-                    product_array.append(product_smiles)
-        reactions.append(rxn)
+    reactions = _find_rxns_with_smiles(db, {"_id": {"$in": id_list}})
 
     return reactions
 
 
-def get_rxns_for_cpd(db: MINE, cpd_id: str, mode: str = 'product_of') -> List:
-    """Returns reactions either being producing or consuming a compound.
+def get_rxns_for_cpd_page(
+    db: MINE,
+    cpd_id: str,
+    mode: str = 'product_of',
+    page_size: int = 100,
+    token: str = None,
+    fields: List[str] = None,
+) -> Tuple[List, Optional[str], Optional[int]]:
+    """Returns one page of the reactions producing or consuming a compound.
+
+    Reaction ids are read page by page from slices of the compound's
+    product_of/reactant_in lists, so hub compounds (e.g. water) never have
+    all their reactions in memory at once.
 
     Parameters
     ----------
@@ -458,39 +1089,236 @@ def get_rxns_for_cpd(db: MINE, cpd_id: str, mode: str = 'product_of') -> List:
     mode : str
         If 'product_of', get reactions producing this compound. If
         'reactant_in', get reactions consuming this compound.
+    page_size : int
+        Maximum number of reactions to return.
+    token : str
+        Continuation token returned with the previous page, None for the
+        first page.
+    fields : List[str]
+        Reaction fields to return, None for all of them.
 
     Returns
     -------
     reactions : List
-        List of reaction documents producing or consuming given compound.
+        Reaction documents of this page, in list order.
+    next_token : str
+        Token to get the next page with, None if this is the last page.
+    total : Optional[int]
+        Total number of reactions producing or consuming the compound (see
+        count_rxns_for_cpd), only counted for the first page (no token).
+
+    Raises
+    ------
+    ValueError
+        If token or page_size is invalid.
     """
-    reaction_ids = []
-    reactions = []
-    rxn_list_docs = db[mode].find({"c_id": cpd_id})
+    if page_size < 1:
+        raise ValueError("page_size must be at least 1")
     field_name = mode.capitalize()
-    for rxn_list_doc in rxn_list_docs:
-        reaction_ids += rxn_list_doc[field_name]
-
-    all_reactions = db.reactions.find({"_id": {"$in": reaction_ids}})
-
-    for rxn in all_reactions:
-        for i, cpds in enumerate(rxn['SMILES_rxn'].split('=>')):
-            if i == 0:  # reactants
-                for reactant, reactant_array in zip(cpds.split('+'), rxn['Reactants']):
-                    reactant = reactant.strip()
-                    reactant_smiles = reactant.split(' ')[-1]  # removes stoich from beginning
-                    reactant_array.append(reactant_smiles)
-            elif i == 1:
-                for product, product_array in zip(cpds.split('+'), rxn['Products']):
-                    product = product.strip()
-                    product_smiles = product.split(' ')[-1]  # removes stoich from beginning
-                    product_array.append(product_smiles)
-        reactions.append(rxn)
+    doc_index, offset = _decode_token(token) if token else (0, 0)
+
+    # (reaction id, position after it) of this page plus one more. The list
+    # document the token points into is sliced from the token's offset, the
+    # ones after it from their start, all read with a single cursor.
+    entries = []
+    n_wanted = page_size + 1
+    first_doc = next(db[mode].find(
+        {"c_id": cpd_id}, {field_name: {"$slice": [offset, n_wanted]}}
+    ).sort("_id", 1).skip(doc_index).limit(1), None)
+    if first_doc is not None:
+        chunks = db[mode].find(
+            {"c_id": cpd_id}, {field_name: {"$slice": n_wanted}}
+        ).sort("_id", 1).skip(doc_index + 1)
+        for i, rxn_list_doc in enumerate(itertools.chain([first_doc], chunks), doc_index):
+            start = offset if i == doc_index else 0
+            for j, rxn_id in enumerate(rxn_list_doc.get(field_name, []), start):
+                entries.append((rxn_id, (i, j + 1)))
+            if len(entries) >= n_wanted:
+                break
+
+    next_token = _encode_token(*entries[page_size - 1][1]) if len(entries) > page_size else None
+    reactions = _rxns_in_order(db, [rxn_id for rxn_id, _ in entries[:page_size]], fields)
+    total = count_rxns_for_cpd(db, cpd_id, mode) if token is None else None
+
+    return reactions, next_token, total
+
 
+def count_rxns_for_cpd(db: MINE, cpd_id: str, mode: str = 'product_of') -> int:
+    """Count the reactions producing or consuming a compound (the ids in its
+    product_of/reactant_in lists).
+
+    Parameters
+    ----------
+    db : MINE
+        DB to search.
+    cpd_id : str
+        Mongo ID of compound.
+    mode : str
+        If 'product_of', count reactions producing this compound. If
+        'reactant_in', count reactions consuming this compound.
+
+    Returns
+    -------
+    int
+        Number of reactions.
+    """
+    field_name = mode.capitalize()
+    totals = db[mode].aggregate([
+        {"$match": {"c_id": cpd_id}},
+        {"$group": {"_id": None, "total": {"$sum": {"$size": {"$ifNull": ["$" + field_name, []]}}}}},
+    ])
+    return next(totals, {"total": 0})["total"]
+
+
+def iter_rxns_for_cpd(
+    db: MINE,
+    cpd_id: str,
+    mode: str = 'product_of',
+    fields: List[str] = None,
+    batch_size: int = 1000,
+    token: str = None,
+    deadline: Deadline = None,
+) -> ResultStream:
+    """Get all reactions producing or consuming a compound (from the token's
+    position), in the order of the compound's product_of/reactant_in lists,
+    as an iterator that fetches batch_size reactions at a time so memory
+    doesn't grow with their number.
+
+    Parameters
+    ----------
+    db : MINE
+        DB to search.
+    cpd_id : str
+        Mongo ID of compound.
+    mode : str
+        If 'product_of', get reactions producing this compound. If
+        'reactant_in', get reactions consuming this compound.
+    fields : List[str]
+        Reaction fields to return (_id is always included). None for all.
+    batch_size : int
+        Number of reactions fetched per query.
+    token : str
+        Continuation token (from get_rxns_for_cpd_page or a truncated
+        stream) to start from, None to start from the first reaction.
+    deadline : Deadline
+        Time budget, checked before each batch. None for no limit.
+
+    Returns
+    -------
+    ResultStream
+        Reaction documents, as get_rxns_for_cpd_page returns them. Stops
+        early (setting deadline.truncated and next_token) if deadline runs
+        out.
+
+    Raises
+    ------
+    ValueError
+        If token is invalid.
+    """
+    field_name = mode.capitalize()
+    start_index, start_offset = _decode_token(token) if token else (0, 0)
+    deadline = deadline or Deadline(None)
+
+    def results():
+        # Reaction ids of the next batch and the position of the first one
+        rxn_ids = []
+        batch_start = (start_index, start_offset)
+        cursor = db[mode].find({"c_id": cpd_id}, {field_name: 1}).sort("_id", 1)
+        try:
+            for doc_index, rxn_list_doc in enumerate(
+                    cursor.skip(start_index).max_time_ms(deadline.max_time_ms()), start_index):
+                offset = start_offset if doc_index == start_index else 0
+                for i, rxn_id in enumerate(rxn_list_doc.get(field_name, [])[offset:], offset):
+                    if not rxn_ids:
+                        batch_start = (doc_index, i)
+                    rxn_ids.append(rxn_id)
+                    if len(rxn_ids) >= batch_size:
+                        if deadline.expired():
+                            break
+                        yield from _rxns_in_order(db, rxn_ids, fields)
+                        rxn_ids = []
+                        batch_start = (doc_index, i + 1)
+                if deadline.truncated:
+                    break
+        except ExecutionTimeout:
+            deadline.truncated = True
+        if rxn_ids and not deadline.expired():
+            yield from _rxns_in_order(db, rxn_ids, fields)
+        if deadline.truncated:
+            stream.next_token = _encode_token(*batch_start)
+
+    stream = ResultStream(results(), deadline)
+    return stream
+
+
+def _rxns_in_order(db: MINE, rxn_ids: List[str], fields: List[str] = None) -> List:
+    """Get reactions (see _find_rxns_with_smiles) in the order of rxn_ids,
+    skipping ids without a reaction."""
+    rxns = {x["_id"]: x for x in _find_rxns_with_smiles(db, {"_id": {"$in": rxn_ids}}, fields)}
+    return [rxns[rxn_id] for rxn_id in rxn_ids if rxn_id in rxns]
+
+
+def _encode_token(*position: int) -> str:
+    """Encode a position in a result list as an opaque continuation token."""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def _encode_id_token(last_id: str) -> str:
+    """Encode the _id of the last result of a list sorted by _id as an
+    opaque continuation token."""
+    return base64.urlsafe_b64encode(json.dumps({"after": last_id}).encode()).decode()
+
+
+def _decode_id_token(token: str) -> str:
+    """Decode a continuation token made by _encode_id_token."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid continuation token")
+    if not isinstance(position, dict) or not isinstance(position.get("after"), str):
+        raise ValueError("Invalid continuation token")
+    return position["after"]
+
+
+def _decode_token(token: str) -> Tuple[int, ...]:
+    """Decode a continuation token made by _encode_token."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid continuation token")
+    if (not isinstance(position, list) or not position
+            or not all(isinstance(x, int) and x >= 0 for x in position)):
+        raise ValueError("Invalid continuation token")
+    return tuple(position)
+
+
+def _find_rxns_with_smiles(db: MINE, query: Dict, fields: List[str] = None) -> List:
+    """Get reactions matching query with the SMILES of each participant
+    appended to its Reactants/Products entry ([stoich, c_id, SMILES]). Only
+    fields (and _id) are returned if given.
+
+    Uses the stored Reactant_SMILES/Product_SMILES fields, which Mongo
+    computes from SMILES_rxn for reactions without them."""
+    pipeline = [
+        {"$match": query},
+        {"$addFields": {field: {"$ifNull": ["$" + field, expr]}
+                        for field, expr in RXN_SMILES_FIELDS.items()}},
+    ]
+    sides = (("Reactants", "Reactant_SMILES"), ("Products", "Product_SMILES"))
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection.update({smiles_field: 1 for side, smiles_field in sides if side in fields})
+        pipeline.append({"$project": projection})
+    reactions = []
+    for rxn in db.reactions.aggregate(pipeline):
+        for side, smiles_field in sides:
+            for participant, smiles in zip(rxn.get(side, []), rxn.pop(smiles_field, None) or []):
+                participant.append(smiles)
+        reactions.append(rxn)
     return reactions
 
 
-def get_ops(db: MINE, operator_ids: List[str]) -> List:
+def get_ops(db: MINE, operator_ids: List[str], catalog: OperatorCatalog = None) -> List:
     """Returns operators from a Mongo database.
 
     Parameters
@@ -499,12 +1327,19 @@ def get_ops(db: MINE, operator_ids: List[str]) -> List:
         DB to search.
     operator_ids : List[str]
         IDs to get operator documents for (e.g. "1.1.-1.h").
+    catalog : OperatorCatalog
+        Operators of db in memory. If given, db isn't queried.
 
     Returns
     -------
     operators : List
         List of operator documents with specified IDs.
     """
+    if catalog is not None:
+        if not operator_ids:
+            return list(catalog.operators)
+        return [catalog.get(op_id) for op_id in operator_ids]
+
     if not operator_ids:
         operators = [op for op in db.operators.find()]
     else:
@@ -516,7 +1351,8 @@ def get_ops(db: MINE, operator_ids: List[str]) -> List:
     return operators
 
 
-def get_op_w_rxns(db: MINE, operator_id: str, limit: int = 100) -> Dict:
+def get_op_w_rxns(db: MINE, operator_id: str, limit: int = 100,
+                  catalog: OperatorCatalog = None) -> Dict:
     """Returns operator with all its associated reactions.
 
     Parameters
@@ -527,15 +1363,22 @@ def get_op_w_rxns(db: MINE, operator_id: str, limit: int = 100) -> Dict:
         Mongo _id or operator name (e.g. rule0001).
     limit : int
         Max number of reaction _ids to return with operator.
+    catalog : OperatorCatalog
+        Operators of db in memory. If given, the operator is taken from it.
 
     Returns
     -------
     operator : Dict
         Operator JSON document (with associated reactions).
     """
-    operator = db.operators.find_one(
-        {"$or": [{"_id": operator_id}, {"Name": operator_id}]}
-    )
+    if catalog is not None:
+        operator = catalog.get(operator_id)
+        # Copy, catalog documents are shared between requests
+        operator = dict(operator) if operator else None
+    else:
+        operator = db.operators.find_one(
+            {"$or": [{"_id": operator_id}, {"Name": operator_id}]}
+        )
     if operator:
         op_rxns = db.reactions.find({"Operators": operator_id}).limit(limit)
         operator["Reaction_ids"] = list(set([op_rxn['_id'] for op_rxn in op_rxns]))
@@ -543,3 +1386,68 @@ def get_op_w_rxns(db: MINE, operator_id: str, limit: int = 100) -> Dict:
         return None
 
     return operator
+
+
+def get_op_rxns_page(
+    db: MINE,
+    operator_id: str,
+    page_size: int = 100,
+    token: str = None,
+    catalog: OperatorCatalog = None,
+) -> Tuple[Optional[Dict], Optional[str]]:
+    """Returns operator with one page of its reaction _ids and its exact
+    number of reactions.
+
+    Reaction _ids and counts come from the operator reaction index built by
+    "python -m api.build op-rxns". For MINEs without it, falls back to
+    get_op_w_rxns (the first page_size reactions found, without a count).
+
+    Parameters
+    ----------
+    db : MINE
+        DB to search.
+    operator_id : str
+        Mongo _id or operator name (e.g. rule0001).
+    page_size : int
+        Maximum number of reaction _ids to return.
+    token : str
+        Continuation token returned with the previous page, None for the
+        first page.
+    catalog : OperatorCatalog
+        Operators of db in memory. If given, the operator is taken from it.
+
+    Returns
+    -------
+    operator : Dict
+        Operator JSON document with a page of reaction _ids
+        ("Reaction_ids") and the total number of reactions
+        ("Reaction_count"), None if there is no such operator.
+    next_token : str
+        Token to get the next page with, None if this is the last page.
+
+    Raises
+    ------
+    ValueError
+        If token is invalid.
+    """
+    if catalog is not None:
+        operator = catalog.get(operator_id)
+        # Copy, catalog documents are shared between requests
+        operator = dict(operator) if operator else None
+    else:
+        operator = db.operators.find_one(
+            {"$or": [{"_id": operator_id}, {"Name": operator_id}]}
+        )
+    if operator is None or "Reaction_count" not in operator:
+        if token:
+            raise ValueError("Invalid continuation token")
+        return get_op_w_rxns(db, operator_id, limit=page_size, catalog=catalog), None
+
+    offset = _decode_token(token)[0] if token else 0
+    operator["Reaction_ids"] = get_op_rxn_ids(db, operator["_id"], offset, page_size)
+    if offset + page_size < operator["Reaction_count"]:
+        next_token = _encode_token(offset + page_size)
+    else:
+        next_token = None
+
+    return operator, next_token
@@ -0,0 +1,212 @@
+"""Query_compiler.py: Checks queries in Mongo syntax sent by clients before
+they are run against MINE compounds, so only plain filters on known fields
+reach the database.
+
+compile_query parses a query string and checks it against whitelists of
+fields and operators, refusing server-side JavaScript ($where, $function),
+aggregation expressions ($expr) and anything else that isn't a filter.
+plan_summary reads which indexes an explained query would use, so queries
+that would scan a whole collection can be refused before they run."""
+from ast import literal_eval
+from typing import Any, Dict, List
+
+#: Compound fields (and their subfields) queries and projections may use
+QUERY_FIELDS = frozenset([
+    "_id", "ID", "MINE_id", "KEGG_id", "Names", "Formula", "Mass", "Charge",
+    "logP", "NP_likeness", "SMILES", "Inchi", "Inchikey", "InChI_key",
+    "inchikey_block1", "Generation", "Expand", "Type", "MINES", "Sources",
+    "Product_of", "Reactant_in", "Pathways", "Enzymes", "len_RDKit_fp",
+])
+
+#: Reaction fields (and their subfields) projections may use
+RXN_FIELDS = frozenset([
+    "_id", "ID", "Reactants", "Products", "Operators", "SMILES_rxn",
+    "Reactant_SMILES", "Product_SMILES", "InChI_hash", "Type", "Generation",
+    "Names", "Energy",
+])
+
+#: Query operators queries may use
+QUERY_OPERATORS = frozenset([
+    "$and", "$or", "$nor", "$not", "$eq", "$ne", "$gt", "$gte", "$lt",
+    "$lte", "$in", "$nin", "$all", "$size", "$exists", "$type", "$regex",
+    "$options", "$elemMatch",
+])
+
+#: Maximum nesting depth of queries
+MAX_QUERY_DEPTH = 10
+
+# Operators whose argument is a list of queries
+_LOGICAL_OPERATORS = frozenset(["$and", "$or", "$nor"])
+
+
+class QueryError(ValueError):
+    """A query that isn't allowed to run."""
+
+
+def compile_query(mongo_query: str) -> Dict[str, Any]:
+    """Parse a query string and check that it only uses allowed fields and
+    operators.
+
+    Parameters
+    ----------
+    mongo_query : str
+        A query with Mongo syntax, e.g. "{'MINE_id': {'$lt': 100}}".
+
+    Returns
+    -------
+    Dict[str, Any]
+        The query, ready to pass to find.
+
+    Raises
+    ------
+    QueryError
+        If the query can't be parsed or uses anything not whitelisted.
+    """
+    try:
+        query = literal_eval(mongo_query)
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        raise QueryError("Query is not valid Mongo syntax")
+    if not isinstance(query, dict):
+        raise QueryError("Query must be a document")
+    _check_filter(query, 0, check_fields=True)
+    return query
+
+
+def compile_projection(fields: List[str], allowed: frozenset = QUERY_FIELDS) -> Dict[str, int]:
+    """Get a projection including fields, checking they are allowed.
+
+    Parameters
+    ----------
+    fields : List[str]
+        Names of fields (dotted paths for subfields).
+    allowed : frozenset
+        Top level fields that may be used, QUERY_FIELDS for compounds or
+        RXN_FIELDS for reactions.
+
+    Returns
+    -------
+    Dict[str, int]
+        Projection for find.
+
+    Raises
+    ------
+    QueryError
+        If a field isn't whitelisted.
+    """
+    for field in fields:
+        _check_field(field, allowed)
+    return {field: 1 for field in fields}
+
+
+def plan_summary(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Summarize the output of the explain command of a query.
+
+    Parameters
+    ----------
+    explain : Dict[str, Any]
+        Output of the explain command (any verbosity).
+
+    Returns
+    -------
+    Dict[str, Any]
+        "plan": the winning plan, "stages": its stages from the root down,
+        "indexes": names of the indexes it uses and "collscan": whether it
+        scans the whole collection.
+    """
+    plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    stages = []
+    indexes = []
+    pending = [plan]
+    while pending:
+        node = pending.pop(0)
+        if isinstance(node, list):
+            pending.extend(node)
+        elif isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node and node["indexName"] not in indexes:
+                indexes.append(node["indexName"])
+            # Stages nest as inputStage(s) and, on newer servers, queryPlan
+            pending.extend(node[key] for key in ("queryPlan", "inputStage", "inputStages")
+                           if key in node)
+    return {
+        "plan": plan,
+        "stages": stages,
+        "indexes": indexes,
+        "collscan": "COLLSCAN" in stages,
+    }
+
+
+def _check_field(field: Any, allowed: frozenset = QUERY_FIELDS) -> None:
+    """Check a field name is whitelisted (by its top level name) and that no
+    segment of its path is empty or uses positional/operator syntax ($)."""
+    if not isinstance(field, str):
+        raise QueryError(f"Field {field!r} can't be queried")
+    segments = field.split(".")
+    if (segments[0] not in allowed
+            or any(not segment or "$" in segment or "\0" in segment for segment in segments)):
+        raise QueryError(f"Field {field!r} can't be queried")
+
+
+def _check_filter(query: Dict, depth: int, check_fields: bool) -> None:
+    """Check a query document: field names and logical operators. Fields of
+    array elements ($elemMatch) aren't checked against QUERY_FIELDS."""
+    if depth > MAX_QUERY_DEPTH:
+        raise QueryError("Query is nested too deeply")
+    for key, value in query.items():
+        if not isinstance(key, str):
+            raise QueryError(f"Field {key!r} can't be queried")
+        if key.startswith("$"):
+            if key not in _LOGICAL_OPERATORS:
+                raise QueryError(f"Operator {key} can't be used here")
+            if not isinstance(value, (list, tuple)) or not value:
+                raise QueryError(f"{key} needs a list of queries")
+            for sub_query in value:
+                if not isinstance(sub_query, dict):
+                    raise QueryError(f"{key} needs a list of queries")
+                _check_filter(sub_query, depth + 1, check_fields)
+        else:
+            if check_fields:
+                _check_field(key)
+            _check_condition(value, depth + 1)
+
+
+def _check_condition(value: Any, depth: int) -> None:
+    """Check the condition on one field: a value to match or a document of
+    operators."""
+    if depth > MAX_QUERY_DEPTH:
+        raise QueryError("Query is nested too deeply")
+    if isinstance(value, dict) and any(isinstance(key, str) and key.startswith("$")
+                                       for key in value):
+        for key, arg in value.items():
+            if key not in QUERY_OPERATORS or key in _LOGICAL_OPERATORS:
+                raise QueryError(f"Operator {key} can't be used here")
+            if key == "$elemMatch":
+                if not isinstance(arg, dict):
+                    raise QueryError("$elemMatch needs a query")
+                if any(isinstance(k, str) and k.startswith("$") for k in arg):
+                    _check_condition(arg, depth + 1)
+                else:
+                    _check_filter(arg, depth + 1, check_fields=False)
+            elif key == "$not":
+                _check_condition(arg, depth + 1)
+            else:
+                _check_value(arg, depth + 1)
+    else:
+        _check_value(value, depth)
+
+
+def _check_value(value: Any, depth: int) -> None:
+    """Check a literal value only holds plain data, with no operators."""
+    if depth > MAX_QUERY_DEPTH:
+        raise QueryError("Query is nested too deeply")
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str) or key.startswith("$"):
+                raise QueryError(f"Operator {key} can't be used here")
+            _check_value(item, depth + 1)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _check_value(item, depth + 1)
+    elif value is not None and not isinstance(value, (str, int, float, bool)):
+        raise QueryError(f"Value {value!r} can't be queried")
@@ -1,33 +1,53 @@
 """Here, routes are defined for all possible API requests. Note that nearly
-all actual logic is imported from the minedatabase package."""
+all actual logic is imported from the minedatabase package.
 
+Compound, reaction, id and search routes return MessagePack or Arrow streams
+instead of JSON to clients that ask for them with an Accept header (see
+api.serialization)."""
+
+import os
 from ast import literal_eval
 
 import requests
-from flask import Blueprint
+from flask import Blueprint, Response
 from flask import current_app as app
-from flask import jsonify, request
-from flask.helpers import send_from_directory
+from flask import request, stream_with_context
 from minedatabase.metabolomics import (ms2_search, ms_adduct_search, read_adduct_names,
                                        score_compounds, spectra_download)
 
+from api.autocomplete import get_name_index
+from api.compression import send_precompressed, write_cache_file
 from api.config import Config
 from api.database import mongo
+from api.deadline import Deadline
+from api.engine import batches, get_search_engine
 from api.exceptions import InvalidUsage
-from api.queries import (advanced_search, get_comps, get_ids, get_op_w_rxns, get_ops, get_rxns,
-                         get_rxns_for_cpd, model_search, quick_search, similarity_search,
+from api.fingerprints import get_bit_postings, get_fp_index
+from api.molecules import get_mol_cache, structure_cache_stats
+from api.operators import get_op_catalog
+from api.queries import (DEFAULT_PROJECTION, ResultStream, advanced_search_page,
+                         advanced_search_stream, count_rxns_for_cpd, explain_advanced_search,
+                         get_comps, get_ids, get_op_rxns_page, get_ops, get_rxns,
+                         get_rxns_for_cpd_page, iter_ids, iter_rxns_for_cpd, model_search,
+                         quick_search, similarity_search, similarity_search_batch,
                          structure_search, substructure_search)
+from api.query_compiler import RXN_FIELDS, compile_projection
+from api.serialization import (JSON_MIMETYPE, dumps, jsonify, make_response,
+                               response_formats)
 
 if Config.THERMO_ON:
     from api.database_thermo import mine_thermo
 
 from api.utils import (extract_enzyme_pathway_from_kegg_data, get_extra_info,
-                       get_smiles_from_mol_string)
+                       get_smiles_from_mol_string, get_xref_cache)
 
 # pylint: disable=invalid-name
 mineserver_api = Blueprint('mineserver_api', __name__)
 # pylint: enable=invalid-name
 
+# Screening fingerprint used for each core database, see _get_screen_fp_type
+_screen_fp_types = {}
+
 
 @mineserver_api.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
@@ -38,6 +58,135 @@ def handle_invalid_usage(error):
     return response
 
 
+def _get_deadline(budget_key, json_data=None):
+    """Start the time budget of a search: the budget configured under
+    budget_key, lowered (never raised) by a "time_ms" argument given in JSON
+    data or the query string."""
+    budget_ms = app.config[budget_key]
+    if json_data and 'time_ms' in json_data:
+        time_ms = json_data['time_ms']
+    else:
+        time_ms = request.args.get('time_ms')
+
+    if time_ms is not None:
+        try:
+            time_ms = float(time_ms)
+        except (TypeError, ValueError):
+            raise InvalidUsage('<time_ms> argument must be a number of milliseconds.')
+        if time_ms <= 0:
+            raise InvalidUsage('<time_ms> argument must be positive.')
+        if budget_ms is None or time_ms < budget_ms:
+            budget_ms = time_ms
+
+    return Deadline(budget_ms)
+
+
+def _get_page_size(default_key, max_key):
+    """Get the "page_size" query string arg, defaulting to the value
+    configured under default_key and limited to the one under max_key."""
+    try:
+        page_size = int(request.args.get('page_size', app.config[default_key]))
+    except ValueError:
+        raise InvalidUsage('<page_size> argument must be an integer.')
+    if not 1 <= page_size <= app.config[max_key]:
+        raise InvalidUsage(f"<page_size> argument must be between 1 and "
+                           f"{app.config[max_key]}.")
+    return page_size
+
+
+def _wants_stream():
+    """Whether the client asked for a streamed NDJSON response, with a
+    "stream=1" query string arg or an Accept header preferring
+    application/x-ndjson to application/json."""
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def _ndjson_response(docs, transform=None):
+    """Stream documents as newline delimited JSON (one document per line).
+    Documents are serialized and written STREAM_BATCH_SIZE at a time, after
+    passing each batch (a list) through transform if given, so a request
+    holds one batch in memory however many documents it returns.
+
+    If docs is a ResultStream that runs out of time, the stream ends with a
+    {"truncated": true, "next_token": <token>} line, since the headers are
+    already sent by then. Clients resume by sending next_token as "token"."""
+    batch_size = app.config['STREAM_BATCH_SIZE']
+
+    def generate():
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield _ndjson_lines(batch, transform)
+                batch = []
+        if batch:
+            yield _ndjson_lines(batch, transform)
+        if isinstance(docs, ResultStream) and docs.truncated:
+            yield dumps({'truncated': True, 'next_token': docs.next_token}) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def _ndjson_lines(batch, transform):
+    """Serialize a batch of documents as NDJSON lines."""
+    if transform is not None:
+        batch = transform(batch)
+    return b''.join(dumps(doc) + b'\n' for doc in batch)
+
+
+def _json_array_response(docs):
+    """Stream documents as one JSON array, serialized STREAM_BATCH_SIZE at a
+    time like _ndjson_response, for clients expecting a plain JSON list."""
+    batch_size = app.config['STREAM_BATCH_SIZE']
+
+    def generate():
+        separator = b'['
+        for batch in batches(docs, batch_size):
+            yield separator + b','.join(dumps(doc) for doc in batch)
+            separator = b','
+        yield b']\n' if separator == b',' else b'[]\n'
+
+    return Response(stream_with_context(generate()), mimetype=JSON_MIMETYPE)
+
+
+def _negotiated_response(results):
+    """Serialize results in the format the client's Accept header prefers:
+    JSON (the default), MessagePack or, for lists, an Arrow stream."""
+    mimetype = request.accept_mimetypes.best_match(response_formats(results),
+                                                   default=JSON_MIMETYPE)
+    response = make_response(results, mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def _get_screen_fp_type(core_db):
+    """Get the fingerprint field substructure searches screen on: the
+    configured SUBSTRUCTURE_SCREEN_FP, or RDKit_fp if no compound of the core
+    database has it (checked once per core database)."""
+    if core_db.name not in _screen_fp_types:
+        fp_type = app.config['SUBSTRUCTURE_SCREEN_FP']
+        if fp_type != 'RDKit_fp' and core_db.compounds.find_one(
+                {fp_type: {'$exists': True}}, {'_id': 1}) is None:
+            app.logger.warning(f"No compounds of {core_db.name} have {fp_type}, screening "
+                               f"substructure searches with RDKit_fp instead. Run "
+                               f"'python -m api.build pattern-fp' and restart to use it.")
+            fp_type = 'RDKit_fp'
+        _screen_fp_types[core_db.name] = fp_type
+    return _screen_fp_types[core_db.name]
+
+
+def _search_response(results, deadline):
+    """Serialize search results (see _negotiated_response), reporting in
+    headers whether the search ran out of time and how long it took."""
+    json_results = _negotiated_response(results)
+    json_results.headers['X-Truncated'] = 'true' if deadline.truncated else 'false'
+    json_results.headers['X-Elapsed-Ms'] = f'{deadline.elapsed_ms():.0f}'
+    return json_results
+
+
 @mineserver_api.route('/quick-search/<db_name>/q=<query>')
 def quick_search_api(db_name, query):
     """Perform a quick search and return results.
@@ -47,15 +196,59 @@ def quick_search_api(db_name, query):
     :param str db_name:
         Name of Mongo database to query against.
     :param str query:
-        A MINE id, KEGG code, ModelSEED id, Inchikey, or Name.
+        A MINE id, KEGG code, ModelSEED id, PubChem id, Inchikey, or Name.
 
     :return: JSON Documents matching query.
     :rtype: flask.Response
     """
     db = mongo.cx[db_name]
     core_db = mongo.cx[app.config['CORE_DB_NAME']]
-    results = quick_search(db, core_db, query)
-    json_results = jsonify(results)
+    ref_db = mongo.cx[app.config['REF_DB_NAME']]
+    results = quick_search(db, core_db, query, ref_db=ref_db)
+    json_results = _negotiated_response(results)
+
+    return json_results
+
+
+@mineserver_api.route('/autocomplete/<db_name>')
+def autocomplete_api(db_name):
+    """Complete a compound name from its first characters.
+
+    .. :quickref: Compound; Autocomplete names
+
+    Names of the MINE's compounds are kept in an in-memory index, built on
+    the first request for the MINE from the xref_ids map written by
+    "python -m api.build xref-ids" and rebuilt when the MINE or the map
+    changes.
+
+    :param str db_name:
+        Name of Mongo database to complete names of.
+    :query str prefix:
+        Start of the name (case insensitive).
+    :query int limit:
+        Maximum number of names to return.
+
+    :return: JSON list of names starting with prefix, in alphabetical order.
+    :rtype: flask.Response
+    """
+    prefix = request.args.get('prefix', '')
+    if not prefix:
+        raise InvalidUsage('<prefix> argument is required.')
+    try:
+        limit = int(request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT']))
+    except ValueError:
+        raise InvalidUsage('<limit> argument must be an integer.')
+    if not 1 <= limit <= app.config['MAX_AUTOCOMPLETE_LIMIT']:
+        raise InvalidUsage(f"<limit> argument must be between 1 and "
+                           f"{app.config['MAX_AUTOCOMPLETE_LIMIT']}.")
+
+    core_db = mongo.cx[app.config['CORE_DB_NAME']]
+    ref_db = mongo.cx[app.config['REF_DB_NAME']]
+    name_index = get_name_index(core_db, ref_db, mongo.cx[db_name],
+                                app.config['NAME_INDEX_CHECK_INTERVAL'])
+    if name_index is None:
+        raise InvalidUsage(f'MINE "{db_name}" not found.')
+    json_results = jsonify(name_index.complete(prefix, limit))
 
     return json_results
 
@@ -106,11 +299,24 @@ def similarity_search_api(db_name, smiles=None, min_tc=0.7, limit=100):
         based on whether it is in or could be derived from the KEGG compounds
         in this organism (provided in the 'Likelihood_score' field of each
         compound document). Defaults to None.
+    :param bool,optional ranked:
+        If true, return the <limit> most similar compounds sorted by
+        decreasing Tanimoto Coefficient (given in the 'Tanimoto' field of each
+        compound document) instead of the first <limit> compounds found. Can
+        be given in form data or as a query string arg (e.g. "?ranked=true").
+        Defaults to False.
+    :param int,optional time_ms:
+        Time budget of the search in milliseconds, can only lower the server's
+        budget. Can be given in form data or as a query string arg.
 
-    :return: JSON Document of similar compounds.
+    :return:
+        JSON Document of similar compounds. If the search ran out of time,
+        the compounds found so far with an "X-Truncated: true" header.
+        "X-Elapsed-Ms" gives the search time.
     :rtype: flask.Response
     """
     json_data = request.get_json()
+    deadline = _get_deadline('SIMILARITY_SEARCH_TIME_MS', json_data)
 
     if json_data and 'mol' in json_data:
         mol_str = str(json_data['mol'])
@@ -121,13 +327,100 @@ def similarity_search_api(db_name, smiles=None, min_tc=0.7, limit=100):
     else:
         model = None
 
+    if json_data and 'ranked' in json_data:
+        ranked = str(json_data['ranked']).lower() in ('1', 'true')
+    else:
+        ranked = request.args.get('ranked', '').lower() in ('1', 'true')
+
     db = mongo.cx[db_name]
     model_db = mongo.cx[app.config['KEGG_DB_NAME']]
     core_db = mongo.cx[app.config['CORE_DB_NAME']]
 
+    if app.config['FP_INDEX_ON']:
+        fp_index = get_fp_index(core_db, db_name)
+    else:
+        fp_index = None
+
     results = similarity_search(db, core_db, smiles, min_tc=min_tc, limit=limit,
-                                parent_filter=model, model_db=model_db)
-    json_results = jsonify(results)
+                                parent_filter=model, model_db=model_db,
+                                fp_index=fp_index, ranked=ranked, deadline=deadline,
+                                engine=get_search_engine(app.config['SEARCH_PROCESSES'],
+                                                         app.config['SEARCH_SHARDS']))
+
+    return _search_response(results, deadline)
+
+
+@mineserver_api.route('/similarity-search-batch/<db_name>', methods=['POST'])
+def similarity_search_batch_api(db_name):
+    """Perform similarity searches for many structures at once.
+
+    .. :quickref: Compound; Batch structure similarity search
+
+    All query structures are answered with a single pass over the candidate
+    compounds, so this is much faster than one similarity search per query.
+    Attach all arguments besides db_name as JSON data in POST request.
+
+    :param str db_name:
+        Name of Mongo database to query against.
+    :param list structures:
+        List of query structures, each either a SMILES string or a mol object
+        in str format.
+    :param float,optional min_tc:
+        Minimum Tanimoto Coefficient required for similarity match. Defaults to
+        0.7.
+    :param int,optional limit:
+        Maximum number of results (compounds) to return per query. Defaults
+        to 100.
+    :param int,optional time_ms:
+        Time budget of the search in milliseconds, can only lower the
+        server's budget.
+
+    :return:
+        JSON object mapping each query structure to its array of similar
+        compounds. If the search ran out of time, the compounds found so far
+        with an "X-Truncated: true" header. "X-Elapsed-Ms" gives the search
+        time.
+    :rtype: flask.Response
+    """
+    json_data = request.get_json()
+
+    if json_data and 'structures' in json_data:
+        structures = [str(structure) for structure in json_data['structures']]
+    else:
+        raise InvalidUsage('<structures> argument must be specified.')
+
+    if len(structures) > app.config['MAX_BATCH_QUERIES']:
+        raise InvalidUsage(f"At most {app.config['MAX_BATCH_QUERIES']} structures can be "
+                           "searched per request.")
+
+    try:
+        min_tc = float(json_data.get('min_tc', 0.7))
+    except (TypeError, ValueError):
+        raise InvalidUsage('<min_tc> argument must be a number.')
+    if not 0 < min_tc <= 1:
+        raise InvalidUsage('<min_tc> argument must be greater than 0 and at most 1.')
+    try:
+        limit = int(json_data.get('limit', 100))
+    except (TypeError, ValueError):
+        raise InvalidUsage('<limit> argument must be an integer.')
+    if limit < 1:
+        raise InvalidUsage('<limit> argument must be at least 1.')
+    deadline = _get_deadline('SIMILARITY_SEARCH_TIME_MS', json_data)
+
+    db = mongo.cx[db_name]
+    core_db = mongo.cx[app.config['CORE_DB_NAME']]
+
+    if app.config['FP_INDEX_ON']:
+        fp_index = get_fp_index(core_db, db_name)
+    else:
+        fp_index = None
+
+    try:
+        results = similarity_search_batch(db, core_db, structures, min_tc=min_tc,
+                                          limit=limit, fp_index=fp_index, deadline=deadline)
+    except ValueError as err:
+        raise InvalidUsage(str(err))
+    json_results = _search_response(results, deadline)
 
     return json_results
 
@@ -180,7 +473,7 @@ def structure_search_api(db_name, smiles=None):
     ref_db = mongo.cx[app.config['REF_DB_NAME']]
     results = structure_search(db, core_db, smiles, model_db=model_db, parent_filter=model)
     results = get_extra_info(db, core_db, ref_db, results)
-    json_results = jsonify(results)
+    json_results = _negotiated_response(results)
 
     return json_results
 
@@ -213,11 +506,18 @@ def substructure_search_api(db_name, smiles=None, limit=100):
     :param int limit:
         Maximum number of results (compounds) to return. By default, returns
         100 results.
+    :param int,optional time_ms:
+        Time budget of the search in milliseconds, can only lower the server's
+        budget. Can be given in form data or as a query string arg.
 
-    :return: JSON Documents of compounds containing given substructure.
+    :return:
+        JSON Documents of compounds containing given substructure. If the
+        search ran out of time, the compounds found so far with an
+        "X-Truncated: true" header. "X-Elapsed-Ms" gives the search time.
     :rtype: flask.Response
     """
     json_data = request.get_json()
+    deadline = _get_deadline('SUBSTRUCTURE_SEARCH_TIME_MS', json_data)
 
     if json_data and 'mol' in json_data:
         mol_str = str(json_data['mol'])
@@ -231,12 +531,26 @@ def substructure_search_api(db_name, smiles=None, limit=100):
     model_db = mongo.cx[app.config['KEGG_DB_NAME']]
     core_db = mongo.cx[app.config['CORE_DB_NAME']]
 
+    screen_fp_type = _get_screen_fp_type(core_db)
+    if app.config['FP_POSTINGS_ON']:
+        postings = get_bit_postings(core_db, db_name, screen_fp_type)
+    else:
+        postings = None
+
+    if app.config['MOL_CACHE_SIZE']:
+        mol_cache = get_mol_cache(core_db, app.config['MOL_CACHE_SIZE'])
+    else:
+        mol_cache = None
+
     db = mongo.cx[db_name]
     results = substructure_search(db, core_db, smiles, limit=limit, model_db=model_db,
-                                  parent_filter=model)
-    json_results = jsonify(results)
+                                  parent_filter=model, postings=postings,
+                                  screen_fp_type=screen_fp_type, mol_cache=mol_cache,
+                                  deadline=deadline,
+                                  engine=get_search_engine(app.config['SEARCH_PROCESSES'],
+                                                           app.config['SEARCH_SHARDS']))
 
-    return json_results
+    return _search_response(results, deadline)
 
 
 @mineserver_api.route('/model-search/q=<query>')
@@ -269,16 +583,96 @@ def database_query_api(db_name, mongo_query):
     :param str db_name:
         Name of Mongo database to query against.
     :param str mongo_query:
-        A valid Mongo query (e.g. .../q={"ID": "cpd00001"}).
+        A valid Mongo query (e.g. .../q={"ID": "cpd00001"}). Only plain
+        filters on compound fields are allowed, see api.query_compiler.
+    :param int,optional time_ms:
+        Time budget of the query in milliseconds (query string arg), can only
+        lower the server's budget.
+    :param int,optional page_size:
+        Maximum number of documents to return (query string arg).
+    :param str,optional token:
+        Continuation token from the "X-Next-Token" header of the previous
+        page (query string arg).
+    :param str,optional fields:
+        Comma separated fields to return instead of the default ones (query
+        string arg).
+    :param int,optional explain:
+        If 1, return the plan Mongo would run the query with and the indexes
+        it would use instead of running it (query string arg).
+    :param int,optional stream:
+        If 1 (or with an "Accept: application/x-ndjson" header), stream all
+        matching documents (from token on) as newline delimited JSON instead
+        of returning one page (query string arg). If the query runs out of
+        time, the stream ends early with a {"truncated": true,
+        "next_token": <token>} line, where next_token resumes the stream.
 
-    :return: JSON Documents matching provided Mongo query.
+    :return:
+        JSON Documents matching provided Mongo query. "X-Next-Token" gives
+        the token of the next page if there is one. If the query ran out of
+        time, the documents found so far with an "X-Truncated: true" header.
+        "X-Elapsed-Ms" gives the query time.
     :rtype: flask.Response
     """
     db = mongo.cx[db_name]
-    results = advanced_search(db, mongo_query)
+    try:
+        if request.args.get('explain') in ('1', 'true'):
+            return jsonify(explain_advanced_search(db, mongo_query))
+
+        deadline = _get_deadline('DATABASE_QUERY_TIME_MS')
+        fields = request.args.get('fields')
+        if fields:
+            projection = compile_projection([field for field in fields.split(',') if field])
+        else:
+            projection = DEFAULT_PROJECTION.copy()
+        if _wants_stream():
+            results = advanced_search_stream(
+                db, mongo_query, token=request.args.get('token'), search_projection=projection,
+                deadline=deadline, reject_collscan=app.config['REJECT_COLLSCAN_QUERIES'],
+                batch_size=app.config['STREAM_BATCH_SIZE']
+            )
+            # TODO: add model to score_compounds (where None currently is)
+            return _ndjson_response(results, lambda batch: score_compounds(db, batch, None))
+
+        page_size = _get_page_size('DATABASE_QUERY_PAGE_SIZE', 'MAX_DATABASE_QUERY_PAGE_SIZE')
+        results, next_token = advanced_search_page(
+            db, mongo_query, page_size, token=request.args.get('token'),
+            search_projection=projection, deadline=deadline,
+            reject_collscan=app.config['REJECT_COLLSCAN_QUERIES']
+        )
+    except ValueError as err:
+        raise InvalidUsage(str(err))
     # TODO: add model to score_compounds (where None currently is)
     results = score_compounds(db, results, None)
-    json_results = jsonify(results)
+
+    json_results = _search_response(results, deadline)
+    if next_token:
+        json_results.headers['X-Next-Token'] = next_token
+
+    return json_results
+
+
+@mineserver_api.route('/cache-stats')
+def cache_stats_api():
+    """Get hit and miss counters of the server's in-memory caches.
+
+    .. :quickref: Server; Get cache statistics
+
+    Counters are per server worker process, since each has its own caches.
+
+    :return:
+        JSON object with the size, maximum size, hits and misses of the
+        query structure cache ("structures"), of the candidate molecule
+        cache ("molecules", null if it isn't used) and of the
+        cross-reference cache ("xrefs").
+    :rtype: flask.Response
+    """
+    if app.config['MOL_CACHE_SIZE']:
+        core_db = mongo.cx[app.config['CORE_DB_NAME']]
+        mol_stats = get_mol_cache(core_db, app.config['MOL_CACHE_SIZE']).stats()
+    else:
+        mol_stats = None
+    json_results = jsonify({'structures': structure_cache_stats(), 'molecules': mol_stats,
+                            'xrefs': get_xref_cache().stats()})
 
     return json_results
 
@@ -318,12 +712,19 @@ def get_ids_api(db_name, collection_name, query=None):
         python dict as you would have in argument to db.collection.find().
         Defaults to None.
 
+    :param int,optional stream:
+        If 1 (or with an "Accept: application/x-ndjson" header), stream ids
+        as newline delimited JSON (query string arg).
+
     :return: List of ids matching query in JSON format.
     :rtype: flask.Response
     """
     db = mongo.cx[db_name]
+    if _wants_stream():
+        return _ndjson_response(iter_ids(db, collection_name, query,
+                                         batch_size=app.config['STREAM_BATCH_SIZE']))
     results = get_ids(db, collection_name, query)
-    json_results = jsonify(results)
+    json_results = _negotiated_response(results)
 
     return json_results
 
@@ -366,7 +767,7 @@ def get_comps_api(db_name):
     if return_extra_info and results and all(results):
         results = get_extra_info(db, core_db, ref_db, results)
 
-    json_results = jsonify(results)
+    json_results = _negotiated_response(results)
 
     return json_results
 
@@ -391,14 +792,62 @@ def get_rxns_api(db_name):
 
     db = mongo.cx[db_name]
     results = get_rxns(db, id_list)
+    json_results = _negotiated_response(results)
+
+    return json_results
+
+
+def _rxns_for_cpd_response(db_name, cpd_id, mode):
+    """Get the reactions producing or consuming a compound, with fields given
+    by a comma separated "fields" query string arg. All reactions are
+    returned (streamed as a JSON list) unless a page is asked for with
+    "page_size" or "token" args. Streams all of them as NDJSON instead if
+    the client asks for it."""
+    fields = request.args.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else None
+    if fields:
+        try:
+            compile_projection(fields, RXN_FIELDS)
+        except ValueError as err:
+            raise InvalidUsage(str(err))
+
+    db = mongo.cx[db_name]
+    if _wants_stream():
+        try:
+            results = iter_rxns_for_cpd(db, cpd_id, mode=mode, fields=fields,
+                                        batch_size=app.config['STREAM_BATCH_SIZE'],
+                                        token=request.args.get('token'),
+                                        deadline=_get_deadline('RXN_STREAM_TIME_MS'))
+        except ValueError as err:
+            raise InvalidUsage(str(err))
+        return _ndjson_response(results)
+    if 'page_size' not in request.args and 'token' not in request.args:
+        json_results = _json_array_response(iter_rxns_for_cpd(
+            db, cpd_id, mode=mode, fields=fields, batch_size=app.config['STREAM_BATCH_SIZE']
+        ))
+        json_results.headers['X-Total-Count'] = str(count_rxns_for_cpd(db, cpd_id, mode))
+        return json_results
+
+    page_size = _get_page_size('RXN_PAGE_SIZE', 'MAX_RXN_PAGE_SIZE')
+    try:
+        results, next_token, total = get_rxns_for_cpd_page(
+            db, cpd_id, mode=mode, page_size=page_size, token=request.args.get('token'),
+            fields=fields
+        )
+    except ValueError as err:
+        raise InvalidUsage(str(err))
     json_results = jsonify(results)
+    if total is not None:
+        json_results.headers['X-Total-Count'] = str(total)
+    if next_token:
+        json_results.headers['X-Next-Token'] = next_token
 
     return json_results
 
 
 @mineserver_api.route('/get-rxns-product-of/<db_name>/<cpd_id>')
 def get_rxns_product_of_api(db_name, cpd_id):
-    """Get reactions producing compound.
+    """Get reactions producing compound, all at once or one page at a time.
 
     .. :quickref: Reaction; Get MINE reactions producing a compound.
 
@@ -406,20 +855,39 @@ def get_rxns_product_of_api(db_name, cpd_id):
         Name of Mongo database to query against.
     :param str cpd_id:
         Mongo ID of compound.
+    :param int,optional page_size:
+        Maximum number of reactions to return (query string arg). If neither
+        page_size nor token is given, all reactions are returned. Defaults
+        to 100 when paging.
+    :param str,optional token:
+        Continuation token from the "X-Next-Token" header of the previous
+        page (query string arg). Omit for the first page.
+    :param str,optional fields:
+        Comma separated reaction fields to return (query string arg, e.g.
+        "?fields=Operators,SMILES_rxn"). Defaults to all fields.
+    :param int,optional stream:
+        If 1 (or with an "Accept: application/x-ndjson" header), stream all
+        of the reactions (from token on) as newline delimited JSON (query
+        string arg). If the stream runs out of time, it ends early with a
+        {"truncated": true, "next_token": <token>} line, where next_token
+        resumes the stream.
+    :param int,optional time_ms:
+        Time budget of a stream in milliseconds (query string arg), can only
+        lower the server's budget.
 
-    :return: List of reaction JSON documents.
+    :return:
+        List of reaction JSON documents. "X-Total-Count" gives the number of
+        reactions producing the compound (on the full list and the first
+        page) and, when paging, "X-Next-Token" (absent on the last page) the
+        token of the next page.
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = get_rxns_for_cpd(db, cpd_id, mode='product_of')
-    json_results = jsonify(results)
-
-    return json_results
+    return _rxns_for_cpd_response(db_name, cpd_id, 'product_of')
 
 
 @mineserver_api.route('/get-rxns-reactant-in/<db_name>/<cpd_id>')
 def get_rxns_reactant_in_api(db_name, cpd_id):
-    """Get reactions consuming compound.
+    """Get reactions consuming compound, all at once or one page at a time.
 
     .. :quickref: Reaction; Get MINE reactions consuming a compound.
 
@@ -427,15 +895,34 @@ def get_rxns_reactant_in_api(db_name, cpd_id):
         Name of Mongo database to query against.
     :param str cpd_id:
         Mongo ID of compound.
+    :param int,optional page_size:
+        Maximum number of reactions to return (query string arg). If neither
+        page_size nor token is given, all reactions are returned. Defaults
+        to 100 when paging.
+    :param str,optional token:
+        Continuation token from the "X-Next-Token" header of the previous
+        page (query string arg). Omit for the first page.
+    :param str,optional fields:
+        Comma separated reaction fields to return (query string arg, e.g.
+        "?fields=Operators,SMILES_rxn"). Defaults to all fields.
+    :param int,optional stream:
+        If 1 (or with an "Accept: application/x-ndjson" header), stream all
+        of the reactions (from token on) as newline delimited JSON (query
+        string arg). If the stream runs out of time, it ends early with a
+        {"truncated": true, "next_token": <token>} line, where next_token
+        resumes the stream.
+    :param int,optional time_ms:
+        Time budget of a stream in milliseconds (query string arg), can only
+        lower the server's budget.
 
-    :return: List of reaction JSON documents.
+    :return:
+        List of reaction JSON documents. "X-Total-Count" gives the number of
+        reactions consuming the compound (on the full list and the first
+        page) and, when paging, "X-Next-Token" (absent on the last page) the
+        token of the next page.
     :rtype: flask.Response
     """
-    db = mongo.cx[db_name]
-    results = get_rxns_for_cpd(db, cpd_id, mode='reactant_in')
-    json_results = jsonify(results)
-
-    return json_results
+    return _rxns_for_cpd_response(db_name, cpd_id, 'reactant_in')
 
 
 @mineserver_api.route('/get-ops/<db_name>', methods=['POST'])
@@ -451,6 +938,9 @@ def get_ops_api(db_name):
         requests.post(<this_uri>, data="{'id_list': ['id1', 'id2', 'id3']}").
         IDs can be either operator ids (e.g. 1.1.-1.h) or Mongo IDs (_id). If
         not provided, all operators are returned (id_list=None).
+    :param int,optional stream:
+        If 1 (or with an "Accept: application/x-ndjson" header), stream
+        operators as newline delimited JSON (query string arg).
 
     :return: List of operator JSON documents.
     :rtype: flask.Response
@@ -461,7 +951,10 @@ def get_ops_api(db_name):
         id_list = None
 
     db = mongo.cx[db_name]
-    results = get_ops(db, id_list)
+    results = get_ops(db, id_list,
+                      catalog=get_op_catalog(db, app.config['OP_CATALOG_CHECK_INTERVAL']))
+    if _wants_stream():
+        return _ndjson_response(results)
     json_results = jsonify(results)
 
     return json_results
@@ -469,7 +962,8 @@ def get_ops_api(db_name):
 
 @mineserver_api.route('/get-op-w-rxns/<db_name>/<op_id>')
 def get_op_w_rxns_api(db_name, op_id):
-    """Get operator with all its associated reactions in selected database.
+    """Get operator with its associated reactions in selected database, one
+    page of reaction ids at a time.
 
     .. :quickref: Operator; Get reactions for MINE operator
 
@@ -477,14 +971,34 @@ def get_op_w_rxns_api(db_name, op_id):
         Name of Mongo database to query against.
     :param str op_id:
         Either operator id (e.g. 1.1.-1.h) or Mongo ID (_id) for operator.
+    :param int,optional page_size:
+        Maximum number of reaction ids to return (query string arg).
+        Defaults to 100.
+    :param str,optional token:
+        Continuation token from the "X-Next-Token" header of the previous
+        page (query string arg). Omit for the first page.
 
-    :return: Operator JSON document (including associated reactions).
+    :return:
+        Operator JSON document (including a page of associated reaction ids
+        in "Reaction_ids"). If the MINE's operator reaction index is built,
+        "Reaction_count" gives the number of reactions of the operator and
+        "X-Next-Token" (absent on the last page) the token of the next page.
     :rtype: flask.Response
     """
+    page_size = _get_page_size('RXN_PAGE_SIZE', 'MAX_RXN_PAGE_SIZE')
+
     db = mongo.cx[db_name]
-    results = get_op_w_rxns(db, op_id)
+    try:
+        results, next_token = get_op_rxns_page(
+            db, op_id, page_size=page_size, token=request.args.get('token'),
+            catalog=get_op_catalog(db, app.config['OP_CATALOG_CHECK_INTERVAL'])
+        )
+    except ValueError as err:
+        raise InvalidUsage(str(err))
     if results:
         json_results = jsonify(results)
+        if next_token:
+            json_results.headers['X-Next-Token'] = next_token
         return json_results
     else:
         raise InvalidUsage('Operator with ID \"{}\" not found.'.format(op_id))
@@ -499,11 +1013,16 @@ def get_op_image_api(rule_name):
     :param str rule_name:
         Name of rule from MetaCyc generalized operator set (e.g. "rule0361").
 
-    :return: Image of operator reaction (.jpg)
+    :return:
+        Image of operator reaction (.jpg), from a compressed copy if the
+        client accepts one and it is smaller.
     :rtype: flask.Response
     """
     app.logger.info(f"Sending operator image: {rule_name}.jpg")
-    return send_from_directory(app.config['OP_IMG_DIR'], f"{rule_name}.jpg")
+    return send_precompressed(
+        os.path.join(app.config['OP_IMG_DIR'], f"{os.path.basename(rule_name)}.jpg"),
+        os.path.join(app.config['COMPRESSION_CACHE_DIR'], 'operator_images')
+    )
 
 
 @mineserver_api.route('/get-thermo-info/<c_id>')
@@ -540,25 +1059,36 @@ def get_adduct_names_api(adduct_type='all'):
     :return:
         JSON array of adduct names. If adduct_type == 'all', then this is an
         array of two arrays, with the first element being positive adducts and
-        the second adduct being negative adducts.
+        the second adduct being negative adducts. Served from a file
+        written (and compressed) once in the compression cache directory.
     :rtype: flask.Response
     """
 
     if adduct_type.lower() == 'positive':
-        results = read_adduct_names(app.config['POS_ADDUCT_PATH'])
+        adduct_paths = [app.config['POS_ADDUCT_PATH']]
     elif adduct_type.lower() == 'negative':
-        results = read_adduct_names(app.config['NEG_ADDUCT_PATH'])
+        adduct_paths = [app.config['NEG_ADDUCT_PATH']]
     elif adduct_type == 'all':
-        pos_results = read_adduct_names(app.config['POS_ADDUCT_PATH'])
-        neg_results = read_adduct_names(app.config['NEG_ADDUCT_PATH'])
-        results = [pos_results, neg_results]
+        adduct_paths = [app.config['POS_ADDUCT_PATH'], app.config['NEG_ADDUCT_PATH']]
     else:
         raise InvalidUsage('URL param <adduct_type> must be "all", "pos", or '
                            '"neg".')
 
-    json_results = jsonify(results)
+    def get_results():
+        """Read the adduct names of each file."""
+        results = [read_adduct_names(adduct_path) for adduct_path in adduct_paths]
+        return results if adduct_type == 'all' else results[0]
 
-    return json_results
+    cache_path = write_cache_file(
+        os.path.join(app.config['COMPRESSION_CACHE_DIR'],
+                     f'adduct_names_{adduct_type.lower()}.json'),
+        lambda: dumps(get_results()) + b'\n', adduct_paths
+    )
+    if cache_path is None:
+        return jsonify(get_results())
+
+    return send_precompressed(cache_path, app.config['COMPRESSION_CACHE_DIR'],
+                              mimetype='application/json')
 
 
 @mineserver_api.route('/ms-adduct-search/<db_name>', methods=['POST'])
@@ -681,7 +1211,7 @@ def ms_adduct_search_api(db_name):
     core_db = mongo.cx[app.config['CORE_DB_NAME']]
 
     results = ms_adduct_search(db, core_db, keggdb, text, text_type, ms_params)
-    json_results = jsonify(results)
+    json_results = _negotiated_response(results)
 
     if results:
         app.logger.info(f'MS Search successful ({len(results)} results found)')
@@ -824,7 +1354,7 @@ def ms2_search_api(db_name):
     core_db = mongo.cx[app.config['CORE_DB_NAME']]
 
     results = ms2_search(db, core_db, keggdb, text, text_type, ms_params)
-    json_results = jsonify(results)
+    json_results = _negotiated_response(results)
 
     return json_results
 
@@ -17,8 +17,13 @@ sys.path.insert(0, '../../MINE-Database')
 sys.path.insert(0, '..')  # required in deployment to import api modules
 
 
+from api.compression import init_compression
 from api.config import Config
 from api.database import mongo
+from api.exceptions import StaleStoreError
+from api.fingerprints import open_fp_store
+from api.molecules import set_structure_cache_size
+from api.serialization import init_json
 
 
 
@@ -39,6 +44,8 @@ def create_app(instance_config=Config):
     # Initialize app
     app = Flask(__name__)
     app.config.from_object(instance_config)
+    init_json(app)
+    init_compression(app)
 
     # Initialize logger
     if __name__ != '__main__':
@@ -77,8 +84,21 @@ def create_app(instance_config=Config):
     # Connect to Mongo Database
     mongo.init_app(app)
 
+    set_structure_cache_size(app.config['STRUCTURE_CACHE_SIZE'])
+
+    # Map fingerprint store (shared by all workers through the page cache)
+    if app.config['FP_STORE_PATH']:
+        app.logger.info(f"Opening fingerprint store {app.config['FP_STORE_PATH']}")
+        try:
+            open_fp_store(app.config['FP_STORE_PATH'], verify=app.config['FP_STORE_VERIFY'],
+                          core_db=mongo.cx[app.config['CORE_DB_NAME']])
+        except StaleStoreError as err:
+            app.logger.error(f"Not using fingerprint store: {err}. Fingerprint indexes "
+                             f"will be built from the core database instead.")
+
     # Allow CORS so we can have front end and back end on same server
-    CORS(app)
+    # (and let the front end see whether search results were truncated)
+    CORS(app, expose_headers=['X-Truncated', 'X-Elapsed-Ms', 'X-Next-Token', 'X-Total-Count'])
 
     app.logger.info('MINE-Server startup')
     app.logger.info('Running at http://127.0.0.1:5000')
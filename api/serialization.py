@@ -0,0 +1,307 @@
+"""Serialization.py: Fast JSON serialization of API responses.
+
+MINE documents are serialized with orjson, which encodes dicts, lists,
+strings, numbers and numpy arrays and scalars natively. Its default hook is
+only called for the few types it doesn't know (ObjectId, pint quantities
+from thermo, sets), not for every object. Without orjson installed, the
+standard library encoder is used with the same hook, which is slower but
+gives the same output.
+
+Unlike Flask 1.1's encoder, dates and datetimes are written as ISO 8601
+strings (e.g. "2020-05-01T12:30:00"), not HTTP dates, and keys are only
+sorted if the JSON_SORT_KEYS setting is on.
+
+Flask 2.2+ apps get ORJSONProvider as their JSON provider (see
+init_json), so flask.jsonify uses it. Older Flask versions have no
+provider interface, so routes use jsonify from this module instead.
+
+Clients can also ask for MessagePack or, for lists of documents, Arrow IPC
+streams (see response_formats and make_response), if msgpack and pyarrow
+are installed."""
+import datetime
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from flask import current_app
+
+from api.fingerprints import FP_SIZES, pack_fps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:  # Flask < 2.2
+    DefaultJSONProvider = None
+
+
+def _default(obj: Any) -> Any:
+    """Convert an object the JSON encoder doesn't know to one it does."""
+    # numpy types and dates are only seen here without orjson
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    # pint Measurement (value +/- error) and Quantity, checked by attribute
+    # to not import pint when thermo is off. Measurements are written as
+    # their value only, their error is dropped.
+    if hasattr(obj, "value") and hasattr(obj, "error"):
+        return obj.value.magnitude
+    if hasattr(obj, "magnitude") and hasattr(obj, "units"):
+        return obj.magnitude
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+#: Mimetype of JSON responses
+JSON_MIMETYPE = "application/json"
+
+#: Mimetype of MessagePack responses
+MSGPACK_MIMETYPE = "application/msgpack"
+
+#: Mimetype of Arrow IPC stream responses
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serialize obj to compact JSON.
+
+    Parameters
+    ----------
+    obj : Any
+        Object to serialize (e.g. a list of Mongo documents).
+    sort_keys : bool
+        Whether to sort the keys of dicts.
+
+    Returns
+    -------
+    bytes
+        UTF-8 encoded JSON.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+    return json.dumps(obj, default=_default, separators=(",", ":"), ensure_ascii=False,
+                      sort_keys=sort_keys).encode()
+
+
+def loads(data: Any) -> Any:
+    """Deserialize JSON from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def jsonify(*args, **kwargs):
+    """Drop-in replacement for flask.jsonify that serializes with dumps.
+
+    Like flask.jsonify, takes either one positional argument, several
+    (serialized as a list) or keyword arguments (serialized as a dict), and
+    sorts keys if the JSON_SORT_KEYS setting is on.
+
+    Returns
+    -------
+    flask.Response
+        Response with the JSON and an application/json mimetype.
+    """
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    mimetype = current_app.config.get("JSONIFY_MIMETYPE", JSON_MIMETYPE)
+    sort_keys = current_app.config.get("JSON_SORT_KEYS", False)
+    return current_app.response_class(dumps(data, sort_keys) + b"\n", mimetype=mimetype)
+
+
+def dumps_msgpack(obj: Any) -> bytes:
+    """Serialize obj to MessagePack, converting values like dumps does."""
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def loads_msgpack(data: bytes) -> Any:
+    """Deserialize MessagePack made by dumps_msgpack."""
+    return msgpack.unpackb(data, raw=False)
+
+
+def dumps_arrow(docs: List) -> bytes:
+    """Serialize a list of documents as an Arrow IPC stream with one column
+    per field (a list of plain values becomes a single "value" column).
+
+    Fingerprint fields (RDKit_fp and Pattern_fp on-bit lists) become fixed
+    size binary columns of bitmaps, where bit i is bit i % 8 of byte i // 8.
+    Columns with nested documents or values that aren't plain JSON types
+    (e.g. ObjectId or dates), or with values Arrow can't give one type, hold
+    JSON strings and have {"encoding": "json"} field metadata.
+
+    Parameters
+    ----------
+    docs : List
+        Documents (e.g. compounds) or plain values.
+
+    Returns
+    -------
+    bytes
+        The stream, with one record batch.
+    """
+    records = bool(docs) and all(isinstance(doc, dict) for doc in docs)
+    if records:
+        names = list(dict.fromkeys(name for doc in docs for name in doc))
+        columns = {name: [doc.get(name) for doc in docs] for name in names}
+    else:
+        columns = {"value": list(docs)}
+
+    arrays = []
+    fields = []
+    for name, values in columns.items():
+        array, metadata = _arrow_column(name, values)
+        arrays.append(array)
+        fields.append(pa.field(name, array.type, metadata=metadata))
+    schema = pa.schema(fields, metadata={"records": "1" if records else "0"})
+    sink = pa.BufferOutputStream()
+    writer = pa.ipc.new_stream(sink, schema)
+    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def loads_arrow(data: bytes) -> List:
+    """Deserialize an Arrow IPC stream made by dumps_arrow. Fields that
+    are null in a row are left out of its document."""
+    table = pa.ipc.open_stream(data).read_all()
+    columns = {}
+    for field, column in zip(table.schema, table.columns):
+        values = column.to_pylist()
+        metadata = field.metadata or {}
+        if b"fp_size" in metadata:
+            values = [None if value is None else np.flatnonzero(np.unpackbits(
+                np.frombuffer(value, dtype=np.uint8), bitorder="little")).tolist()
+                      for value in values]
+        elif metadata.get(b"encoding") == b"json":
+            values = [None if value is None else loads(value) for value in values]
+        columns[field.name] = values
+
+    if (table.schema.metadata or {}).get(b"records") != b"1":
+        return columns.get("value", [])
+    return [{name: values[i] for name, values in columns.items() if values[i] is not None}
+            for i in range(table.num_rows)]
+
+
+def _arrow_column(name: str, values: List) -> Tuple["pa.Array", Optional[Dict[str, str]]]:
+    """Make the Arrow array of a column and its field metadata."""
+    if name in FP_SIZES and all(value is None or isinstance(value, list) for value in values):
+        fp_size = FP_SIZES[name]
+        rows = [i for i, value in enumerate(values) if value is not None]
+        packed = pack_fps([values[i] for i in rows], fp_size).view(np.uint8)
+        bitmaps = [None] * len(values)
+        for i, bitmap in zip(rows, packed):
+            bitmaps[i] = bitmap.tobytes()
+        return pa.array(bitmaps, type=pa.binary(fp_size // 8)), {"fp_size": str(fp_size)}
+
+    if all(_is_plain(value) for value in values):
+        try:
+            return pa.array(values), None
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+            pass
+    json_values = [None if value is None else dumps(value).decode() for value in values]
+    return pa.array(json_values, type=pa.string()), {"encoding": "json"}
+
+
+def _is_plain(value: Any) -> bool:
+    """Whether a value is a plain JSON value or a list of them. Documents
+    are not, since Arrow would turn them into structs with the fields of
+    every row."""
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain(item) for item in value)
+    return value is None or isinstance(value, (str, bool, int, float))
+
+
+def response_formats(obj: Any) -> List[str]:
+    """Get the mimetypes obj can be serialized to, JSON first. Binary
+    formats are only offered if their library is installed."""
+    formats = [JSON_MIMETYPE]
+    if msgpack is not None:
+        formats.append(MSGPACK_MIMETYPE)
+    if pa is not None and isinstance(obj, list):
+        formats.append(ARROW_MIMETYPE)
+    return formats
+
+
+def make_response(obj: Any, mimetype: str = JSON_MIMETYPE):
+    """Serialize obj to a response.
+
+    Parameters
+    ----------
+    obj : Any
+        Object to serialize.
+    mimetype : str
+        One of response_formats(obj).
+
+    Returns
+    -------
+    flask.Response
+        Response with the serialized object.
+    """
+    if mimetype == MSGPACK_MIMETYPE:
+        data = dumps_msgpack(obj)
+    elif mimetype == ARROW_MIMETYPE:
+        data = dumps_arrow(obj)
+    else:
+        return jsonify(obj)
+    return current_app.response_class(data, mimetype=mimetype)
+
+
+if DefaultJSONProvider is not None:
+    class ORJSONProvider(DefaultJSONProvider):
+        """Flask JSON provider serializing with dumps."""
+
+        def dumps(self, obj: Any, **kwargs: Any) -> str:
+            """Serialize obj to a JSON string (kwargs other than sort_keys
+            are ignored)."""
+            return dumps(obj, kwargs.get("sort_keys", self.sort_keys)).decode()
+
+        def loads(self, s: Any, **kwargs: Any) -> Any:
+            """Deserialize JSON from str or bytes."""
+            return loads(s)
+
+        def response(self, *args: Any, **kwargs: Any):
+            """Serialize data like jsonify to a response."""
+            return jsonify(*args, **kwargs)
+else:
+    ORJSONProvider = None
+
+
+def init_json(app) -> None:
+    """Make flask.jsonify of app serialize with dumps, on Flask versions
+    with JSON providers.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The app.
+    """
+    if ORJSONProvider is not None:
+        app.json = ORJSONProvider(app)
+        app.json.sort_keys = app.config.get("JSON_SORT_KEYS", False)
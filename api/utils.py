@@ -1,43 +1,105 @@
+import threading
+
 from flask import current_app as app
-from rdkit.Chem import AllChem
 from rdkit.Chem.AllChem import MolFromSmiles, MolToInchiKey
 
+from api.cache import SQLiteCache, TieredCache, TTLCache
+from api.molecules import parse_structure
+from api.queries import INCHIKEY_BLOCK1, inchikey_block1_in_filter
+
+# Fields of reference compounds used to pick the best one and its xrefs
+REF_PROJECTION = {
+    'Inchikey': 1,
+    INCHIKEY_BLOCK1: 1,
+    'cross_references': 1,
+    'pubchem_id': 1,
+}
+
+# (Cross_References, Names) by InChIKey first block, see get_xref_cache
+_xref_cache = None
+_xref_cache_lock = threading.Lock()
+
 
 def get_smiles_from_mol_string(mol_string):
-    """Convert a molfile in string format to a SMILES string."""
-    mol = AllChem.MolFromMolBlock(mol_string)
-    smiles = AllChem.MolToSmiles(mol)
+    """Convert a molfile in string format to a SMILES string (cached, see
+    api.molecules.parse_structure)."""
+    smiles = parse_structure(mol_string).smiles
 
     return smiles
 
 
-def get_extra_info(db, core_db, ref_db, compounds):
-    """Look up compounds in core database to get spectra, fingerprints,
-    and DB Links."""
+def get_xref_cache():
+    """Get the cross-reference cache of this process, creating it from the
+    app config on first use."""
+    global _xref_cache  # pylint: disable=global-statement
+    if _xref_cache is None:
+        with _xref_cache_lock:
+            if _xref_cache is None:
+                cache = TTLCache(app.config['XREF_CACHE_SIZE'], app.config['XREF_CACHE_TTL'])
+                if app.config['XREF_CACHE_PATH']:
+                    cache = TieredCache(cache, SQLiteCache(app.config['XREF_CACHE_PATH'],
+                                                           app.config['XREF_CACHE_TTL']))
+                _xref_cache = cache
+    return _xref_cache
 
-    cpd_ids = []
-    final_compounds = {}
-    for cpd in compounds:
-        cpd_ids.append(cpd['_id'])
 
-        mol = MolFromSmiles(cpd['SMILES'])
-        inchi_key = MolToInchiKey(mol)
-        key_prefix = inchi_key.split('-')[0]
-
-        ref_cpds = ref_db.data.find({'Inchikey': {'$regex': r'^' + key_prefix}})
-        best_ref_cpd = _get_best_ref_cpd(ref_cpds)
-        if best_ref_cpd:
-            cpd['Cross_References'], cpd['Names'] = _get_xrefs(best_ref_cpd)
+def get_extra_info(db, core_db, ref_db, compounds):
+    """Look up compounds in core database to get spectra, fingerprints,
+    and DB Links.
+
+    Cross-references and names are cached by InChIKey first block (see
+    get_xref_cache). Reference compounds of the uncached blocks are fetched
+    with one query, then grouped and resolved in memory."""
+
+    final_compounds = {cpd['_id']: cpd for cpd in compounds}
+    core_compounds = {x['_id']: x for x in core_db.compounds.find(
+        {'_id': {'$in': list(final_compounds)}}
+    )}
+
+    # Use stored InChIKeys, only computing them for compounds without one
+    inchi_keys = {}
+    for cpd_id, cpd in final_compounds.items():
+        core_cpd = core_compounds.get(cpd_id, {})
+        inchi_key = cpd.get('Inchikey') or cpd.get('InChI_key') or core_cpd.get('Inchikey')
+        if not inchi_key and cpd.get('SMILES'):
+            mol = MolFromSmiles(cpd['SMILES'])
+            inchi_key = MolToInchiKey(mol) if mol else None
+        if inchi_key:
+            inchi_keys[cpd_id] = inchi_key
+
+    xref_cache = get_xref_cache()
+    xrefs_by_block1 = {}
+    uncached = []
+    for block1 in {inchi_key.split('-')[0] for inchi_key in inchi_keys.values()}:
+        cached = xref_cache.get(block1)
+        if cached is None:
+            uncached.append(block1)
         else:
-            cpd['Cross_References'] = {}
-            cpd['Names'] = []
-
-        final_compounds[cpd['_id']] = cpd
+            xrefs_by_block1[block1] = cached
+
+    if uncached:
+        ref_cpds_by_block1 = {}
+        for ref_cpd in ref_db.data.find(
+            inchikey_block1_in_filter(ref_db.data, uncached, 'Inchikey'), REF_PROJECTION
+        ):
+            block1 = ref_cpd.get(INCHIKEY_BLOCK1) or ref_cpd['Inchikey'].split('-')[0]
+            ref_cpds_by_block1.setdefault(block1, []).append(ref_cpd)
+        for block1 in uncached:
+            best_ref_cpd = _get_best_ref_cpd(ref_cpds_by_block1.get(block1, []))
+            if best_ref_cpd:
+                xrefs_by_block1[block1] = get_xrefs(best_ref_cpd)
+            else:
+                xrefs_by_block1[block1] = ({}, [])
+            xref_cache.put(block1, xrefs_by_block1[block1])
 
-    core_compounds = core_db.compounds.find({'_id': {'$in': cpd_ids}})
+    for cpd_id, cpd in final_compounds.items():
+        block1 = inchi_keys[cpd_id].split('-')[0] if cpd_id in inchi_keys else None
+        xrefs, names = xrefs_by_block1.get(block1, ({}, []))
+        # Copy, cached values are shared between requests
+        cpd['Cross_References'] = dict(xrefs)
+        cpd['Names'] = list(names)
 
-    for core_cpd in core_compounds:
-        cpd_id = core_cpd['_id']
+    for cpd_id, core_cpd in core_compounds.items():
         final_cpd = final_compounds[cpd_id]
         final_cpd['Mass'] = core_cpd['Mass']
         final_cpd['Charge'] = core_cpd['Charge']
@@ -76,24 +138,25 @@ def _get_best_ref_cpd(ref_cpds):
     return best_ref_cpd
 
 
-def _get_xrefs(cpd_dict):
-    """Get cross-references and names for compound."""
+def get_xrefs(cpd_dict):
+    """Get cross-references and names for compound (also used to build the
+    xref_ids collection, see api.build xref-ids)."""
     if not cpd_dict:
         return None, None
     xrefs = {}
-    names = set()
+    # First spelling of each name, keyed by its lower case form
+    names = {}
     if 'cross_references' in cpd_dict:
         for xref in cpd_dict['cross_references']:
             if _description_is_valid(xref['description']):
                 xrefs[xref['source']] = xref['source_id']
                 for name in xref['description'].split('||'):
-                    if name.lower() not in [n.lower() for n in names]:
-                        names.add(name)
+                    names.setdefault(name.lower(), name)
 
     if 'pubchem_id' in cpd_dict:
         xrefs['pubchem_id'] = str(cpd_dict['pubchem_id'])
 
-    return (xrefs, list(names))
+    return (xrefs, list(names.values()))
 
 
 def _description_is_valid(description):
@@ -0,0 +1,96 @@
+"""Benchmark exact structure lookups by InChIKey first block.
+
+For a sample of InChIKeys from a MINE, times the anchored regex lookup that
+structure_search used to run against the equality lookup on the precomputed
+inchikey_block1 field, and reports the documents each examined (from
+explain) and latency percentiles. Both lookups must find the same compounds.
+
+Run from the MINE-Server directory after "python -m api.build inchikey-block1":
+
+    python benchmarks/bench_inchikey_lookup.py <mine_name> [--sample 500]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from api.queries import INCHIKEY_BLOCK1  # noqa: E402
+
+
+def time_lookups(collection, queries, repeats):
+    """Run each query repeats times, returning latencies in ms and the ids
+    found by each query."""
+    latencies = []
+    found = []
+    for query in queries:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            ids = [x["_id"] for x in collection.find(query, {"_id": 1})]
+            latencies.append((time.perf_counter() - start) * 1000)
+        found.append(sorted(ids))
+    return latencies, found
+
+
+def docs_examined(collection, query):
+    """Get the number of documents and index keys a query examines."""
+    stats = collection.find(query).explain()["executionStats"]
+    return stats["totalDocsExamined"], stats["totalKeysExamined"]
+
+
+def main():
+    """Time regex and equality lookups for sampled keys and print a
+    summary."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("mine_name", help="Name of the MINE to query")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017",
+                        help="URI of the MINE MongoDB")
+    parser.add_argument("--sample", type=int, default=500,
+                        help="Number of InChIKeys to look up")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of times each lookup is run")
+    args = parser.parse_args()
+
+    compounds = pymongo.MongoClient(args.mongo_uri)[args.mine_name].compounds
+    keys = [x["InChI_key"] for x in compounds.aggregate([
+        {"$match": {"InChI_key": {"$type": "string"}}},
+        {"$sample": {"size": args.sample}},
+        {"$project": {"InChI_key": 1}},
+    ])]
+    if not keys:
+        sys.exit(f"No compounds with InChI_key in {args.mine_name}")
+    blocks = [key.split("-")[0] for key in keys]
+
+    lookups = {
+        "regex": [{"InChI_key": {"$regex": "^" + block}} for block in blocks],
+        "equality": [{INCHIKEY_BLOCK1: block} for block in blocks],
+    }
+    found = {}
+    print(f"{len(keys)} InChIKeys from {args.mine_name}, {args.repeats} repeats each")
+    print()
+    print(f"{'lookup':<10} {'docs/query':>11} {'keys/query':>11} {'median ms':>10} "
+          f"{'p95 ms':>8} {'max ms':>8}")
+    for name, queries in lookups.items():
+        examined = [docs_examined(compounds, query) for query in queries[:50]]
+        latencies, found[name] = time_lookups(compounds, queries, args.repeats)
+        latencies.sort()
+        print(f"{name:<10} {statistics.mean(x[0] for x in examined):>11.1f} "
+              f"{statistics.mean(x[1] for x in examined):>11.1f} "
+              f"{statistics.median(latencies):>10.3f} "
+              f"{latencies[int(0.95 * (len(latencies) - 1))]:>8.3f} {latencies[-1]:>8.3f}")
+
+    mismatches = sum(a != b for a, b in zip(found["regex"], found["equality"]))
+    print()
+    if mismatches:
+        print(f"{mismatches} lookups found different compounds, rerun "
+              f"'python -m api.build inchikey-block1 --force'")
+    else:
+        print("Both lookups found the same compounds for every key")
+
+
+if __name__ == "__main__":
+    main()
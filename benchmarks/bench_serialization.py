@@ -0,0 +1,133 @@
+"""Benchmark JSON serialization of compound documents.
+
+Times serializing a list of compound documents the way Flask 1.1's jsonify
+does (stdlib json with sorted keys) against api.serialization.dumps with
+orjson and with its stdlib fallback. Documents are synthetic compounds with
+RDKit_fp arrays and CFM-ID spectra, or real compounds of a MINE with --mine.
+
+Run from the MINE-Server directory:
+
+    python benchmarks/bench_serialization.py [--n-docs 1000] [--mine <mine_name>]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from api import serialization  # noqa: E402
+
+
+def synthetic_compounds(n_docs, seed=0):
+    """Make compound documents shaped like those get-comps returns."""
+    rng = random.Random(seed)
+    compounds = []
+    for i in range(n_docs):
+        n_bits = rng.randint(100, 400)
+        compounds.append({
+            "_id": "C" + "%040x" % rng.getrandbits(160),
+            "MINE_id": i,
+            "SMILES": "OCC1OC(O)C(O)C(O)C1O",
+            "Inchikey": "WQZGKKKJIJFFOK-GASJEMHNSA-N",
+            "Formula": "C6H12O6",
+            "Mass": rng.uniform(50, 900),
+            "Charge": 0,
+            "logP": rng.uniform(-5, 5),
+            "Generation": rng.randint(0, 3),
+            "Names": ["Glucose", "D-Glucose", "Dextrose"],
+            "RDKit_fp": sorted(rng.sample(range(512), min(n_bits, 512))),
+            "len_RDKit_fp": n_bits,
+            "Product_of": ["R" + "%040x" % rng.getrandbits(160) for _ in range(5)],
+            "Spectra": {
+                f"{mode} CFM-ID Spectrum": {
+                    energy: [[round(rng.uniform(10, 900), 4), round(rng.uniform(0, 100), 2)]
+                             for _ in range(rng.randint(20, 80))]
+                    for energy in ["10 V", "20 V", "40 V"]
+                }
+                for mode in ["Positive", "Negative"]
+            },
+        })
+    return compounds
+
+
+def mine_compounds(mongo_uri, mine_name, n_docs):
+    """Sample compound documents of a MINE."""
+    import pymongo  # pylint: disable=import-outside-toplevel
+    compounds = pymongo.MongoClient(mongo_uri)[mine_name].compounds
+    return list(compounds.aggregate([{"$sample": {"size": n_docs}}]))
+
+
+def stdlib_jsonify(docs):
+    """Serialize like Flask 1.1 jsonify (outside debug mode)."""
+    return json.dumps(docs, sort_keys=True, separators=(",", ":"),
+                      default=serialization._default).encode()  # pylint: disable=protected-access
+
+
+def stdlib_fallback(docs):
+    """Serialize with api.serialization.dumps without orjson."""
+    orjson = serialization.orjson
+    serialization.orjson = None
+    try:
+        return serialization.dumps(docs)
+    finally:
+        serialization.orjson = orjson
+
+
+def time_serializer(serialize, docs, repeats):
+    """Run serialize repeats times, returning latencies in ms and the output
+    size in bytes."""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        data = serialize(docs)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, len(data)
+
+
+def main():
+    """Time each serializer and print a summary."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-docs", type=int, default=1000,
+                        help="Number of compound documents per response")
+    parser.add_argument("--repeats", type=int, default=20,
+                        help="Number of times each serializer is run")
+    parser.add_argument("--mine", help="Sample documents from this MINE instead of "
+                                       "making synthetic ones")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017",
+                        help="URI of the MINE MongoDB")
+    args = parser.parse_args()
+
+    if args.mine:
+        docs = mine_compounds(args.mongo_uri, args.mine, args.n_docs)
+    else:
+        docs = synthetic_compounds(args.n_docs)
+
+    serializers = {"jsonify": stdlib_jsonify, "fallback": stdlib_fallback}
+    if serialization.orjson is not None:
+        serializers["orjson"] = serialization.dumps
+    else:
+        print("orjson is not installed, only timing the stdlib serializers")
+
+    print(f"{len(docs)} compound documents, {args.repeats} repeats each")
+    print()
+    print(f"{'serializer':<10} {'size MB':>8} {'median ms':>10} {'p95 ms':>8} {'MB/s':>8}")
+    medians = {}
+    for name, serialize in serializers.items():
+        latencies, size = time_serializer(serialize, docs, args.repeats)
+        latencies.sort()
+        medians[name] = statistics.median(latencies)
+        print(f"{name:<10} {size / 1e6:>8.2f} {medians[name]:>10.2f} "
+              f"{latencies[int(0.95 * (len(latencies) - 1))]:>8.2f} "
+              f"{size / 1e6 / (medians[name] / 1000):>8.1f}")
+
+    if "orjson" in medians:
+        print()
+        print(f"orjson is {medians['jsonify'] / medians['orjson']:.1f}x faster than jsonify")
+
+
+if __name__ == "__main__":
+    main()
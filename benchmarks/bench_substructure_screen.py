@@ -0,0 +1,113 @@
+"""Benchmark substructure screening fingerprints.
+
+For each query in a query set, reports how many compounds of a MINE pass the
+RDKit_fp and Pattern_fp screens, the screen-out ratio of each (fraction of
+compounds that never reach HasSubstructMatch), and how many survivors really
+contain the query. A screen is leaky if it drops compounds that contain the
+query, these are reported as missed.
+
+Run from the MINE-Server directory after "python -m api.build pattern-fp":
+
+    python benchmarks/bench_substructure_screen.py <mine_name> [--queries queries.txt]
+"""
+import argparse
+import os
+import sys
+import time
+
+import pymongo
+from rdkit.Chem import AllChem
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from api.fingerprints import BitPostings, FingerprintIndex  # noqa: E402
+from api.molecules import screen_fp_bits  # noqa: E402
+
+DEFAULT_QUERIES = [
+    "C",
+    "CO",
+    "C(=O)O",
+    "CC(=O)N",
+    "O=P(O)(O)O",
+    "c1ccccc1",
+    "c1ccncc1",
+    "OC1COC(O)C(O)C1O",
+    "Nc1ncnc2c1ncn2",
+    "CCCCCCCCCCCC(=O)O",
+]
+
+FP_TYPES = ["RDKit_fp", "Pattern_fp"]
+
+
+def main():
+    """Screen each query against a MINE with both fingerprints and print a
+    table of results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("mine_name", help="Name of the MINE to screen")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017",
+                        help="URI of the MINE MongoDB")
+    parser.add_argument("--core-db", default="core", help="Name of the core database")
+    parser.add_argument("--queries", help="File with one query SMILES per line")
+    args = parser.parse_args()
+
+    if args.queries:
+        with open(args.queries) as infile:
+            queries = [line.strip() for line in infile if line.strip()]
+    else:
+        queries = DEFAULT_QUERIES
+
+    core_db = pymongo.MongoClient(args.mongo_uri)[args.core_db]
+    postings = {}
+    for fp_type in FP_TYPES:
+        start = time.perf_counter()
+        postings[fp_type] = BitPostings(FingerprintIndex.from_mongo(core_db, args.mine_name,
+                                                                    fp_type))
+        print(f"Built {fp_type} postings over {len(postings[fp_type])} compounds in "
+              f"{time.perf_counter() - start:.1f} s")
+    smiles = {x["_id"]: x["SMILES"] for x in core_db.compounds.find(
+        {"MINES": args.mine_name}, {"SMILES": 1}
+    )}
+
+    print()
+    print(f"{'query':<24} {'fp':<11} {'survivors':>10} {'screen-out':>11} "
+          f"{'matches':>8} {'precision':>10} {'missed':>7} {'screen ms':>10}")
+    totals = {fp_type: [0, 0] for fp_type in FP_TYPES}
+    for query in queries:
+        mol = AllChem.MolFromSmiles(query)
+        if not mol:
+            print(f"{query:<24} unable to parse, skipped")
+            continue
+
+        survivors = {}
+        screen_ms = {}
+        for fp_type in FP_TYPES:
+            start = time.perf_counter()
+            survivors[fp_type] = set(postings[fp_type].screen_ids(screen_fp_bits(mol, fp_type)))
+            screen_ms[fp_type] = (time.perf_counter() - start) * 1000
+
+        matches = set()
+        for cpd_id in survivors["RDKit_fp"] | survivors["Pattern_fp"]:
+            comp = AllChem.MolFromSmiles(smiles.get(cpd_id, ""))
+            if comp and comp.HasSubstructMatch(mol):
+                matches.add(cpd_id)
+
+        for fp_type in FP_TYPES:
+            n_compounds = len(postings[fp_type])
+            n_survivors = len(survivors[fp_type])
+            n_matches = len(matches & survivors[fp_type])
+            totals[fp_type][0] += n_survivors
+            totals[fp_type][1] += n_matches
+            print(f"{query[:24]:<24} {fp_type:<11} {n_survivors:>10} "
+                  f"{1 - n_survivors / max(n_compounds, 1):>11.4f} {n_matches:>8} "
+                  f"{n_matches / max(n_survivors, 1):>10.4f} "
+                  f"{len(matches - survivors[fp_type]):>7} {screen_ms[fp_type]:>10.2f}")
+
+    print()
+    for fp_type in FP_TYPES:
+        n_survivors, n_matches = totals[fp_type]
+        print(f"{fp_type}: {n_survivors} survivors reach HasSubstructMatch in total, "
+              f"{n_matches / max(n_survivors, 1):.4f} of them match")
+
+
+if __name__ == "__main__":
+    main()
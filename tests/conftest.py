@@ -1,4 +1,6 @@
-"""Define app here for pytest-flask."""
+"""Define app here for pytest-flask, and fixtures shared by test modules."""
+
+import random
 
 import pytest
 
@@ -6,6 +8,7 @@ import pytest
 # Change the below <...> and uncomment if you want to use VSCode test debugger
 # import os
 # os.environ['PATH'] += r";<...>\Anaconda3\envs\MINE\Library\bin"
+from api import fingerprints
 from api.run import create_app
 
 
@@ -14,3 +17,63 @@ def app():
     """Create app. This fixture is required for pytest-flask plugin."""
     application = create_app()
     return application
+
+
+@pytest.fixture
+def fp_lists():
+    """Random 512 bit fingerprints (as lists of on-bits) for 500 compounds."""
+    rng = random.Random(42)
+    return [sorted(rng.sample(range(fingerprints.FP_SIZE), rng.randint(1, 200)))
+            for _ in range(500)]
+
+
+class FakeCompounds(object):
+    """In-memory stand-in for the core compounds collection, with only the
+    queries write_fp_store makes (on compounds that all have RDKit_fp)."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def distinct(self, field):
+        return sorted({value for doc in self.docs for value in doc.get(field, [])})
+
+    def count_documents(self, query):
+        return len(self.docs)
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def aggregate(self, pipeline):
+        return [{"_id": None, "width": max(len(doc["_id"].encode()) for doc in self.docs)}]
+
+    def find(self, query, projection, batch_size=None):
+        return self
+
+    def sort(self, field, direction):
+        return iter(sorted(self.docs, key=lambda doc: doc[field]))
+
+
+class FakeCoreDb(object):
+    """In-memory stand-in for the core database."""
+
+    name = "core"
+
+    def __init__(self, docs):
+        self.compounds = FakeCompounds(docs)
+
+
+@pytest.fixture
+def fake_core_db(fp_lists):
+    """In-memory core database with compounds of fp_lists, even ones in the
+    KEGG MINE and all of them in the EcoCyc MINE."""
+    return FakeCoreDb([{"_id": f"C{i:040d}", "RDKit_fp": fp, "len_RDKit_fp": len(fp),
+                        "MINES": ["EcoCyc", "KEGG"] if i % 2 == 0 else ["EcoCyc"]}
+                       for i, fp in enumerate(fp_lists)])
+
+
+@pytest.fixture
+def fp_store_path(fake_core_db, fp_lists, tmp_path):
+    """Path to a fingerprint store of fake_core_db."""
+    path = str(tmp_path / "fps.store")
+    assert fingerprints.write_fp_store(fake_core_db, path) == len(fp_lists)
+    return path
@@ -47,6 +47,25 @@ def assert_response_fields(response, status_code=200):
         assert response.json
 
 
+def read_ndjson(response):
+    """Read the documents of a streamed NDJSON response, and the final
+    truncation marker if the stream was cut short.
+
+    Returns
+    -------
+    docs : list
+        Documents of the stream.
+    marker : dict
+        The {"truncated": true, "next_token": ...} line, None if absent.
+    """
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    docs = [json.loads(line) for line in response.data.splitlines()]
+    if docs and docs[-1].get('truncated') is True:
+        return docs[:-1], docs[-1]
+    return docs, None
+
+
 def post_json(client, url, json_dict):
     """Send form data as a json to the specified url in a post request.
 
@@ -123,6 +142,38 @@ def test_similarity_search_api(client, mol_str):
     response = post_json(client, url, json_dict)
     assert_response_fields(response)
 
+    # ranked is parsed the same way from JSON data as from the query string
+    url = url_for('mineserver_api.similarity_search_api', db_name='mongotest',
+                  min_tc=0.1, limit=5)
+    for ranked, is_ranked in [(True, True), ('true', True), (1, True), ('false', False),
+                              ('0', False), (False, False)]:
+        response = post_json(client, url, {'mol': mol_str, 'ranked': ranked})
+        assert_response_fields(response)
+        assert all(('Tanimoto' in cpd) == is_ranked for cpd in response.json)
+
+
+@valid_db
+def test_similarity_search_batch_api(client, mol_str):
+    """
+    GIVEN several compounds to query using batch similarity search via the API
+    WHEN a response is received
+    THEN make sure the response is healthy and has results for every query
+    """
+    smiles = r'Nc1ncnc2c1ncn2[C@@H]1O[C@H](COP(=O)(O)OP(=O)(O)O)[C@@H](O)' \
+             r'[C@H]1O'
+    url = url_for('mineserver_api.similarity_search_batch_api', db_name='mongotest')
+    json_dict = {'structures': [smiles, mol_str], 'min_tc': 0.1, 'limit': 5}
+    response = post_json(client, url, json_dict)
+    assert_response_fields(response)
+    assert set(response.json) == {smiles, mol_str}
+
+    response = post_json(client, url, {'min_tc': 0.1})
+    assert_response_fields(response, status_code=400)
+    for bad_args in [{'min_tc': 'high'}, {'min_tc': 0}, {'min_tc': 1.5}, {'limit': 'all'},
+                     {'limit': 0}]:
+        response = post_json(client, url, dict(json_dict, **bad_args))
+        assert_response_fields(response, status_code=400)
+
 
 @valid_db
 def test_structure_search_api(client, mol_str):
@@ -206,6 +257,33 @@ def test_database_query_api(client):
     assert_response_fields(response)
 
 
+@valid_db
+def test_database_query_api_stream(client):
+    """
+    GIVEN a direct query (using Mongo syntax) to a MINE DB
+    WHEN its results are streamed, with enough time and with too little
+    THEN make sure the stream has the results of the query, and a truncated
+        stream ends with a token that resumes it
+    """
+    query = '{"MINE_id": {"$gte": 0}}'
+    url = url_for('mineserver_api.database_query_api', db_name='mongotest',
+                  mongo_query=query)
+    compounds = client.get(url, query_string={'page_size': 1000}).json
+    assert compounds
+
+    docs, marker = read_ndjson(client.get(url, query_string={'stream': 1}))
+    assert marker is None
+    assert [doc['_id'] for doc in docs] == [cpd['_id'] for cpd in compounds]
+
+    docs, marker = read_ndjson(client.get(url, query_string={'stream': 1,
+                                                             'time_ms': 0.001}))
+    assert marker is not None and marker['next_token']
+    rest, marker = read_ndjson(client.get(url, query_string={
+        'stream': 1, 'token': marker['next_token']}))
+    assert marker is None
+    assert [doc['_id'] for doc in docs + rest] == [cpd['_id'] for cpd in compounds]
+
+
 @valid_db
 def test_get_ids_api(client):
     """
@@ -225,6 +303,24 @@ def test_get_ids_api(client):
     assert_response_fields(response)
 
 
+@valid_db
+def test_get_ids_api_stream(client):
+    """
+    GIVEN a MINE DB and collection name within that DB
+    WHEN all IDs are requested as a stream of newline delimited JSON
+    THEN make sure the stream has the same ids as the JSON response
+    """
+    url = url_for('mineserver_api.get_ids_api', db_name='mongotest',
+                  collection_name='compounds')
+    ids = json.loads(client.get(url).data)
+
+    for response in [client.get(url, query_string={'stream': 1}),
+                     client.get(url, headers={'Accept': 'application/x-ndjson'})]:
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert [json.loads(line) for line in response.data.splitlines()] == ids
+
+
 @valid_db
 def test_get_comps_api(client):
     """
@@ -270,6 +366,60 @@ def test_get_ops_api(client):
     assert_response_fields(response)
 
 
+@valid_db
+def test_get_ops_api_stream(client):
+    """
+    GIVEN a MINE DB
+    WHEN operators are requested as a stream of newline delimited JSON
+    THEN make sure the stream has the same operators as the JSON response
+    """
+    url = url_for('mineserver_api.get_ops_api', db_name='mongotest')
+    ops = post_json(client, url, None).json
+
+    url = url_for('mineserver_api.get_ops_api', db_name='mongotest', stream=1)
+    docs, marker = read_ndjson(post_json(client, url, None))
+    assert marker is None
+    assert docs == ops
+
+
+@valid_db
+@pytest.mark.parametrize('endpoint,collection', [
+    ('mineserver_api.get_rxns_product_of_api', 'product_of'),
+    ('mineserver_api.get_rxns_reactant_in_api', 'reactant_in'),
+])
+def test_get_rxns_for_cpd_api_stream(client, endpoint, collection):
+    """
+    GIVEN a compound of a MINE DB that reactions produce or consume
+    WHEN its reactions are requested all at once, streamed with enough time
+        and streamed with too little
+    THEN make sure the stream has the same reactions as the full list, and a
+        truncated stream ends with a token that resumes it
+    """
+    rxn_list_doc = pymongo.MongoClient().mongotest[collection].find_one()
+    if rxn_list_doc is None:
+        pytest.skip(f"No {collection} documents in mongotest")
+    url = url_for(endpoint, db_name='mongotest', cpd_id=rxn_list_doc['c_id'])
+    response = client.get(url)
+    assert_response_fields(response)
+    rxns = response.json
+    assert response.headers['X-Total-Count'] == str(len(rxns))
+
+    docs, marker = read_ndjson(client.get(url, query_string={'stream': 1}))
+    assert marker is None
+    assert docs == rxns
+
+    docs, marker = read_ndjson(client.get(url, query_string={'stream': 1,
+                                                             'time_ms': 0.001}))
+    assert marker is not None and marker['next_token']
+    rest, marker = read_ndjson(client.get(url, query_string={
+        'stream': 1, 'token': marker['next_token']}))
+    assert marker is None
+    assert docs + rest == rxns
+
+    response = client.get(url, query_string={'fields': 'Operators,$where'})
+    assert_response_fields(response, status_code=400)
+
+
 @valid_db
 def test_get_op_w_rxns_api(client):
     """
@@ -0,0 +1,90 @@
+"""Tests for autocomplete.py using pytest."""
+# pylint: disable=redefined-outer-name
+
+import pymongo
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+from api import autocomplete
+from api.autocomplete import NameIndex, get_name_index
+from api.queries import INCHIKEY_BLOCK1, XREF_ID_COLLECTION
+
+try:
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    client.server_info()
+    del client
+    is_mongo = True
+except ServerSelectionTimeoutError as err:
+    is_mongo = False
+
+valid_db = pytest.mark.skipif(not is_mongo, reason="No MongoDB Connection")
+
+
+@pytest.fixture
+def name_dbs():
+    """(MINE, core, references) databases with glucose in the MINE."""
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    mine_db = client["mongotest_names_mine"]
+    core_db = client["mongotest_names_core"]
+    ref_db = client["mongotest_names_ref"]
+    mine_db.compounds.insert_one({"_id": "C1", "Inchikey": "WQZGKKKJIJFFOK-GASJEMHNSA-N"})
+    core_db.compounds.insert_many([
+        {"_id": "C1", "Inchikey": "WQZGKKKJIJFFOK-GASJEMHNSA-N", "MINES": [mine_db.name]},
+        {"_id": "C2", "Inchikey": "DHMQDGOQFOQNFH-UHFFFAOYSA-N", "MINES": []},
+    ])
+    ref_db[XREF_ID_COLLECTION].insert_many([
+        {"source": "name", "source_id": "glucose", "name": "Glucose",
+         INCHIKEY_BLOCK1: "WQZGKKKJIJFFOK"},
+        {"source": "name", "source_id": "glycine", "name": "Glycine",
+         INCHIKEY_BLOCK1: "DHMQDGOQFOQNFH"},
+    ])
+    autocomplete._name_indexes.clear()
+    yield mine_db, core_db, ref_db
+    autocomplete._name_indexes.clear()
+    for db in [mine_db, core_db, ref_db]:
+        client.drop_database(db.name)
+
+
+def test_name_index_complete():
+    """
+    GIVEN an index of compound names
+    WHEN names are completed from a prefix
+    THEN make sure matching names are returned in order, up to the limit
+    """
+    name_index = NameIndex(["Glucose", "D-Glucose", "glucose 6-phosphate", "Glycine",
+                            "Glucose", "ATP"])
+
+    assert len(name_index) == 5
+    assert name_index.complete("gluc") == ["Glucose", "glucose 6-phosphate"]
+    assert name_index.complete("GL", limit=2) == ["Glucose", "glucose 6-phosphate"]
+    assert name_index.complete("gly") == ["Glycine"]
+    assert name_index.complete("zzz") == []
+    assert name_index.complete("") == ["ATP", "D-Glucose", "Glucose", "glucose 6-phosphate",
+                                       "Glycine"]
+
+
+@valid_db
+def test_get_name_index(name_dbs):
+    """
+    GIVEN a MINE and the xref_ids map
+    WHEN its name index is requested
+    THEN make sure it only has names of the MINE's compounds, is rebuilt
+        when the map changes and that unknown MINEs have no index
+    """
+    mine_db, core_db, ref_db = name_dbs
+    name_index = get_name_index(core_db, ref_db, mine_db, 60)
+    assert name_index.complete("gl") == ["Glucose"]
+    assert get_name_index(core_db, ref_db, mine_db, 60) is name_index
+
+    ref_db[XREF_ID_COLLECTION].insert_one({"source": "name", "source_id": "dextrose",
+                                           "name": "Dextrose",
+                                           INCHIKEY_BLOCK1: "WQZGKKKJIJFFOK"})
+    # Not checked again before the interval is over
+    assert get_name_index(core_db, ref_db, mine_db, 60) is name_index
+    name_index = get_name_index(core_db, ref_db, mine_db, 0)
+    assert name_index.complete("") == ["Dextrose", "Glucose"]
+    # Unchanged data keeps the index
+    assert get_name_index(core_db, ref_db, mine_db, 0) is name_index
+
+    unknown_db = pymongo.MongoClient()["mongotest_names_unknown"]
+    assert get_name_index(core_db, ref_db, unknown_db, 60) is None
@@ -0,0 +1,128 @@
+"""Tests for build.py using pytest."""
+# pylint: disable=redefined-outer-name
+
+import argparse
+
+import pymongo
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+from api import build, operators, queries
+from api.utils import get_xrefs
+
+try:
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    client.server_info()
+    del client
+    is_mongo = True
+except ServerSelectionTimeoutError as err:
+    is_mongo = False
+
+valid_db = pytest.mark.skipif(not is_mongo, reason="No MongoDB Connection")
+
+GLUCOSE_INCHIKEY = "WQZGKKKJIJFFOK-GASJEMHNSA-N"
+
+
+@pytest.fixture
+def glucose_ref():
+    """Reference compound of glucose, as stored in the references database."""
+    return {
+        "_id": "ref_glucose",
+        "Inchikey": GLUCOSE_INCHIKEY,
+        "pubchem_id": 5793,
+        "cross_references": [
+            {"source": "seed", "source_id": "cpd00027", "description": "D-Glucose||Glucose"},
+            {"source": "kegg", "source_id": "C00031", "description": "D-Glucose"},
+            {"source": "obsolete", "source_id": "cpd99999",
+             "description": "secondary/obsolete/fantasy identifier"},
+        ],
+    }
+
+
+@pytest.fixture
+def xref_dbs(glucose_ref):
+    """(MINE, core, references) databases with glucose in them."""
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    mine_db = client["mongotest_xref_mine"]
+    core_db = client["mongotest_xref_core"]
+    ref_db = client["mongotest_xref_ref"]
+    core_db.compounds.insert_one({"_id": "C" + "0" * 40, "Inchikey": GLUCOSE_INCHIKEY,
+                                  "MINES": [mine_db.name]})
+    ref_db.data.insert_many([glucose_ref, {"_id": "ref_no_key"}])
+    yield mine_db, core_db, ref_db
+    for db in [mine_db, core_db, ref_db]:
+        client.drop_database(db.name)
+
+
+def test_get_xrefs(glucose_ref):
+    """
+    GIVEN a reference compound
+    WHEN its cross-references and names are read
+    THEN make sure obsolete ids are dropped and names are deduplicated
+    """
+    xrefs, names = get_xrefs(glucose_ref)
+    assert xrefs == {"seed": "cpd00027", "kegg": "C00031", "pubchem_id": "5793"}
+    assert names == ["D-Glucose", "Glucose"]
+    assert get_xrefs(None) == (None, None)
+
+
+@valid_db
+def test_build_xref_ids(xref_dbs):
+    """
+    GIVEN a references database
+    WHEN the xref_ids collection is built from it
+    THEN make sure each cross-reference id and lower case name maps to the
+        InChIKey first block of its compound, and quick search finds the
+        compound by them
+    """
+    mine_db, core_db, ref_db = xref_dbs
+    build.build_xref_ids(pymongo.MongoClient(),
+                         argparse.Namespace(ref_db=ref_db.name, batch_size=2))
+
+    assert queries.XREF_ID_COLLECTION + "_build" not in ref_db.list_collection_names()
+    entries = {x["source_id"]: x for x in ref_db[queries.XREF_ID_COLLECTION].find()}
+    assert set(entries) == {"cpd00027", "C00031", "5793", "d-glucose", "glucose"}
+    assert {x[queries.INCHIKEY_BLOCK1] for x in entries.values()} == {"WQZGKKKJIJFFOK"}
+    assert entries["cpd00027"]["source"] == "seed"
+    assert entries["glucose"]["name"] == "Glucose"
+
+    for query in ["cpd00027", "5793", "Glucose", "D-GLUCOSE"]:
+        results = queries.quick_search(mine_db, core_db, query, {"_id": 1}, ref_db=ref_db)
+        assert results == [{"_id": "C" + "0" * 40}]
+    assert queries.quick_search(mine_db, core_db, "cpd99999", {"_id": 1}, ref_db=ref_db) == []
+    # Rebuilding replaces the collection
+    build.build_xref_ids(pymongo.MongoClient(),
+                         argparse.Namespace(ref_db=ref_db.name, batch_size=100))
+    assert ref_db[queries.XREF_ID_COLLECTION].count_documents({}) == len(entries)
+
+
+@valid_db
+def test_build_op_rxns():
+    """
+    GIVEN a MINE whose operators have stale reaction counts
+    WHEN the operator reaction index is built
+    THEN make sure each operator gets its reactions and count, and operators
+        without reactions are counted 0
+    """
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    db = client["mongotest_build_op_rxns"]
+    try:
+        db.operators.insert_many([
+            {"_id": "2.7.1.a", "Name": "rule0001", "Reaction_count": 5},
+            {"_id": "1.1.1.a", "Name": "rule0002", "Reaction_count": 5},
+            {"_id": "3.1.1.a", "Name": "rule0003"},
+        ])
+        db.reactions.insert_many([
+            {"_id": "R0", "Operators": ["rule0001"]},
+            {"_id": "R1", "Operators": ["2.7.1.a", "rule0001", "rule0003"]},
+            {"_id": "R2", "Operators": ["rule0003"]},
+        ])
+        build.build_op_rxns(client, argparse.Namespace(mine=[db.name], batch_size=2))
+
+        counts = {x["_id"]: x["Reaction_count"] for x in db.operators.find()}
+        assert counts == {"2.7.1.a": 2, "1.1.1.a": 0, "3.1.1.a": 2}
+        assert operators.OP_RXN_COLLECTION + "_build" not in db.list_collection_names()
+        assert queries.get_op_rxns_page(db, "rule0001", page_size=10)[0]["Reaction_ids"] \
+            == ["R0", "R1"]
+    finally:
+        client.drop_database(db.name)
@@ -0,0 +1,98 @@
+"""Tests for cache.py using pytest."""
+
+from api.cache import LRUCache, SQLiteCache, TieredCache, TTLCache
+
+
+def test_lru_cache_eviction():
+    """
+    GIVEN an LRU cache with a maximum size
+    WHEN more entries than that are added
+    THEN make sure the least recently used entries are evicted
+    """
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_lru_cache_stats():
+    """
+    GIVEN an LRU cache
+    WHEN keys are looked up
+    THEN make sure hits and misses are counted
+    """
+    cache = LRUCache(10)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b", "default") == "default"
+    assert cache.stats() == {"size": 1, "max_size": 10, "hits": 1, "misses": 1}
+
+    cache.clear()
+    assert cache.stats() == {"size": 0, "max_size": 10, "hits": 0, "misses": 0}
+
+    disabled = LRUCache(0)
+    disabled.put("a", 1)
+    assert "a" not in disabled
+
+
+def test_ttl_cache_expiry():
+    """
+    GIVEN a TTL cache
+    WHEN an entry is older than its time to live
+    THEN make sure it is treated as missing
+    """
+    cache = TTLCache(10, ttl=60)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+
+    expired = TTLCache(10, ttl=0)
+    expired.put("a", 1)
+    assert expired.get("a") is None
+    assert "a" not in expired
+    assert expired.stats()["misses"] == 1
+
+
+def test_sqlite_cache(tmp_path):
+    """
+    GIVEN a SQLite cache file
+    WHEN values are put and the file is reopened
+    THEN make sure values survive, expire and can be cleared
+    """
+    path = str(tmp_path / "cache.sqlite")
+    cache = SQLiteCache(path, ttl=60)
+    cache.put("C00031", [{"KEGG": "C00031"}, ["Glucose"]])
+    assert cache.get("C00031") == [{"KEGG": "C00031"}, ["Glucose"]]
+
+    reopened = SQLiteCache(path, ttl=60)
+    assert reopened.get("C00031") == [{"KEGG": "C00031"}, ["Glucose"]]
+    assert reopened.get("missing", "default") == "default"
+    assert reopened.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+    expired = SQLiteCache(str(tmp_path / "expired.sqlite"), ttl=0)
+    expired.put("a", 1)
+    assert expired.get("a") is None
+
+    reopened.clear()
+    assert len(reopened) == 0
+
+
+def test_tiered_cache(tmp_path):
+    """
+    GIVEN a memory cache in front of a SQLite cache
+    WHEN a value is only on disk
+    THEN make sure it is found and copied to memory
+    """
+    disk = SQLiteCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    disk.put("a", [1, 2])
+    cache = TieredCache(TTLCache(10, ttl=60), disk)
+    assert cache.get("a") == [1, 2]
+    assert cache.memory.get("a") == [1, 2]
+
+    cache.put("b", [3])
+    assert disk.get("b") == [3]
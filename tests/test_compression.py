@@ -0,0 +1,107 @@
+"""Tests for compression.py using pytest."""
+# pylint: disable=redefined-outer-name
+
+import gzip
+import json
+import os
+import zlib
+
+import pytest
+from flask import Flask, Response, jsonify
+
+from api import compression
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Minimal app with compression and routes returning large, small and
+    streamed JSON and static files."""
+    app = Flask(__name__)
+    app.config.update(COMPRESSION_ON=True, COMPRESSION_MIN_SIZE=1024,
+                      COMPRESSION_LEVELS={'gzip': 6, 'br': 4, 'zstd': 3},
+                      PRECOMPRESSION_LEVELS={'gzip': 9, 'br': 11, 'zstd': 19})
+    compression.init_compression(app)
+
+    @app.route('/large')
+    def large():
+        return jsonify(list(range(1000)))
+
+    @app.route('/small')
+    def small():
+        return jsonify([1, 2, 3])
+
+    @app.route('/stream')
+    def stream():
+        return Response((json.dumps(i) + '\n' for i in range(1000)),
+                        mimetype='application/x-ndjson')
+
+    @app.route('/static/<name>')
+    def static_file(name):
+        return compression.send_precompressed(str(tmp_path / name), str(tmp_path / 'cache'))
+
+    return app
+
+
+def test_compress_round_trip():
+    """
+    GIVEN data compressed whole and as a stream of chunks
+    WHEN it is decompressed
+    THEN make sure the original data comes back
+    """
+    data = b'{"SMILES": "OCC1OC(O)C(O)C(O)C1O"}\n' * 100
+    assert gzip.decompress(compression.compress(data, 'gzip', 6)) == data
+    chunks = [data[:1000], data[1000:2000], data[2000:]]
+    decompressor = zlib.decompressobj(31)
+    # Each flushed chunk can be decoded on its own
+    for chunk, compressed in zip(chunks, compression.compress_stream(chunks, 'gzip', 6)):
+        assert decompressor.decompress(compressed) == chunk
+
+
+def test_compress_response(app):
+    """
+    GIVEN responses of different sizes, buffered or streamed
+    WHEN a client that accepts gzip requests them
+    THEN make sure large and streamed responses are compressed and small
+        ones aren't
+    """
+    client = app.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+
+    response = client.get('/large', headers=headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data)) == list(range(1000))
+
+    response = client.get('/stream', headers=headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data).splitlines() == [b'%d' % i for i in range(1000)]
+
+    assert 'Content-Encoding' not in client.get('/small', headers=headers).headers
+    assert 'Content-Encoding' not in client.get('/large').headers
+
+
+def test_send_precompressed(app, tmp_path):
+    """
+    GIVEN a compressible and an incompressible static file
+    WHEN a client that accepts gzip requests them
+    THEN make sure the compressible one is sent from a compressed copy in
+        the cache directory and the other one as is
+    """
+    text = b'Adduct name\n' * 1000
+    (tmp_path / 'adducts.txt').write_bytes(text)
+    noise = os.urandom(4096)
+    (tmp_path / 'image.jpg').write_bytes(noise)
+    client = app.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+
+    response = client.get('/static/adducts.txt', headers=headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/plain'
+    assert gzip.decompress(response.data) == text
+    assert (tmp_path / 'cache' / 'adducts.txt.gz').exists()
+
+    response = client.get('/static/image.jpg', headers=headers)
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == noise
+
+    assert client.get('/static/missing.jpg', headers=headers).status_code == 404
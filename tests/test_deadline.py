@@ -0,0 +1,29 @@
+"""Tests for deadline.py using pytest."""
+
+from api.deadline import Deadline
+
+
+def test_deadline_expired():
+    """
+    GIVEN deadlines with and without a time budget
+    WHEN they are checked
+    THEN make sure only a used up budget marks results as truncated
+    """
+    deadline = Deadline(0)
+    assert deadline.expired()
+    assert deadline.truncated
+    assert deadline.remaining_ms() == 0
+    assert deadline.max_time_ms() == 1
+
+    deadline = Deadline(60000)
+    assert not deadline.expired()
+    assert not deadline.truncated
+    assert 0 < deadline.max_time_ms() <= 60000
+    assert 0 < deadline.timeout() <= 60
+
+    deadline = Deadline(None)
+    assert not deadline.expired()
+    assert deadline.remaining_ms() is None
+    assert deadline.max_time_ms() is None
+    assert deadline.timeout() is None
+    assert deadline.elapsed_ms() >= 0
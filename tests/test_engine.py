@@ -0,0 +1,92 @@
+"""Tests for engine.py using pytest."""
+# pylint: disable=redefined-outer-name
+
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from rdkit.Chem import AllChem
+
+from api import engine as engine_module
+from api import fingerprints
+from api.engine import SearchEngine, get_search_engine
+
+# Candidates of substructure searches, those containing "C(=O)O" first
+SMILES = ["CC(=O)O", "CCO", "OC(=O)CC(=O)O", "CC=O", "c1ccccc1C(=O)O", "CCCC", "OC(=O)C=C"]
+
+
+@pytest.fixture
+def engine():
+    """Search engine with 2 worker processes and 4 shards per search."""
+    search_engine = SearchEngine(2, 4)
+    yield search_engine
+    search_engine.shutdown()
+
+
+@pytest.fixture
+def store_index(fp_store_path):
+    """Index of the EcoCyc MINE of a fingerprint store."""
+    return fingerprints.FingerprintStore(fp_store_path).index_for("EcoCyc")
+
+
+def sequential_substructure(sub_structure, candidates, limit):
+    """Candidates containing sub_structure, checked one by one."""
+    mol = AllChem.MolFromSmiles(sub_structure)
+    return [x for x in candidates
+            if AllChem.MolFromSmiles(x["SMILES"]).HasSubstructMatch(mol)][:limit]
+
+
+def assert_same_results(engine, store_index, fp_lists):
+    """Check that engine searches return what sequential searches do."""
+    for query_bits in fp_lists[:3]:
+        assert engine.similarity(store_index, "EcoCyc", query_bits, 0.2, 1000) \
+            == store_index.search(query_bits, 0.2, 1000)
+        assert engine.similarity(store_index, "EcoCyc", query_bits, 0.2, 5) \
+            == store_index.search(query_bits, 0.2, 5)
+        assert engine.similarity(store_index, "EcoCyc", query_bits, 0.1, 10, ranked=True) \
+            == store_index.top_k(query_bits, 0.1, 10)
+
+    candidates = [{"_id": f"C{i}", "SMILES": smiles} for i, smiles in enumerate(SMILES)]
+    for limit in [1, 3, 100]:
+        assert engine.substructure(iter(candidates), "C(=O)O", limit) \
+            == sequential_substructure("C(=O)O", candidates, limit)
+
+
+def test_sharded_search(engine, store_index, fp_lists, monkeypatch):
+    """
+    GIVEN a search engine with 2 worker processes and a fingerprint store
+    WHEN similarity and substructure searches are sharded across it
+    THEN make sure the results are those of single process searches
+    """
+    monkeypatch.setattr(engine_module, "_SUBSTRUCTURE_CHUNK_SIZE", 2)
+    assert_same_results(engine, store_index, fp_lists)
+    assert not engine.broken
+
+
+def test_broken_pool(engine, store_index, fp_lists, monkeypatch):
+    """
+    GIVEN a search engine whose worker processes died
+    WHEN similarity and substructure searches are run on it
+    THEN make sure they fall back to searching in this process
+    """
+    monkeypatch.setattr(engine_module, "_SUBSTRUCTURE_CHUNK_SIZE", 2)
+    with pytest.raises(BrokenProcessPool):
+        engine._executor.submit(os._exit, 1).result()  # pylint: disable=protected-access
+    assert_same_results(engine, store_index, fp_lists)
+    assert engine.broken
+
+
+def test_get_search_engine_fallback(monkeypatch):
+    """
+    GIVEN a system where the worker pool can't be started
+    WHEN the search engine is requested
+    THEN make sure no engine is returned, so searches run in this process
+    """
+    def fail(*args, **kwargs):
+        raise OSError("No semaphores")
+
+    monkeypatch.setattr(engine_module, "_engine", None)
+    monkeypatch.setattr(engine_module, "ProcessPoolExecutor", fail)
+    assert get_search_engine(2, 4) is None
+    assert get_search_engine(2, 4) is None
+    assert get_search_engine(1, 4) is None
@@ -0,0 +1,263 @@
+"""Tests for fingerprints.py using pytest."""
+# pylint: disable=redefined-outer-name
+
+import os
+
+import numpy as np
+import pytest
+
+from api import fingerprints
+from api.deadline import Deadline
+from api.exceptions import StaleStoreError
+
+
+@pytest.fixture
+def fp_index(fp_lists):
+    """Fingerprint index over fp_lists."""
+    ids = [f"C{i:040d}" for i in range(len(fp_lists))]
+    return fingerprints.FingerprintIndex.from_unsorted(ids, fingerprints.pack_fps(fp_lists))
+
+
+def brute_force_tanimoto(query_bits, fp_lists):
+    """Tanimoto scores computed with Python sets, keyed by compound _id."""
+    query_bits = set(query_bits)
+    return {
+        f"C{i:040d}": len(query_bits & set(fp)) / len(query_bits | set(fp))
+        for i, fp in enumerate(fp_lists)
+    }
+
+
+def test_pack_fps(fp_lists):
+    """
+    GIVEN lists of fingerprint on-bits
+    WHEN they are packed into 64 bit words
+    THEN make sure every on-bit ends up in the right word and the popcount
+    matches the number of on-bits
+    """
+    packed = fingerprints.pack_fps(fp_lists)
+    assert packed.shape == (len(fp_lists), fingerprints.FP_WORDS)
+    assert packed.dtype == np.uint64
+    assert list(fingerprints.popcount(packed)) == [len(fp) for fp in fp_lists]
+    for row, fp in zip(packed, fp_lists):
+        unpacked = [bit for bit in range(fingerprints.FP_SIZE)
+                    if int(row[bit // 64]) >> (bit % 64) & 1]
+        assert unpacked == fp
+
+
+def test_index_window(fp_index):
+    """
+    GIVEN a fingerprint index
+    WHEN a popcount window is requested
+    THEN make sure it contains exactly the rows within the length ratio bounds
+    """
+    start, stop = fp_index.window(100, 0.5)
+    counts = list(fp_index.counts)
+    assert all(50 <= count <= 200 for count in counts[start:stop])
+    assert all(count < 50 or count > 200 for count in counts[:start] + counts[stop:])
+
+
+@pytest.mark.parametrize("min_tc", [0.1, 0.3, 0.5])
+def test_index_search(fp_index, fp_lists, min_tc):
+    """
+    GIVEN a fingerprint index
+    WHEN it is searched with a query fingerprint
+    THEN make sure hits and scores match a brute force set calculation
+    """
+    query_bits = fp_lists[0]
+    expected = {cpd_id: score for cpd_id, score
+                in brute_force_tanimoto(query_bits, fp_lists).items() if score >= min_tc}
+    hits = fp_index.search(query_bits, min_tc, len(fp_lists))
+    assert {cpd_id for cpd_id, _ in hits} == set(expected)
+    for cpd_id, score in hits:
+        assert score == pytest.approx(expected[cpd_id])
+
+    assert len(fp_index.search(query_bits, min_tc, 2)) == min(2, len(expected))
+
+
+def test_index_rows(fp_index, fp_lists):
+    """
+    GIVEN a fingerprint index restricted to a subset of rows of shared arrays
+    WHEN it is searched with a query fingerprint
+    THEN make sure only compounds in those rows are returned
+    """
+    rows = np.arange(0, len(fp_index), 2)
+    sub_index = fingerprints.FingerprintIndex(
+        fp_index._ids, fp_index._fps, fp_index.counts, rows=rows
+    )  # pylint: disable=protected-access
+    expected = {fp_index.cpd_id(row) for row in rows}
+    hits = sub_index.search(fp_lists[0], 0.0, len(fp_lists))
+    assert {cpd_id for cpd_id, _ in hits} == expected
+
+
+@pytest.mark.parametrize("k", [1, 5, 50])
+def test_index_top_k(fp_index, fp_lists, k):
+    """
+    GIVEN a fingerprint index
+    WHEN the top k most similar compounds are requested
+    THEN make sure they are the k best brute force scores in decreasing order
+    """
+    query_bits = fp_lists[3]
+    expected = sorted(brute_force_tanimoto(query_bits, fp_lists).values(), reverse=True)
+    hits = fp_index.top_k(query_bits, 0.1, k)
+    scores = [score for _, score in hits]
+    assert scores == sorted(scores, reverse=True)
+    assert scores == pytest.approx([score for score in expected if score >= 0.1][:k])
+    assert hits[0][0] == "C" + "3".zfill(40)
+
+
+def test_bucket_order():
+    """
+    GIVEN popcount buckets and a query popcount
+    WHEN buckets are ordered for a top k search
+    THEN make sure their Tanimoto upper bounds never increase
+    """
+    order = fingerprints.bucket_order(range(1, 200), 50)
+    assert order[0] == 50
+    bounds = [fingerprints.tanimoto_bound(count, 50) for count in order]
+    assert bounds == sorted(bounds, reverse=True)
+
+
+@pytest.mark.parametrize("limit", [3, 1000])
+def test_index_search_many(fp_index, fp_lists, limit):
+    """
+    GIVEN a fingerprint index and a batch of query fingerprints
+    WHEN all queries are searched in a single pass
+    THEN make sure each query gets the same hits as a search on its own
+    """
+    queries = fp_lists[:20]
+    batch_hits = fp_index.search_many(queries, 0.3, limit)
+    assert len(batch_hits) == len(queries)
+    for query_bits, hits in zip(queries, batch_hits):
+        assert hits == fp_index.search(query_bits, 0.3, limit)
+
+
+def test_index_subset_shards(fp_index, fp_lists):
+    """
+    GIVEN a fingerprint index split into contiguous shards
+    WHEN each shard is searched and the hits are merged in shard order
+    THEN make sure the merged hits are those of a search of the whole index
+    """
+    query_bits = fp_lists[7]
+    start, stop = fp_index.window(len(query_bits), 0.2)
+    bounds = np.linspace(start, stop, 5).astype(int)
+    merged = []
+    for shard_start, shard_stop in zip(bounds[:-1], bounds[1:]):
+        merged += fp_index.subset(shard_start, shard_stop).search(query_bits, 0.2, 1000)
+    assert merged == fp_index.search(query_bits, 0.2, 1000)
+
+
+def test_index_deadline(fp_index, fp_lists):
+    """
+    GIVEN a fingerprint index
+    WHEN it is searched with a deadline that has run out or has time left
+    THEN make sure an expired search stops with no hits and marks the
+        deadline truncated, and one with time left runs to completion
+    """
+    query_bits = fp_lists[0]
+    for search in [lambda deadline: fp_index.search(query_bits, 0.1, 1000, deadline=deadline),
+                   lambda deadline: fp_index.top_k(query_bits, 0.1, 10, deadline=deadline),
+                   lambda deadline: fp_index.search_many([query_bits], 0.1, 1000,
+                                                         deadline=deadline)[0]]:
+        deadline = Deadline(0)
+        assert search(deadline) == []
+        assert deadline.truncated
+        deadline = Deadline(60000)
+        assert search(deadline) == search(None)
+        assert not deadline.truncated
+
+
+@pytest.mark.parametrize("n_query_bits", [0, 1, 3, 10])
+def test_bit_postings_screen(fp_index, fp_lists, n_query_bits):
+    """
+    GIVEN bit postings of a fingerprint index
+    WHEN compounds are screened for a set of query on-bits
+    THEN make sure exactly the compounds with all those bits on are returned
+    """
+    postings = fingerprints.BitPostings(fp_index)
+    # Mix of rare bits (kept as arrays) and common bits (kept as bitmaps)
+    query_bits = sorted(range(fingerprints.FP_SIZE),
+                        key=lambda bit: postings.cardinalities[bit])[::50][:n_query_bits]
+    expected = {f"C{i:040d}" for i, fp in enumerate(fp_lists) if set(query_bits) <= set(fp)}
+    screened = list(postings.screen_ids(query_bits))
+    assert set(screened) == expected
+    assert len(screened) == len(expected)
+    assert list(postings.screen(query_bits)) == sorted(postings.screen(query_bits))
+
+
+def test_fp_store_round_trip(fp_store_path, fp_index, fp_lists):
+    """
+    GIVEN a fingerprint store written from core compounds
+    WHEN it is opened and indexes of its MINEs are searched
+    THEN make sure they find the same hits as indexes built in memory
+    """
+    store = fingerprints.FingerprintStore(fp_store_path)
+    assert len(store) == len(fp_lists)
+    assert store.mines == ["EcoCyc", "KEGG"]
+    assert store.fp_type == "RDKit_fp"
+    assert store.index_for("Invalid") is None
+
+    query_bits = fp_lists[0]
+    ecocyc = store.index_for("EcoCyc")
+    assert len(ecocyc) == len(fp_lists)
+    assert sorted(ecocyc.search(query_bits, 0.2, 1000)) \
+        == sorted(fp_index.search(query_bits, 0.2, 1000))
+    kegg = store.index_for("KEGG")
+    assert len(kegg) == len(fp_lists[::2])
+    assert {cpd_id for cpd_id, _ in kegg.search(query_bits, 0.0, 1000)} \
+        == {f"C{i:040d}" for i in range(0, len(fp_lists), 2)}
+
+
+def test_fp_store_version_mismatch(fp_store_path):
+    """
+    GIVEN a fingerprint store written in another format version
+    WHEN it is opened
+    THEN make sure it is refused as stale
+    """
+    with open(fp_store_path, "r+b") as store_file:
+        magic, _, header_len = fingerprints._STORE_PREAMBLE.unpack(
+            store_file.read(fingerprints._STORE_PREAMBLE.size))  # pylint: disable=protected-access
+        store_file.seek(0)
+        store_file.write(fingerprints._STORE_PREAMBLE.pack(  # pylint: disable=protected-access
+            magic, fingerprints.STORE_VERSION + 1, header_len))
+    with pytest.raises(StaleStoreError, match="version"):
+        fingerprints.FingerprintStore(fp_store_path)
+
+
+def test_fp_store_checksum(fp_store_path):
+    """
+    GIVEN a fingerprint store whose contents changed after it was written
+    WHEN it is opened
+    THEN make sure it is refused as stale unless verification is off
+    """
+    with open(fp_store_path, "r+b") as store_file:
+        store_file.seek(-1, 2)
+        last_byte = store_file.read(1)
+        store_file.seek(-1, 2)
+        store_file.write(bytes([last_byte[0] ^ 0xFF]))
+    with pytest.raises(StaleStoreError, match="checksum"):
+        fingerprints.FingerprintStore(fp_store_path)
+    assert len(fingerprints.FingerprintStore(fp_store_path, verify=False)) == 500
+
+
+def test_fp_store_stale(fp_store_path, fake_core_db, fp_lists, tmp_path, monkeypatch):
+    """
+    GIVEN a fingerprint store and a core database that changed since
+    WHEN the store is opened against the core database, or rebuilt while
+        compound MINE membership changes
+    THEN make sure it is refused, and the rebuild fails without leaving a
+        partial file behind
+    """
+    # Keep the store opened here from being used by other tests
+    monkeypatch.setattr(fingerprints, "_store", None)
+    core_db = fake_core_db
+    assert len(fingerprints.open_fp_store(fp_store_path, core_db=core_db)) == len(fp_lists)
+    core_db.compounds.docs = core_db.compounds.docs[:-1]
+    with pytest.raises(StaleStoreError, match="rebuild"):
+        fingerprints.open_fp_store(fp_store_path, core_db=core_db)
+
+    core_db.compounds.distinct = lambda field: ["EcoCyc"]
+    path = str(tmp_path / "changed" / "fps.store")
+    os.makedirs(os.path.dirname(path))
+    with pytest.raises(ValueError, match="changed while writing"):
+        fingerprints.write_fp_store(core_db, path)
+    assert os.listdir(os.path.dirname(path)) == []
@@ -0,0 +1,92 @@
+"""Tests for molecules.py using pytest."""
+
+from rdkit.Chem import AllChem
+
+from api import molecules
+
+ETHANOL_MOLBLOCK = """{name}
+  {program}
+
+  3  2  0  0  0  0  0  0  0  0999 V2000
+    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    1.2990    0.7500    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    2.5981   -0.0000    0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0
+  1  2  1  0
+  2  3  1  0
+M  END
+"""
+
+
+class FakeMolBinaries(object):
+    """In-memory stand-in for the mol_binaries collection, recording the
+    _ids each find asks for."""
+
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.requested = []
+
+    def find(self, query):
+        ids = query["_id"]["$in"]
+        self.requested.append(list(ids))
+        return [self.docs[cpd_id] for cpd_id in ids if cpd_id in self.docs]
+
+
+def test_parse_structure_cache():
+    """
+    GIVEN a query structure sent several times (as molfiles exported at
+    different times)
+    WHEN it is parsed each time
+    THEN make sure it is only parsed once and derived values are shared
+    """
+    molecules.set_structure_cache_size(10)
+    first = molecules.parse_structure(
+        ETHANOL_MOLBLOCK.format(name="ethanol", program="Mrv1810 01012100002D")
+    )
+    second = molecules.parse_structure(
+        ETHANOL_MOLBLOCK.format(name="", program="Mrv1810 06152113372D")
+    )
+    assert first is second
+    assert first.smiles == "CCO"
+    assert first.inchi_key == "LFQSCWFLJHTTHZ-UHFFFAOYSA-N"
+    assert first.fp_bits("RDKit_fp") is second.fp_bits("RDKit_fp")
+    assert molecules.parse_structure("CCO") is not first
+    assert molecules.structure_cache_stats() == {"size": 2, "max_size": 10, "hits": 1,
+                                                 "misses": 2}
+
+
+def test_mol_cache():
+    """
+    GIVEN a molecule cache over stored binary molecules
+    WHEN molecules are requested again, beyond its size and without a
+    stored molecule
+    THEN make sure hits skip the database, least recently used molecules are
+    evicted and SMILES are parsed as a fallback
+    """
+    smiles = {"C1": "CCO", "C2": "CC=O", "C3": "CC(=O)O"}
+    mol_binaries = FakeMolBinaries([
+        {"_id": cpd_id, "Mol": AllChem.MolFromSmiles(smi).ToBinary()}
+        for cpd_id, smi in smiles.items() if cpd_id != "C3"
+    ])
+    mol_cache = molecules.MolCache({molecules.MOL_COLLECTION: mol_binaries}, max_size=2)
+    compounds = [{"_id": cpd_id, "SMILES": smi} for cpd_id, smi in smiles.items()]
+
+    mols = mol_cache.get_mols(compounds[:2])
+    assert [AllChem.MolToSmiles(mol) for mol in mols] == ["CCO", "CC=O"]
+    assert mol_binaries.requested == [["C1", "C2"]]
+    assert mol_cache.stats() == {"size": 2, "max_size": 2, "hits": 0, "misses": 2,
+                                 "smiles_fallbacks": 0}
+
+    # Both cached, no database read
+    assert mol_cache.get_mols(compounds[:2]) == mols
+    assert len(mol_binaries.requested) == 1
+    assert mol_cache.stats()["hits"] == 2
+
+    # C3 has no stored molecule and evicts C1, the least recently used
+    mol_cache.get_mols(compounds[1:2])
+    assert AllChem.MolToSmiles(mol_cache.get_mols(compounds[2:])[0]) == "CC(=O)O"
+    assert mol_binaries.requested[-1] == ["C3"]
+    assert mol_cache.stats()["smiles_fallbacks"] == 1
+    mol_cache.get_mols(compounds[:1])
+    assert mol_binaries.requested[-1] == ["C1"]
+    assert mol_cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 4,
+                                 "smiles_fallbacks": 1}
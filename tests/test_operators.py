@@ -0,0 +1,24 @@
+"""Tests for operators.py using pytest."""
+
+from api.operators import OperatorCatalog
+
+
+def test_operator_catalog():
+    """
+    GIVEN a catalog of operators
+    WHEN operators are looked up by _id or Name
+    THEN make sure the right operators (or None) are returned
+    """
+    operators = [
+        {"_id": "2.7.1.a", "Name": "rule0001"},
+        {"_id": "1.1.-1.h", "Name": "rule0002"},
+        {"_id": "rule0001"},
+    ]
+    catalog = OperatorCatalog(operators, version=(None, 3))
+
+    assert len(catalog) == 3
+    assert catalog.get("2.7.1.a") is operators[0]
+    assert catalog.get("rule0002") is operators[1]
+    # _ids take precedence over names
+    assert catalog.get("rule0001") is operators[2]
+    assert catalog.get("Invalid") is None
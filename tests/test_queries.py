@@ -5,7 +5,7 @@ import pymongo
 import pytest
 from pymongo.errors import ServerSelectionTimeoutError
 
-from api import queries
+from api import operators, queries
 from minedatabase import databases
 
 
@@ -20,6 +20,40 @@ except ServerSelectionTimeoutError as err:
 valid_db = pytest.mark.skipif(not is_mongo, reason="No MongoDB Connection")
 
 
+@pytest.fixture
+def op_rxns_db(monkeypatch):
+    """Database with an operator of 7 reactions indexed in chunks of 3."""
+    monkeypatch.setattr(operators, "OP_RXN_CHUNK_SIZE", 3)
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    db = client["mongotest_op_rxns"]
+    db.operators.insert_one({"_id": "2.7.1.a", "Name": "rule0001", "Reaction_count": 7})
+    rxn_ids = [f"R{i}" for i in range(7)]
+    db[operators.OP_RXN_COLLECTION].insert_many([
+        {"operator": "2.7.1.a", "chunk": i // 3, "Reaction_ids": rxn_ids[i:i + 3]}
+        for i in range(0, 7, 3)
+    ])
+    yield db
+    client.drop_database(db.name)
+
+
+@pytest.fixture
+def cpd_rxns_db():
+    """Database with a compound produced by 7 reactions, listed in product_of
+    documents of 3, 0 and 4 reaction ids."""
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    db = client["mongotest_cpd_rxns"]
+    rxn_ids = [f"R{i}" for i in range(7)]
+    db.reactions.insert_many([{"_id": rxn_id, "Reactant_SMILES": [], "Product_SMILES": []}
+                              for rxn_id in rxn_ids])
+    db.product_of.insert_many([
+        {"_id": "P0", "c_id": "C1", "Product_of": rxn_ids[:3]},
+        {"_id": "P1", "c_id": "C1", "Product_of": []},
+        {"_id": "P2", "c_id": "C1", "Product_of": rxn_ids[3:]},
+    ])
+    yield db
+    client.drop_database(db.name)
+
+
 @valid_db
 def test_quick_search(test_db, glucose, glucose_id):
     """
@@ -59,6 +93,29 @@ def test_database_query(test_db, glucose, glucose_id):
     assert queries.advanced_search(test_db, "{'MINE_id': 917030}", {"_id": 1}) == [
         glucose_id
     ]
+    with pytest.raises(ValueError):
+        queries.advanced_search(test_db, "{'$where': 'true'}")
+
+    first, token = queries.advanced_search_page(test_db, "{'MINE_id': {'$gte': 0}}", 1,
+                                                search_projection={"_id": 1})
+    second, _ = queries.advanced_search_page(test_db, "{'MINE_id': {'$gte': 0}}", 1,
+                                             token=token, search_projection={"_id": 1})
+    assert token and len(first) == len(second) == 1 and first != second
+    # Paging goes through the matches once each, in _id order
+    all_ids = sorted(x["_id"] for x in test_db.compounds.find({"MINE_id": {"$gte": 0}}))
+    paged_ids = []
+    token = None
+    while True:
+        page, token = queries.advanced_search_page(test_db, "{'MINE_id': {'$gte': 0}}", 2,
+                                                   token=token, search_projection={"_id": 1})
+        paged_ids += [x["_id"] for x in page]
+        if token is None:
+            break
+    assert paged_ids == all_ids
+    page, _ = queries.advanced_search_page(test_db, "{'MINE_id': 917030}", 1,
+                                           search_projection={"_id": 0, "MINE_id": 1})
+    assert page == [{"MINE_id": 917030}]
+    assert "stages" in queries.explain_advanced_search(test_db, "{'MINE_id': 917030}")
 
 
 @valid_db
@@ -171,3 +228,117 @@ def test_get_ops(test_db):
     assert len(ops) == 2
     assert ops[0]["_id"] == "2.7.1.a"
     assert ops[1] == None
+
+
+def test_continuation_token():
+    """
+    GIVEN a position in a paged result list
+    WHEN it is encoded as a continuation token
+    THEN make sure it decodes to the same position and bad tokens are rejected
+    """
+    token = queries._encode_token(3, 250)
+    assert queries._decode_token(token) == (3, 250)
+    for bad_token in ["not a token", queries._encode_token(-1, 0), "W10="]:
+        with pytest.raises(ValueError):
+            queries._decode_token(bad_token)
+
+    token = queries._encode_id_token("Ccffda1b2e82fcdb0e1e710cad4d5f70df7a5d74f")
+    assert queries._decode_id_token(token) == "Ccffda1b2e82fcdb0e1e710cad4d5f70df7a5d74f"
+    for bad_token in ["not a token", queries._encode_token(3), queries._encode_id_token(3)]:
+        with pytest.raises(ValueError):
+            queries._decode_id_token(bad_token)
+
+
+@valid_db
+@pytest.mark.parametrize("page_size", [1, 2, 3, 4, 7, 10])
+def test_get_rxns_for_cpd_page(cpd_rxns_db, page_size):
+    """
+    GIVEN a compound whose reaction ids are listed in several documents
+    WHEN its reactions are paged through with continuation tokens
+    THEN make sure every reaction is returned once, in list order, and the
+        total is only counted for the first page
+    """
+    rxn_ids = []
+    token = None
+    n_pages = 0
+    while True:
+        rxns, token, total = queries.get_rxns_for_cpd_page(cpd_rxns_db, "C1", page_size=page_size,
+                                                           token=token)
+        assert total == (7 if n_pages == 0 else None)
+        assert len(rxns) <= page_size
+        rxn_ids += [rxn["_id"] for rxn in rxns]
+        n_pages += 1
+        if token is None:
+            break
+    assert rxn_ids == [f"R{i}" for i in range(7)]
+    assert n_pages == -(-7 // page_size)
+    assert queries.count_rxns_for_cpd(cpd_rxns_db, "C2") == 0
+
+
+@valid_db
+def test_get_op_rxn_ids(op_rxns_db):
+    """
+    GIVEN an operator with reaction _ids indexed in chunks
+    WHEN ranges of them are read by offset
+    THEN make sure the right _ids are returned across chunk boundaries
+    """
+    rxn_ids = [f"R{i}" for i in range(7)]
+    for offset, n_ids in [(0, 3), (0, 7), (2, 2), (2, 5), (3, 3), (5, 10), (6, 1), (7, 3)]:
+        assert operators.get_op_rxn_ids(op_rxns_db, "2.7.1.a", offset, n_ids) \
+            == rxn_ids[offset:offset + n_ids]
+    assert operators.get_op_rxn_ids(op_rxns_db, "Invalid", 0, 3) == []
+
+
+@valid_db
+def test_get_op_rxns_page(op_rxns_db):
+    """
+    GIVEN an operator with reaction _ids indexed in chunks
+    WHEN its reactions are paged through with continuation tokens
+    THEN make sure every reaction _id is returned once with the total count
+    """
+    rxn_ids = []
+    token = None
+    n_pages = 0
+    while True:
+        operator, token = queries.get_op_rxns_page(op_rxns_db, "rule0001", page_size=2,
+                                                   token=token)
+        assert operator["Reaction_count"] == 7
+        rxn_ids.extend(operator["Reaction_ids"])
+        n_pages += 1
+        if token is None:
+            break
+    assert rxn_ids == [f"R{i}" for i in range(7)]
+    assert n_pages == 4
+
+    operator, token = queries.get_op_rxns_page(op_rxns_db, "2.7.1.a", page_size=7)
+    assert len(operator["Reaction_ids"]) == 7
+    assert token is None
+    with pytest.raises(ValueError):
+        queries.get_op_rxns_page(op_rxns_db, "2.7.1.a", token="not a token")
+
+
+@valid_db
+def test_block1_filter_index_recheck(monkeypatch):
+    """
+    GIVEN a collection whose inchikey_block1 index is built while the server
+    runs
+    WHEN InChIKey first block filters are made for it
+    THEN make sure they switch to the index once it is checked again
+    """
+    client = pymongo.MongoClient(ServerSelectionTimeoutMS=2000)
+    collection = client["mongotest_block1"].compounds
+    collection.insert_one({"_id": "C1", "Inchikey": "WQZGKKKJIJFFOK-GASJEMHNSA-N"})
+    try:
+        inchi_keys = ["WQZGKKKJIJFFOK-GASJEMHNSA-N"]
+        assert "Inchikey" in queries.inchikey_block1_in_filter(collection, inchi_keys,
+                                                               "Inchikey")
+        collection.create_index(queries.INCHIKEY_BLOCK1)
+        # Not checked again before the interval passes
+        assert "Inchikey" in queries.inchikey_block1_in_filter(collection, inchi_keys,
+                                                               "Inchikey")
+        monkeypatch.setattr(queries, "BLOCK1_INDEX_CHECK_INTERVAL", 0)
+        assert queries.inchikey_block1_in_filter(collection, inchi_keys, "Inchikey") \
+            == {queries.INCHIKEY_BLOCK1: {"$in": ["WQZGKKKJIJFFOK"]}}
+    finally:
+        client.drop_database("mongotest_block1")
+        queries._block1_indexed.clear()  # pylint: disable=protected-access
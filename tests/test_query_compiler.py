@@ -0,0 +1,71 @@
+"""Tests for query_compiler.py using pytest."""
+
+import pytest
+
+from api.query_compiler import (RXN_FIELDS, QueryError, compile_projection, compile_query,
+                                plan_summary)
+
+
+def test_compile_query():
+    """
+    GIVEN queries with Mongo syntax
+    WHEN they are compiled
+    THEN make sure plain filters on known fields pass and anything else is refused
+    """
+    assert compile_query("{'MINE_id': 917030}") == {"MINE_id": 917030}
+    assert compile_query("{'$or': [{'Names': 'Glucose'}, {'Mass': {'$gt': 180, '$lt': 181}}]}")
+    assert compile_query("{'Sources.Operators': {'$elemMatch': {'$eq': '1.1.1.a'}}}")
+    assert compile_query("{'Names': {'$not': {'$regex': '^gluc', '$options': 'i'}}}")
+
+    for query in ["{'$where': 'sleep(1000)'}", "{'$expr': {'$gt': ['$Mass', 1]}}",
+                  "{'password': 1}", "{'Mass': {'$function': {}}}",
+                  "{'Names': {'$or': [{'a': 1}]}}", "{'Names': {'x': {'$ne': 1}}}",
+                  "['MINE_id']", "{'MINE_id': }", "__import__('os')",
+                  "{'Mass': {'$gt': {1, 2}}}", "{'$and': []}", "{'Names.$': 'Glucose'}"]:
+        with pytest.raises(QueryError):
+            compile_query(query)
+    with pytest.raises(QueryError):
+        compile_query("{'Names': " * 20 + "1" + "}" * 20)
+
+
+def test_compile_projection():
+    """
+    GIVEN fields requested by a client
+    WHEN a projection is compiled from them
+    THEN make sure only known fields are accepted
+    """
+    assert compile_projection(["SMILES", "Sources.Operators"]) == {"SMILES": 1,
+                                                                    "Sources.Operators": 1}
+    assert compile_projection(["Operators"], RXN_FIELDS) == {"Operators": 1}
+    with pytest.raises(QueryError):
+        compile_projection(["SMILES"], RXN_FIELDS)
+    for fields in [["SMILES", "RDKit_fp"], ["SMILES.$"], ["Sources.$.Operators"],
+                   ["Sources..Operators"], ["Names."]]:
+        with pytest.raises(QueryError):
+            compile_projection(fields)
+
+
+def test_plan_summary():
+    """
+    GIVEN the output of explain for indexed and unindexed queries
+    WHEN it is summarized
+    THEN make sure the stages and indexes used are found
+    """
+    indexed = {"queryPlanner": {"winningPlan": {
+        "stage": "FETCH",
+        "inputStage": {"stage": "IXSCAN", "indexName": "MINE_id_1"},
+    }}}
+    summary = plan_summary(indexed)
+    assert summary["stages"] == ["FETCH", "IXSCAN"]
+    assert summary["indexes"] == ["MINE_id_1"]
+    assert not summary["collscan"]
+
+    unindexed = {"queryPlanner": {"winningPlan": {"queryPlan": {
+        "stage": "SUBPLAN",
+        "inputStage": {"stage": "OR", "inputStages": [
+            {"stage": "IXSCAN", "indexName": "Names_1"}, {"stage": "COLLSCAN"},
+        ]},
+    }}}}
+    summary = plan_summary(unindexed)
+    assert summary["indexes"] == ["Names_1"]
+    assert summary["collscan"]
@@ -0,0 +1,107 @@
+"""Tests for serialization.py using pytest."""
+
+import datetime
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+from api import serialization
+
+
+@pytest.fixture
+def document():
+    """Compound-like document with values the stdlib encoder can't handle."""
+    pint = pytest.importorskip("pint")
+    ureg = pint.UnitRegistry()
+    return {
+        "_id": ObjectId("5f0f1b2c3d4e5f6a7b8c9d0e"),
+        "SMILES": "OCC1OC(O)C(O)C(O)C1O",
+        "Mass": np.float64(180.06338810399998),
+        "Generation": np.int64(0),
+        "RDKit_fp": np.array([3, 17, 256], dtype=np.int32),
+        "Sources": {"rule0001", "rule0002"},
+        "dG": ureg.Quantity(-915.9, "kJ/mol"),
+        "Updated": datetime.datetime(2020, 5, 1, 12, 30),
+        "Spectra": {"Positive CFM-ID Spectrum": {"20 V": [[181.07, 3.5]]}},
+    }
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps(document, monkeypatch, use_orjson):
+    """
+    GIVEN a document with ObjectId, numpy, pint and date values
+    WHEN it is serialized with or without orjson
+    THEN make sure both give the same plain JSON values, with keys sorted
+        only when asked to
+    """
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serialization, "orjson", None)
+
+    assert serialization.loads(serialization.dumps(document)) == {
+        "_id": "5f0f1b2c3d4e5f6a7b8c9d0e",
+        "SMILES": "OCC1OC(O)C(O)C(O)C1O",
+        "Mass": 180.06338810399998,
+        "Generation": 0,
+        "RDKit_fp": [3, 17, 256],
+        "Sources": list(document["Sources"]),
+        "dG": -915.9,
+        "Updated": "2020-05-01T12:30:00",
+        "Spectra": {"Positive CFM-ID Spectrum": {"20 V": [[181.07, 3.5]]}},
+    }
+    with pytest.raises(TypeError):
+        serialization.dumps({"bad": object()})
+
+    data = serialization.dumps({"b": {"d": 1, "c": 2}, "a": 3}, sort_keys=True)
+    assert data == b'{"a":3,"b":{"c":2,"d":1}}'
+    assert serialization.dumps({"b": 1, "a": 2}) == b'{"b":1,"a":2}'
+
+
+@pytest.fixture
+def compounds():
+    """Compound documents as get-comps returns them."""
+    return [
+        {"_id": "Ccffda1b2e82fcdb0e1e710cad4d5f70df7a5d74f", "MINE_id": 917030,
+         "SMILES": "OCC1OC(O)C(O)C(O)C1O", "Mass": 180.06338810399998,
+         "Names": ["Glucose", "D-Glucose"], "RDKit_fp": [3, 17, 256, 511],
+         "Pattern_fp": [0, 2047], "Generation": 0,
+         "Spectra": {"Positive CFM-ID Spectrum": {"20 V": [[181.07, 3.5]]}},
+         "Product_of": ["R1", "R2"]},
+        {"_id": "C1", "MINE_id": 1, "SMILES": "O", "Mass": 18.0105646837,
+         "RDKit_fp": [], "Generation": 1, "Product_of": [[1, "R3"]]},
+    ]
+
+
+def test_msgpack_round_trip(compounds):
+    """
+    GIVEN compound documents
+    WHEN they are serialized to MessagePack and back
+    THEN make sure the result is the same as with JSON
+    """
+    pytest.importorskip("msgpack")
+    expected = serialization.loads(serialization.dumps(compounds))
+    assert serialization.loads_msgpack(serialization.dumps_msgpack(compounds)) == expected
+
+
+def test_arrow_round_trip(compounds):
+    """
+    GIVEN compound documents and a list of ids
+    WHEN they are serialized to Arrow streams and back
+    THEN make sure the results are the same as with JSON and fingerprints
+        are stored as fixed size bitmaps
+    """
+    pa = pytest.importorskip("pyarrow")
+    expected = serialization.loads(serialization.dumps(compounds))
+    data = serialization.dumps_arrow(compounds)
+    assert serialization.loads_arrow(data) == expected
+
+    schema = pa.ipc.open_stream(data).schema
+    assert schema.field("RDKit_fp").type == pa.binary(64)
+    assert schema.field("Pattern_fp").type == pa.binary(256)
+    assert schema.field("Spectra").metadata == {b"encoding": b"json"}
+
+    ids = [compound["_id"] for compound in compounds]
+    assert serialization.loads_arrow(serialization.dumps_arrow(ids)) == ids
+    assert serialization.loads_arrow(serialization.dumps_arrow([])) == []